@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# Convert the capture files under waveform-data/rf into the binary cache used by extract.py --cache.  Any arguments
+# are passed on to capture_cache.py (e.g., a list of zones, or --dtype float32).
+
+# This figures out the real directory where this script lives
+DIR="$( cd "$( dirname "$(readlink -f "${BASH_SOURCE[0]}")" )" >/dev/null 2>&1 && pwd )"
+app_dir=$(readlink -f $DIR/..)
+
+source $app_dir/venv/bin/activate
+python $app_dir/python/capture_cache.py "$@"
@@ -1,11 +1,24 @@
 #!/bin/bash
 
+# Usage: do_cavity_extraction.bash <label_file> <log_dir> [extract.py options] [--profile]
+
 # This figures out the real directory where this script lives
 DIR="$( cd "$( dirname "$(readlink -f "${BASH_SOURCE[0]}")" )" >/dev/null 2>&1 && pwd )"
 app_dir=$(readlink -f $DIR/..)
 
 log_dir=$2
 log_file=$log_dir/cav.$(basename $1).log
+profile_file=$log_dir/cav.$(basename $1).profile.jsonl
+
+# A bare --profile from the driver scripts writes this job's profile to $profile_file
+args=()
+for arg in "${@:3}"; do
+    if [ "$arg" == "--profile" ] ; then
+        args+=(--profile $profile_file)
+    else
+        args+=("$arg")
+    fi
+done
 
 source $app_dir/venv/bin/activate
-python $app_dir/python/extract.py $1 cavity > $log_file 2>&1
+python $app_dir/python/extract.py $1 cavity --index "${args[@]}" > $log_file 2>&1
@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# Usage: do_worker_extraction.bash <spool_dir> <log_dir> [worker.py serve options] [--profile]
+
+# This figures out the real directory where this script lives
+DIR="$( cd "$( dirname "$(readlink -f "${BASH_SOURCE[0]}")" )" >/dev/null 2>&1 && pwd )"
+app_dir=$(readlink -f $DIR/..)
+
+spool_dir=$1
+log_dir=$2
+log_file=$log_dir/worker.$(hostname).log
+profile_file=$log_dir/worker.$(hostname).profile.jsonl
+
+# A bare --profile from the driver scripts writes this job's profile to $profile_file
+args=()
+for arg in "${@:3}"; do
+    if [ "$arg" == "--profile" ] ; then
+        args+=(--profile $profile_file)
+    else
+        args+=("$arg")
+    fi
+done
+
+source $app_dir/venv/bin/activate
+python $app_dir/python/worker.py serve $spool_dir --exit-when-empty --index "${args[@]}" > $log_file 2>&1
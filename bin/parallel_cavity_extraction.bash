@@ -1,17 +1,71 @@
 #!/bin/bash
 
+# Usage: parallel_cavity_extraction.bash [--force] [--dry-run] [--mem-budget=MB] [--features=SUBSET_FILE] [--profile]
+#   Only events that are new, or whose label, capture files, or feature settings changed since their last
+#   extraction (or whose output is missing) are run.  See python/manifest.py.
+#   --force    run every event
+#   --dry-run  list the events that would be run, and why, without running anything
+#   --mem-budget=MB
+#              keep each job under MB of resident memory (see python/chunked_features.py), and only start a job on
+#              a node with at least that much memory free
+#   --features=SUBSET_FILE
+#              only extract the features listed in this file (see python/feature_selection.py)
+#   --profile  write a timing profile of every job to the log directory (see python/profiling.py)
+
 # This figures out the real directory where this script lives
 DIR="$( cd "$( dirname "$(readlink -f "${BASH_SOURCE[0]}")" )" >/dev/null 2>&1 && pwd )"
 app_dir=$(readlink -f $DIR/..)
 
 now=$(date +%F_%T)
 nodes=$app_dir/nodefile
-labels_dir=$app_dir/labeled-examples/processed
 log_dir=$app_dir/log/cavity_$now
 job_log=$log_dir/cavity_${now}_jobs.log
+todo_file=$log_dir/cavity_${now}_todo.txt
+
+# Events come from the label table if process.py wrote one (--table), and otherwise from the processed label files
+labels=$app_dir/labeled-examples/processed
+if [ -f $app_dir/labeled-examples/processed.tsv ] ; then
+    labels=$app_dir/labeled-examples/processed.tsv
+fi
+
+# Options that change the extracted features are given to both the plan and the extraction jobs
+plan_args=""
+extract_args=""
+dry_run=0
+mem_budget=""
+profile=""
+for arg in "$@"; do
+    case $arg in
+        --force) plan_args="$plan_args --force" ;;
+        --dry-run) dry_run=1 ;;
+        --mem-budget=*) mem_budget=${arg#--mem-budget=} ;;
+        --profile) profile="--profile" ;;
+        --features=*) extract_args="$extract_args --features $(readlink -f ${arg#--features=})" ;;
+        *) echo "Usage: $(basename $0) [--force] [--dry-run] [--mem-budget=MB] [--features=SUBSET_FILE] [--profile]"; exit 1 ;;
+    esac
+done
 
-cmd="$app_dir/bin/do_cavity_extraction.bash {} $log_dir"
+parallel_args=""
+if [ -n "$mem_budget" ] ; then
+    extract_args="$extract_args --mem-budget $mem_budget"
+    parallel_args="--memfree ${mem_budget}M"
+fi
+plan_args="$plan_args $extract_args"
+cmd="$app_dir/bin/do_cavity_extraction.bash {} $log_dir $extract_args $profile"
+
+source $app_dir/venv/bin/activate
+python $app_dir/python/event_index.py refresh || exit 1
+if [ $dry_run -eq 1 ] ; then
+    python $app_dir/python/manifest.py plan cavity $labels $plan_args --explain --index
+    exit 0
+fi
 
 mkdir -p $log_dir
 
-ls $labels_dir/* | parallel -j+0 --progress --sshloginfile $nodes --sshdelay 0.1 --workdir $app_dir --joblog $job_log $cmd
+# Report every label that can't be matched to its event directory up front
+python $app_dir/python/event_index.py check $labels > $log_dir/cavity_${now}_unmatched.txt
+
+python $app_dir/python/manifest.py plan cavity $labels $plan_args --index > $todo_file || exit 1
+deactivate
+
+cat $todo_file | parallel -j+0 $parallel_args --progress --sshloginfile $nodes --sshdelay 0.1 --workdir $app_dir --joblog $job_log $cmd
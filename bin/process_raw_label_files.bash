@@ -10,7 +10,14 @@ processed_dir=$labeled_dir/processed
 
 source $app_dir/venv/bin/activate
 
+# Any options (e.g., --table) are passed on to process.py.  find is used since there can be too many files for rm.
 if [ -d "$processed_dir" ] ; then
-    rm -f $processed_dir/*
+    find $processed_dir -mindepth 1 -maxdepth 1 -type f -delete
 fi
-python $python_dir/process.py $labeled_dir |& tee $labeled_dir/process.log
+
+# The extraction scripts use the default label table whenever it exists, so drop it when writing label files instead
+case " $* " in
+    *" --table"*) ;;
+    *) rm -f $labeled_dir/processed.tsv $labeled_dir/processed.tsv.idx ;;
+esac
+python $python_dir/process.py "$@" $labeled_dir |& tee $labeled_dir/process.log
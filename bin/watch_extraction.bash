@@ -0,0 +1,17 @@
+#!/bin/bash
+
+# Watch waveform-data/rf for new fault events and extract their features into the feature store as soon as they are
+# harvested.  Runs until interrupted.  Any arguments are passed on to watch.py (e.g., a list of zones, or --backfill).
+# The per-event latency log is written to log/watch_<timestamp>.log.
+
+# This figures out the real directory where this script lives
+DIR="$( cd "$( dirname "$(readlink -f "${BASH_SOURCE[0]}")" )" >/dev/null 2>&1 && pwd )"
+app_dir=$(readlink -f $DIR/..)
+
+now=$(date +%F_%T)
+log_file=$app_dir/log/watch_$now.log
+
+mkdir -p $app_dir/log
+
+source $app_dir/venv/bin/activate
+python $app_dir/python/watch.py "$@" 2>&1 | tee $log_file
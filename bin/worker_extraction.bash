@@ -0,0 +1,47 @@
+#!/bin/bash
+
+# Queue the processed label files that need extraction (see python/manifest.py) in a spool directory and start one
+# warm worker per core on each host in nodefile.
+# Usage: worker_extraction.bash <(cavity|trip)> [--features=SUBSET_FILE] [--profile]
+#   --features=SUBSET_FILE
+#              only extract the features listed in this file (see python/feature_selection.py)
+#   --profile  write a timing profile of every worker to the log directory (see python/profiling.py)
+
+# This figures out the real directory where this script lives
+DIR="$( cd "$( dirname "$(readlink -f "${BASH_SOURCE[0]}")" )" >/dev/null 2>&1 && pwd )"
+app_dir=$(readlink -f $DIR/..)
+
+extract_type=$1
+shift
+
+# Options that change the extracted features are given to both the plan and the workers
+extract_args=""
+profile=""
+for arg in "$@"; do
+    case $arg in
+        --profile) profile="--profile" ;;
+        --features=*) extract_args="$extract_args --features $(readlink -f ${arg#--features=})" ;;
+        *) echo "Usage: $(basename $0) <(cavity|trip)> [--features=SUBSET_FILE] [--profile]"; exit 1 ;;
+    esac
+done
+
+now=$(date +%F_%T)
+nodes=$app_dir/nodefile
+labels=$app_dir/labeled-examples/processed
+if [ -f $app_dir/labeled-examples/processed.tsv ] ; then
+    # process.py --table wrote a label table instead of label files
+    labels=$app_dir/labeled-examples/processed.tsv
+fi
+log_dir=$app_dir/log/${extract_type}_worker_$now
+spool_dir=$log_dir/spool
+
+mkdir -p $log_dir
+
+source $app_dir/venv/bin/activate
+python $app_dir/python/event_index.py refresh || exit 1
+python $app_dir/python/manifest.py plan $extract_type $labels $extract_args --index > $log_dir/todo.txt || exit 1
+xargs -r python $app_dir/python/worker.py submit $spool_dir $extract_type < $log_dir/todo.txt || exit 1
+
+parallel --nonall --sshloginfile $nodes --workdir $app_dir $app_dir/bin/do_worker_extraction.bash $spool_dir $log_dir $extract_args $profile
+
+python $app_dir/python/worker.py status $spool_dir
@@ -0,0 +1,84 @@
+import os
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import extract
+
+# Compares the time and peak memory needed to assemble the cavity model waveforms of an event with the current
+# extract.load_cavity_waveforms and with the original concat-based code, which is kept here for reference.  Memory
+# is measured with tracemalloc, which sees numpy and pandas allocations.  Results are printed as a TSV, one row per
+# event, followed by the averages.
+
+
+# The cavity waveform assembly as it was originally written in extract.py
+def legacy_load_cavity_waveforms(event, event_id):
+    capture_files = os.listdir(event.event_dir)
+    waveforms_df = pd.DataFrame()
+    for m in range(0, 8):
+        f = os.path.join(event.event_dir, capture_files[m])
+        df = pd.read_table(f, sep='\t')
+        df['id'] = pd.Series(event_id, index=df.index)
+        col = ['Time',
+                f'{m+1}_IMES', f'{m+1}_QMES', f'{m+1}_GMES', f'{m+1}_PMES', f'{m+1}_IASK', f'{m+1}_QASK',
+                f'{m+1}_GASK', f'{m+1}_PASK', f'{m+1}_CRFP', f'{m+1}_CRFPP', f'{m+1}_CRRP', f'{m+1}_CRRPP',
+                f'{m+1}_GLDE', f'{m+1}_PLDE', f'{m+1}_DETA2_', f'{m+1}_CFQE2_', f'{m+1}_DFQES',
+                'id']
+        df.columns = col
+        waveforms_df = pd.concat([waveforms_df, df], axis=1, sort=False)
+        waveforms_df = waveforms_df.loc[:, ~waveforms_df.columns.duplicated()]
+
+    mapper = {"{}_DETA2_".format(m): "{}_DETA2".format(m) for m in range(1, 9)}
+    waveforms_df = waveforms_df.rename(columns=mapper)
+    return waveforms_df[extract.select_columns]
+
+
+# Run func(event, 1) repeat times.  Returns the result, the best wall time in seconds and the peak traced memory in
+# bytes.
+def measure(func, event, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(event, 1)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    func(event, 1)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark cavity waveform assembly against the original code.")
+    parser.add_argument('label_files', nargs='+', metavar='label_file',
+                        help="processed label file(s) or directories of label files")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="number of timed runs per event, the best is reported (default: %(default)s)")
+    args = parser.parse_args()
+
+    rows = []
+    print("event\tlegacy_s\tcurrent_s\tlegacy_peak_mb\tcurrent_peak_mb\tsame_result")
+    for label_file in extract.expand_label_files(args.label_files):
+        try:
+            event = extract.read_label_file(label_file)
+            event.event_dir = extract.find_event_dir(event)
+            legacy_df, legacy_s, legacy_peak = measure(legacy_load_cavity_waveforms, event, args.repeat)
+            current_df, current_s, current_peak = measure(extract.load_cavity_waveforms, event, args.repeat)
+        except extract.ExtractionError as ex:
+            print("Error: {}: {}".format(label_file, ex))
+            continue
+
+        same = np.array_equal(legacy_df.values.astype('float64'), current_df.values) and \
+            list(legacy_df.columns) == list(current_df.columns)
+        rows.append((legacy_s, current_s, legacy_peak / 2**20, current_peak / 2**20))
+        print("{} {}\t{:.4f}\t{:.4f}\t{:.1f}\t{:.1f}\t{}".format(event.zone, event.timestamp, *rows[-1], same))
+
+    if len(rows) > 0:
+        means = np.mean(rows, axis=0)
+        print("mean\t{:.4f}\t{:.4f}\t{:.1f}\t{:.1f}\t".format(*means))
+        print("Speedup: {:.1f}x, peak memory reduction: {:.1f}x".format(means[0] / means[1], means[2] / means[3]))
@@ -0,0 +1,460 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import contextlib
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+import tsfresh
+
+import extract
+import profiling
+import label_table
+import run
+import run_state
+
+# This script benchmarks extraction without access to the harvested waveform data.
+#
+# "generate" builds a synthetic tree laid out like the app:
+#   <root>/waveform-data/rf/<zone>/<date>/<time>.<n>/  - 8 capture files per event, <EPICS cavity>WFSharv.<...>.txt,
+#                                                        with Time and the 17 <EPICS cavity>WFS<signal> columns
+#   <root>/labeled-examples/processed/                - one label file per event, as process.py writes them
+#   <root>/label-processing/raw/                      - raw label files (with duplicate and mismatched labels) for
+#                                                        timing process.py
+# The capture files have --samples samples every --step ms, centered on the fault at t=0 (8192 samples of 0.2 ms
+# like the harvester).  Each signal is a level plus noise and a random walk, and the labeled cavity's signals decay
+# after t=0.  The shapes are only meant to give the feature calculators realistic work, not to be physical.  The
+# same --seed always gives the same tree.
+#
+# "run" times the cases below for every combination of event count and core count, and appends one JSON line per
+# case to the results file (default benchmarks/results.jsonl) along with the version of the code (git describe),
+# library versions and host.
+#   cavity, trip, both - extraction of the first N events as per-event jobs on a pool of C workers (run.py), with
+#                        the stage breakdown and peak RSS of the jobs taken from their profiles (see profiling.py)
+#   process            - process.py on the raw label files with C parsing processes, writing per-event files (the
+#                        event count of these cases is the number of raw label lines)
+#   process_table      - the same with --table
+#   write_csv          - writing the cavity features of N events as CSV files plus their manifest records
+#   write_store        - the same with the feature store
+#
+# "compare" lines up two versions in the results file case by case and reports the ones that got slower by more than
+# --threshold, exiting with 1 if there are any.
+
+# Where this script currently lives
+python_dir = os.path.dirname(os.path.realpath(__file__))
+
+# The root of the rfw_tsf_extractor app
+app_dir = os.path.realpath(os.path.join(python_dir, '..'))
+
+# Default location of stored results
+results_file = os.path.join(app_dir, 'benchmarks', 'results.jsonl')
+
+# The cases "run" knows about
+extraction_cases = extract.run_types
+process_cases = ('process', 'process_table')
+write_cases = ('write_csv', 'write_store')
+cases = extraction_cases + process_cases + write_cases
+
+# Fault types used for the synthetic labels.  Cavity 0 (multi cavity) events are left out of the extraction events
+# since trip extraction skips them, but they show up in the raw labels.
+faults = ('Quench', 'E_Quench', 'Microphonics', 'Controls Fault', 'Single Cav Turn off', 'Heat Riser Choke')
+
+# Typical level of each signal
+signal_levels = {'IMES': 5.0, 'QMES': 5.0, 'GMES': 10.0, 'PMES': 0.0, 'IASK': 5.0, 'QASK': 5.0, 'GASK': 10.0,
+                 'PASK': 0.0, 'CRFP': 2.0, 'CRFPP': 0.0, 'CRRP': 1.0, 'CRRPP': 0.0, 'GLDE': 10.0, 'PLDE': 0.0,
+                 'DETA2': 0.0, 'CFQE2': 0.0, 'DFQES': 0.0}
+
+
+# The header of label files
+label_header = "zone\tcavity\tcav#\tfault\ttime\n"
+
+
+# Paths of the synthetic tree
+def tree_paths(root):
+    return {'data_dir': os.path.join(root, 'waveform-data', 'rf'),
+            'label_dir': os.path.join(root, 'labeled-examples', 'processed'),
+            'process_dir': os.path.join(root, 'label-processing'),
+            'runs_dir': os.path.join(root, 'runs')}
+
+
+# The waveforms of one capture file.  Returns an array with the Time column followed by the 17 signals.
+def synthetic_waveforms(rng, time_axis, faulted):
+    n = len(time_axis)
+    values = np.empty((n, 1 + len(extract.waveforms)))
+    values[:, 0] = time_axis
+    decay = np.exp(-np.clip(time_axis, 0, None) / rng.uniform(5.0, 200.0)) if faulted else np.ones(n)
+    for i, signal in enumerate(extract.waveforms):
+        level = signal_levels[signal] * rng.uniform(0.8, 1.2)
+        walk = np.cumsum(rng.normal(0.0, 0.01, n))
+        values[:, i + 1] = (level + walk) * decay + rng.normal(0.0, 0.05, n)
+    return values
+
+
+# Write the capture files and label file of one event
+def write_event(rng, paths, zone, when, n, cavity, fault, time_axis):
+    date = when.strftime("%Y_%m_%d")
+    time_of_day = when.strftime("%H%M%S")
+    event_dir = os.path.join(paths['data_dir'], zone, date, "{}.{}".format(time_of_day, n))
+    os.makedirs(event_dir, exist_ok=True)
+
+    epics = extract.zone_dict[zone]
+    for cav in range(1, 9):
+        prefix = "{}{}WFS".format(epics, cav)
+        header = "\t".join(["Time"] + [prefix + s for s in extract.waveforms])
+        values = synthetic_waveforms(rng, time_axis, cav == cavity)
+        capture_file = os.path.join(event_dir, "{}harv.{}_{}.{}.txt".format(prefix, date, time_of_day, n))
+        np.savetxt(capture_file, values, fmt='%.6g', delimiter='\t', header=header, comments='')
+
+    line = label_line(zone, cavity, fault, when)
+    with open(os.path.join(paths['label_dir'], "{}.csv".format(label_table.event_key(line))), 'w') as fh:
+        fh.write(label_header)
+        fh.write(line + "\n")
+
+
+# A label line for an event
+def label_line(zone, cavity, fault, when):
+    return "{}\t{}\t{}\t{}\t{}".format(zone, cavity, cavity, fault, when.strftime("%Y/%m/%d %H:%M:%S"))
+
+
+# Write n_labels raw label lines split over n_files files.  About 5% of the events get a duplicate label and 1% a
+# second label that disagrees.
+def write_raw_labels(rng, raw_dir, n_labels, n_files):
+    os.makedirs(raw_dir, exist_ok=True)
+    zones = sorted(extract.zone_dict)
+    start = pd.Timestamp('2019-01-01').value // 10**9
+    lines = []
+    while len(lines) < n_labels:
+        when = pd.Timestamp(int(start + rng.randint(0, 365 * 86400)), unit='s')
+        zone = zones[rng.randint(len(zones))]
+        cavity = int(rng.randint(0, 9))
+        line = label_line(zone, cavity, faults[rng.randint(len(faults))], when)
+        lines.append(line)
+        r = rng.random_sample()
+        if r < 0.05:
+            lines.append(line)
+        elif r < 0.06:
+            lines.append(label_line(zone, (cavity + 1) % 9, faults[0], when))
+    order = rng.permutation(len(lines))
+    for i in range(n_files):
+        with open(os.path.join(raw_dir, "labels_{}.tsv".format(i)), 'w') as fh:
+            fh.write(label_header)
+            for j in order[i::n_files]:
+                fh.write(lines[j] + "\n")
+
+
+# Build a synthetic tree under root with n_events events
+def generate(root, n_events, n_samples, step, n_labels, n_label_files, seed):
+    rng = np.random.RandomState(seed)
+    paths = tree_paths(root)
+    for name in ('data_dir', 'label_dir'):
+        os.makedirs(paths[name], exist_ok=True)
+    time_axis = (np.arange(n_samples) - n_samples // 2) * step
+
+    zones = sorted(extract.zone_dict)
+    start = pd.Timestamp('2020-01-01')
+    for n in range(n_events):
+        # Events are a few minutes apart so every one has its own timestamp
+        when = start + pd.Timedelta(seconds=int(n * 600 + rng.randint(0, 300)))
+        write_event(rng, paths, zones[n % len(zones)], when, n % 10, int(rng.randint(1, 9)),
+                    faults[rng.randint(len(faults))], time_axis)
+
+    write_raw_labels(rng, os.path.join(paths['process_dir'], 'raw'), n_labels, n_label_files)
+    os.makedirs(os.path.join(paths['process_dir'], 'processed'), exist_ok=True)
+    with open(os.path.join(root, 'benchmark.json'), 'w') as fh:
+        json.dump({'events': n_events, 'samples': n_samples, 'step': step, 'labels': n_labels, 'seed': seed}, fh)
+
+
+# The extract module settings that point it at a synthetic tree, with outputs going to out_dir
+def tree_settings(root, out_dir, engine, output_backend='csv'):
+    paths = tree_paths(root)
+    os.makedirs(os.path.join(out_dir, 'manifest'), exist_ok=True)
+    return {'data_dir': paths['data_dir'],
+            'label_dir': paths['label_dir'],
+            'out_dir': out_dir,
+            'manifest_dir': os.path.join(out_dir, 'manifest'),
+            'store_dir': os.path.join(out_dir, 'store'),
+            'use_cache': False,
+            'use_index': False,
+            'output_backend': output_backend,
+            'feature_subset': None,
+            'tsf_jobs': 1,
+            'default_engine': engine}
+
+
+# Time the extraction of label_files as per-event jobs on n_workers processes.  settings are the extract module
+# settings of the jobs (see tree_settings), which run.py sets in each worker.  Returns the wall time and the summary
+# of the jobs' profiles.
+def time_extraction(label_files, extract_type, n_workers, settings, work_dir):
+    profile_file = os.path.join(work_dir, 'profile.jsonl')
+    job_log = os.path.join(work_dir, 'jobs.log')
+    state = run_state.create(os.path.join(work_dir, 'state.jsonl'), [], extract_type, job_log=job_log,
+                             profile_file=profile_file)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        failed = run.run_jobs(label_files, extract_type, n_workers, settings, 0, 0, work_dir, job_log, state,
+                              profile_file=profile_file)
+    wall = time.perf_counter() - start
+    state.close()
+    if len(failed) > 0:
+        raise RuntimeError("{} {} jobs failed, see {}".format(len(failed), extract_type, work_dir))
+    return wall, profile_summary(profile_file)
+
+
+# Stage times, calculator time and the largest peak RSS of the jobs in a profile file
+def profile_summary(profile_file):
+    records = list(profiling.read_records([profile_file]))
+    n_records, n_events, stages, calculators, jobs = profiling.aggregate(records)
+    return {'stages_s': {name: round(values[1], 6) for name, values in sorted(stages.items())},
+            'calculators_s': round(sum(values[1] for values in calculators.values()), 6),
+            'peak_rss_mb': round(max([r['peak_rss_mb'] for r in records] + [0.0]), 3)}
+
+
+# Time process.py on the raw labels of the tree with n_workers parsing processes.  Peak RSS is not reported since the
+# child's high water mark includes the memory of this process from before the exec.
+def time_process(root, n_workers, table):
+    process_dir = tree_paths(root)['process_dir']
+    processed_dir = os.path.join(process_dir, 'processed')
+    shutil.rmtree(processed_dir, ignore_errors=True)
+    os.makedirs(processed_dir)
+    command = [sys.executable, os.path.join(python_dir, 'process.py'), process_dir, '--jobs', str(n_workers)]
+    if table:
+        command.append('--table')
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        if subprocess.call(command, stdout=devnull, stderr=subprocess.STDOUT) != 0:
+            raise RuntimeError("'{}' failed".format(" ".join(command)))
+    return time.perf_counter() - start, {}
+
+
+# Time writing the features of already extracted events.  settings say where and how to write them (see
+# tree_settings).
+def time_write(label_files, csv_dir, settings):
+    for name, value in settings.items():
+        setattr(extract, name, value)
+    results = []
+    for label_file in label_files:
+        event = extract.read_label_file(label_file)
+        event.event_dir = extract.find_event_dir(event)
+        name = '{}_{}_{}'.format('cavity', event.zone, event.timestamp)
+        X = pd.read_csv(os.path.join(csv_dir, name + '_X.csv'))
+        y = pd.read_csv(os.path.join(csv_dir, name + '_y.csv'))
+        results.append((event, X, y))
+
+    start = time.perf_counter()
+    extract.write_results('cavity', results)
+    return time.perf_counter() - start, {}
+
+
+# The version of the code being benchmarked
+def code_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=app_dir,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+# Describe the environment a result was measured in
+def environment(version):
+    return {'version': version,
+            'host': socket.gethostname(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'tsfresh': tsfresh.__version__}
+
+
+# Run the requested cases on the tree under root.  Results are appended to results as they are measured.
+def run_benchmarks(root, selected, event_counts, core_counts, engine, repeat, results, version):
+    with open(os.path.join(root, 'benchmark.json'), 'r') as fh:
+        tree = json.load(fh)
+    label_files = extract.expand_label_files([tree_paths(root)['label_dir']])
+    event_counts = [n for n in event_counts if n <= len(label_files)]
+    run_dir = os.path.join(tree_paths(root)['runs_dir'], time.strftime("%Y-%m-%d_%H:%M:%S"))
+    env = environment(version)
+    os.makedirs(os.path.dirname(os.path.abspath(results)), exist_ok=True)
+
+    def measure(case, n_events, n_cores, func):
+        times = []
+        details = None
+        for i in range(repeat):
+            wall, details = func(i)
+            times.append(wall)
+        record = dict(env)
+        record.update({'case': case, 'engine': engine if case in extraction_cases else None,
+                       'events': n_events, 'cores': n_cores, 'samples': tree['samples'], 'labels': tree['labels'],
+                       'wall_s': round(min(times), 6), 'times_s': [round(t, 6) for t in times],
+                       'events_per_s': round(n_events / min(times), 6) if n_events else None,
+                       'written': time.strftime("%Y-%m-%d %H:%M:%S")})
+        record.update(details)
+        with open(results, 'a') as fh:
+            fh.write(json.dumps(record, sort_keys=True) + "\n")
+        print("{:<14} {:>6} {:>5} {:>10.3f} {:>10} {:>10}".format(
+            case, n_events, n_cores, record['wall_s'],
+            "{:.3f}".format(record['events_per_s']) if record['events_per_s'] else '-',
+            "{:.0f}".format(record['peak_rss_mb']) if 'peak_rss_mb' in record else '-'), flush=True)
+
+    print("{:<14} {:>6} {:>5} {:>10} {:>10} {:>10}".format("case", "events", "cores", "wall_s", "events/s",
+                                                          "rss_mb"), flush=True)
+    for case in selected:
+        if case in extraction_cases:
+            for n_events in event_counts:
+                for n_cores in core_counts:
+                    def func(i, case=case, n_events=n_events, n_cores=n_cores):
+                        work_dir = os.path.join(run_dir, "{}_{}_{}_{}".format(case, n_events, n_cores, i))
+                        return time_extraction(label_files[:n_events], case, n_cores,
+                                               tree_settings(root, work_dir, engine), work_dir)
+                    measure(case, n_events, n_cores, func)
+        elif case in process_cases:
+            for n_cores in core_counts:
+                measure(case, tree['labels'], n_cores,
+                        lambda i, n_cores=n_cores, table=(case == 'process_table'): time_process(root, n_cores,
+                                                                                                   table))
+        else:
+            # Writing needs features to write, so extract the events first (not timed)
+            csv_dir = os.path.join(run_dir, 'write_input')
+            if not os.path.isdir(csv_dir):
+                time_extraction(label_files[:max(event_counts)], 'cavity', max(core_counts),
+                                tree_settings(root, csv_dir, engine), csv_dir)
+            backend = case.split('_', 1)[1]
+            for n_events in event_counts:
+                def func(i, n_events=n_events, backend=backend):
+                    work_dir = os.path.join(run_dir, "{}_{}_{}".format(case, n_events, i))
+                    return time_write(label_files[:n_events], csv_dir, tree_settings(root, work_dir, engine, backend))
+                measure(case, n_events, 1, func)
+
+
+# The key that identifies the same measurement across versions
+def result_key(record):
+    return (record['case'], record.get('engine'), record['events'], record['cores'], record['samples'],
+            record['labels'], record['host'])
+
+
+# Compare the results of two versions.  Returns the number of cases that got slower by more than threshold.
+def compare(records, base, new, threshold):
+    def latest(version):
+        by_key = {}
+        for r in records:
+            if r['version'] == version:
+                by_key[result_key(r)] = r
+        return by_key
+
+    base_results = latest(base)
+    new_results = latest(new)
+    n_slower = 0
+    fmt = "{:<14} {:<8} {:>6} {:>5} {:>10} {:>10} {:>8}  {}"
+    print("Comparing {} (base) with {} on the cases measured for both".format(base, new))
+    common = sorted(set(base_results) & set(new_results), key=lambda k: [str(v) for v in k])
+    if len(common) == 0:
+        print("No cases were measured for both versions on the same host")
+        return 0
+    print(fmt.format("case", "engine", "events", "cores", "base_s", "new_s", "change", ""))
+    for key in common:
+        b = base_results[key]['wall_s']
+        n = new_results[key]['wall_s']
+        change = (n - b) / b if b > 0 else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "SLOWER"
+            n_slower += 1
+        elif change < -threshold:
+            flag = "faster"
+        print(fmt.format(key[0], key[1] or '-', key[2], key[3], "{:.3f}".format(b), "{:.3f}".format(n),
+                         "{:+.1%}".format(change), flag))
+    return n_slower
+
+
+# Parse a comma separated list of counts
+def count_list(value):
+    return [int(v) for v in value.split(',') if v != '']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark extraction on synthetic capture data.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    generate_parser = subparsers.add_parser('generate', help="build a synthetic waveform and label tree")
+    generate_parser.add_argument('root', help="directory to build the tree in")
+    generate_parser.add_argument('--events', type=int, default=32, help="number of events (default: %(default)s)")
+    generate_parser.add_argument('--samples', type=int, default=8192,
+                                 help="samples per capture file (default: %(default)s)")
+    generate_parser.add_argument('--step', type=float, default=0.2,
+                                 help="ms between samples (default: %(default)s)")
+    generate_parser.add_argument('--labels', type=int, default=100000,
+                                 help="number of raw label lines for process.py (default: %(default)s)")
+    generate_parser.add_argument('--label-files', type=int, default=20,
+                                 help="number of raw label files (default: %(default)s)")
+    generate_parser.add_argument('--seed', type=int, default=0, help="random seed (default: %(default)s)")
+
+    run_parser = subparsers.add_parser('run', help="time the cases and store the results")
+    run_parser.add_argument('root', help="a tree built by generate")
+    run_parser.add_argument('--cases', default='cavity,trip,process,process_table,write_csv,write_store',
+                            help="comma separated cases to run, from {} (default: %(default)s)".format(
+                                ",".join(cases)))
+    run_parser.add_argument('--events', type=count_list, default=[1, 8, 32],
+                            help="comma separated event counts (default: 1,8,32)")
+    run_parser.add_argument('--cores', type=count_list, default=sorted({1, os.cpu_count()}),
+                            help="comma separated worker counts (default: 1 and the number of cores)")
+    run_parser.add_argument('--engine', choices=sorted(extract.feature_engines), default=extract.default_engine,
+                            help="feature calculation engine (default: %(default)s)")
+    run_parser.add_argument('--repeat', type=int, default=1,
+                            help="number of runs of each case, the best is stored (default: %(default)s)")
+    run_parser.add_argument('--results', default=results_file, help="results file (default: %(default)s)")
+    run_parser.add_argument('--version', default=None,
+                            help="name of the version being measured (default: git describe)")
+
+    compare_parser = subparsers.add_parser('compare', help="compare the results of two versions")
+    compare_parser.add_argument('versions', nargs='*', metavar='version',
+                                help="base and new version (default: the last two versions in the results)")
+    compare_parser.add_argument('--results', default=results_file, help="results file (default: %(default)s)")
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help="relative slowdown that counts as a regression (default: %(default)s)")
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.root, args.events, args.samples, args.step, args.labels, args.label_files, args.seed)
+        print("Generated {} events and {} raw labels in {}".format(args.events, args.labels, args.root))
+    elif args.command == 'run':
+        selected = [c for c in args.cases.split(',') if c != '']
+        for case in selected:
+            if case not in cases:
+                print("Error: unknown case '{}'.  Valid cases are {}".format(case, cases))
+                exit(1)
+        if not os.path.isfile(os.path.join(args.root, 'benchmark.json')):
+            print("Error: no generated tree found in '{}'".format(args.root))
+            exit(1)
+        version = args.version if args.version is not None else code_version()
+        run_benchmarks(args.root, selected, args.events, args.cores, args.engine, args.repeat, args.results,
+                       version)
+        print("Results for {} appended to {}".format(version, args.results))
+    elif args.command == 'compare':
+        if not os.path.isfile(args.results):
+            print("Error: results file not found '{}'".format(args.results))
+            exit(1)
+        with open(args.results, 'r') as fh:
+            records = [json.loads(line) for line in fh if line.strip()]
+        versions = args.versions
+        if len(versions) == 0:
+            seen = []
+            for r in records:
+                if r['version'] in seen:
+                    seen.remove(r['version'])
+                seen.append(r['version'])
+            versions = seen[-2:]
+        if len(versions) != 2:
+            print("Error: need two versions to compare")
+            exit(1)
+        if compare(records, versions[0], versions[1], args.threshold) > 0:
+            exit(1)
+    else:
+        parser.print_usage()
+        exit(1)
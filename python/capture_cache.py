@@ -0,0 +1,148 @@
+import os
+import json
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+# This module keeps a binary copy of every parsed capture file so the text files only have to be parsed once.  The
+# cache mirrors the waveform-data/rf tree, with each <capture_file> stored as
+#   <cache_dir>/<zone>/<date>/<time>/<capture_file>.npy   - the data as a 2-D array (samples x columns)
+#   <cache_dir>/<zone>/<date>/<time>/<capture_file>.json  - column names, dtype and the size/mtime of the source file
+# An entry is only used if the size and mtime of the source file still match.  The .npy files are memory-mapped when
+# read.
+
+# Where this script currently lives
+python_dir = os.path.dirname(os.path.realpath(__file__))
+
+# The root of the rfw_tsf_extractor app
+app_dir = os.path.realpath(os.path.join(python_dir, '..'))
+
+# Default locations within the app
+data_dir = os.path.join(app_dir, 'waveform-data', 'rf')
+cache_dir = os.path.join(app_dir, 'waveform-data', 'cache')
+
+# float64 gives results identical to parsing the text files.  float32 halves the size of the cache, but the features
+# will differ slightly from those calculated on the text files.
+valid_dtypes = ('float64', 'float32')
+
+
+# Path of the cache entry for a capture file (without the .npy/.json extension), or None if the file is not under
+# data_dir
+def entry_path(capture_file, data_dir=data_dir, cache_dir=cache_dir):
+    rel_path = os.path.relpath(os.path.realpath(capture_file), os.path.realpath(data_dir))
+    if rel_path.startswith(os.pardir):
+        return None
+    return os.path.join(cache_dir, rel_path)
+
+
+# Return the cached DataFrame for a capture file, or None if there is no valid cache entry
+def load(capture_file, data_dir=data_dir, cache_dir=cache_dir):
+    path = entry_path(capture_file, data_dir, cache_dir)
+    if path is None:
+        return None
+    try:
+        with open(path + '.json', 'r') as fh:
+            meta = json.load(fh)
+        stat = os.stat(capture_file)
+        if meta['size'] != stat.st_size or meta['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        values = np.load(path + '.npy', mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if values.ndim != 2 or values.shape[1] != len(meta['columns']):
+        return None
+    return pd.DataFrame(values, columns=meta['columns'])
+
+
+# Write a cache entry for a capture file.  Both files are written under temporary names and renamed into place, data
+# first, so concurrent readers only ever see complete entries.
+def store(capture_file, df, data_dir=data_dir, cache_dir=cache_dir, dtype='float64'):
+    path = entry_path(capture_file, data_dir, cache_dir)
+    if path is None:
+        return
+    stat = os.stat(capture_file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'wb') as fh:
+        np.save(fh, np.ascontiguousarray(df.values, dtype=dtype))
+    os.replace(tmp, path + '.npy')
+
+    meta = {'columns': [str(c) for c in df.columns], 'dtype': dtype, 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+    with open(tmp, 'w') as fh:
+        json.dump(meta, fh)
+    os.replace(tmp, path + '.json')
+
+
+# Read a capture file, using the cache if it has a valid entry.  On a miss the text file is parsed and, if update is
+# True, a cache entry is written for next time.
+def read_capture_file(capture_file, data_dir=data_dir, cache_dir=cache_dir, update=True, dtype='float64'):
+    df = load(capture_file, data_dir, cache_dir)
+    if df is not None:
+        return df
+
+    df = pd.read_table(capture_file, sep='\t')
+    if update:
+        try:
+            store(capture_file, df, data_dir, cache_dir, dtype)
+        except OSError as ex:
+            print("Warning: could not cache {}: {}".format(capture_file, ex))
+    return df
+
+
+# Make sure a single capture file has a valid cache entry.  Returns 'cached', 'converted' or an error message.
+def convert(args):
+    capture_file, data_dir, cache_dir, dtype = args
+    try:
+        if load(capture_file, data_dir, cache_dir) is not None:
+            return 'cached'
+        store(capture_file, pd.read_table(capture_file, sep='\t'), data_dir, cache_dir, dtype)
+    except Exception as ex:
+        return "{}: {}".format(type(ex).__name__, ex)
+    return 'converted'
+
+
+# Find every capture file under the data directory (optionally just under the given zones)
+def find_capture_files(data_dir=data_dir, zones=None):
+    top_dirs = [os.path.join(data_dir, z) for z in zones] if zones else [data_dir]
+    capture_files = []
+    for top_dir in top_dirs:
+        for root, dirs, files in os.walk(top_dir):
+            dirs.sort()
+            capture_files.extend(os.path.join(root, f) for f in sorted(files))
+    return capture_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert capture files under waveform-data/rf into the binary "
+                                                 "cache used by extract.py --cache.  Files that already have a valid "
+                                                 "cache entry are skipped.")
+    parser.add_argument('zones', nargs='*', help="only convert these zones (default: all)")
+    parser.add_argument('--data-dir', default=data_dir, help="waveform data directory (default: %(default)s)")
+    parser.add_argument('--cache-dir', default=cache_dir, help="cache directory (default: %(default)s)")
+    parser.add_argument('--dtype', choices=valid_dtypes, default='float64',
+                        help="storage type of the cached data (default: %(default)s)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help="number of files to convert in parallel (default: %(default)s)")
+    args = parser.parse_args()
+
+    capture_files = find_capture_files(args.data_dir, args.zones)
+    jobs = [(f, args.data_dir, args.cache_dir, args.dtype) for f in capture_files]
+
+    counts = {'cached': 0, 'converted': 0, 'failed': 0}
+    with multiprocessing.Pool(args.jobs) as pool:
+        for job, result in zip(jobs, pool.imap(convert, jobs, chunksize=8)):
+            if result in counts:
+                counts[result] += 1
+            else:
+                counts['failed'] += 1
+                print("Error: could not convert {}: {}".format(job[0], result))
+
+    print("Converted {} of {} capture files ({} already cached, {} failed)".format(
+        counts['converted'], len(capture_files), counts['cached'], counts['failed']))
+    if counts['failed'] > 0:
+        exit(1)
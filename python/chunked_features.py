@@ -0,0 +1,171 @@
+import gc
+
+import numpy as np
+import pandas as pd
+import psutil
+
+import tsfresh
+
+import fast_features
+
+# This module calculates features within a memory budget (extract.py --mem-budget).  Handing tsfresh a wide DataFrame
+# costs a float64 copy of it, and tsfresh then melts every signal into one long DataFrame (id, time, kind and value
+# for every sample of every signal) and sorts it, so the peak is several times the size of the waveforms.  Here the
+# waveforms stay in the caller's float32 wide frame, and are converted to long format a few signals at a time (and,
+# if a single signal of all events is too big, a few events at a time).  Each chunk is handed to tsfresh on its own,
+# so the peak is the size of one chunk instead of all of them.
+#
+# The chunks are sized so that the resident size of the process stays under the budget, using an estimate of the
+# bytes needed per sample of a chunk.  On Linux the peak of each chunk is measured (by resetting the high water mark
+# through /proc/self/clear_refs) and the estimate is corrected from it, so chunks shrink if tsfresh needs more than
+# expected.  If even a single signal of a single event does not fit, BudgetExceeded is raised rather than letting
+# the job push the host into swap.
+#
+# The 'fast' engine gets each chunk as a wide float64 frame since it works on wide arrays.  Either way the output has
+# the same columns as the unchunked calculation, but not necessarily in the same order (see extract.order_features).
+
+# Starting estimate of the bytes of memory needed per sample of a chunk: the long format is 32 bytes per sample (id,
+# time, kind and value) and tsfresh makes a sorted copy plus per-series copies while calculating
+default_bytes_per_sample = 96
+
+# The high water mark of the resident size can be reset by writing this to /proc/self/clear_refs (Linux 4.0+)
+_clear_refs = '/proc/self/clear_refs'
+
+
+# Raised when the budget is too small for even the smallest chunk
+class BudgetExceeded(Exception):
+    pass
+
+
+# Resident size of this process in bytes
+def current_rss():
+    return psutil.Process().memory_info().rss
+
+
+# Reset the peak resident size of this process.  Returns False if that isn't possible here.
+def reset_peak_rss():
+    try:
+        with open(_clear_refs, 'w') as fh:
+            fh.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# Peak resident size of this process in bytes since the last reset (VmHWM), or None if it isn't available
+def peak_rss():
+    try:
+        with open('/proc/self/status', 'r') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# Build the long format DataFrame of some signals of some events.  values is the float32 (rows, kinds) array of the
+# signals, rows is the slice of rows of the events and columns the indexes of the signals.
+def long_chunk(ids, times, values, rows, columns, kinds, column_id, column_sort):
+    n = rows.stop - rows.start
+    return pd.DataFrame({column_id: np.tile(ids[rows], len(columns)),
+                         column_sort: np.tile(times[rows], len(columns)),
+                         'kind': np.repeat(np.array([str(kinds[c]) for c in columns], dtype=object), n),
+                         'value': values[rows][:, columns].T.ravel().astype('float64')})
+
+
+# Calculate the features of one chunk with the given engine
+def extract_chunk(ids, times, values, rows, columns, kinds, column_id, column_sort, default_fc_parameters,
+                  kind_to_fc_parameters, n_jobs, engine):
+    if engine == 'fast':
+        chunk = pd.DataFrame(values[rows][:, columns].astype('float64'), columns=[kinds[c] for c in columns])
+        chunk.insert(0, column_sort, times[rows])
+        chunk.insert(0, column_id, ids[rows])
+        return fast_features.extract_features(chunk, column_id=column_id, column_sort=column_sort,
+                                              default_fc_parameters=default_fc_parameters,
+                                              kind_to_fc_parameters=kind_to_fc_parameters,
+                                              disable_progressbar=True, n_jobs=n_jobs)
+
+    chunk = long_chunk(ids, times, values, rows, columns, kinds, column_id, column_sort)
+    return tsfresh.extract_features(chunk, column_id=column_id, column_sort=column_sort, column_kind='kind',
+                                    column_value='value', default_fc_parameters=default_fc_parameters,
+                                    kind_to_fc_parameters=kind_to_fc_parameters, disable_progressbar=True,
+                                    n_jobs=n_jobs)
+
+
+# Same interface as tsfresh.extract_features for the arguments extract.py uses, plus the engine to use ('tsfresh' or
+# 'fast') and the budget in bytes.  The signals of timeseries_container should already be float32.  tsfresh must run
+# in this process for its memory to count against the budget, so n_jobs 1 runs it here (as n_jobs 0).
+def extract_features(timeseries_container, column_id, column_sort, default_fc_parameters, kind_to_fc_parameters=None,
+                     n_jobs=1, disable_progressbar=True, engine='tsfresh', budget=None):
+    df = timeseries_container
+    kinds = [c for c in df.columns if c not in (column_id, column_sort)]
+    ids = df[column_id].values.astype('float64')
+    times = df[column_sort].values.astype('float64')
+    values = np.asarray(df[kinds].values, dtype='float32')
+    if n_jobs == 1:
+        n_jobs = 0
+
+    # Row ranges of each event, so chunks of events are contiguous slices
+    boundaries = np.flatnonzero(np.diff(ids)) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(ids)]])
+    if len(np.unique(ids)) != len(starts):
+        # Rows of an event are not together, so put them together (the order within an event doesn't matter since
+        # tsfresh sorts by time)
+        order = np.argsort(ids, kind='mergesort')
+        ids, times, values = ids[order], times[order], values[order]
+        boundaries = np.flatnonzero(np.diff(ids)) + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(ids)]])
+
+    bytes_per_sample = default_bytes_per_sample
+    can_measure = reset_peak_rss() and peak_rss() is not None
+    frames = []
+    event = 0
+    while event < len(starts):
+        room = budget - current_rss() if budget is not None else None
+
+        # As many whole events as fit with a single signal, then as many signals as fit with those events
+        n_events = len(starts) - event
+        if room is not None:
+            while n_events > 0 and (ends[event + n_events - 1] - starts[event]) * bytes_per_sample > room:
+                n_events = n_events // 2 if n_events > 1 else 0
+            if n_events == 0:
+                raise BudgetExceeded("a memory budget of {:.0f} MB is too small: {:.0f} MB is in use and one signal "
+                                     "of one event needs about {:.1f} MB".format(
+                                         budget / 2**20, (budget - room) / 2**20,
+                                         (ends[event] - starts[event]) * bytes_per_sample / 2**20))
+        rows = slice(starts[event], ends[event + n_events - 1])
+        n_rows = rows.stop - rows.start
+
+        group_frames = []
+        kind = 0
+        while kind < len(kinds):
+            room = budget - current_rss() if budget is not None else None
+            n_kinds = len(kinds) - kind
+            if room is not None:
+                n_kinds = max(1, min(n_kinds, int(room // (n_rows * bytes_per_sample))))
+            columns = list(range(kind, kind + n_kinds))
+
+            before = current_rss()
+            if can_measure:
+                reset_peak_rss()
+            group_frames.append(extract_chunk(ids, times, values, rows, columns, kinds, column_id, column_sort,
+                                              default_fc_parameters, kind_to_fc_parameters, n_jobs, engine))
+            if can_measure:
+                # Learn the real cost per sample from the peak of this chunk, so the next chunks fit
+                measured = (peak_rss() - before) / float(n_rows * n_kinds)
+                bytes_per_sample = max(32, measured, bytes_per_sample * 0.5)
+                if budget is not None and peak_rss() > budget:
+                    print("Warning: peak RSS of {:.0f} MB went over the memory budget of {:.0f} MB, using smaller "
+                          "chunks".format(peak_rss() / 2**20, budget / 2**20))
+            kind += n_kinds
+            gc.collect()
+
+        frames.append(pd.concat(group_frames, axis=1) if len(group_frames) > 1 else group_frames[0])
+        event += n_events
+
+    X = pd.concat(frames, axis=0) if len(frames) > 1 else frames[0]
+    X.index.name = column_id
+    return X
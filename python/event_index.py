@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import argparse
+
+# This module keeps an index of the waveform tree so that extraction jobs can find an event's directory and capture
+# files without globbing and listing directories on (usually NFS-mounted) waveform-data/rf.  There is one small JSON
+# file per zone:
+#   <index_dir>/<zone>.json  - {'dates': {<date>: {'mtime_ns': ..., 'events': {<event dir>: {'mtime_ns': ...,
+#                                                                                             'files': [...]}}}}}
+# where <event dir> is the directory name with its fractional second (e.g., 040659.4) and files lists the
+# [name, size, mtime_ns] of every capture file in directory listing order.  The capture file names start with the
+# EPICS cavity name (e.g., R1M4), which maps the files to cavities.
+#
+# Refreshing the index only lists the date directories whose mtime changed (new or removed events) and the event
+# directories whose mtime changed (new or removed capture files), so it is cheap to run before every extraction.
+
+# Where this script currently lives
+python_dir = os.path.dirname(os.path.realpath(__file__))
+
+# The root of the rfw_tsf_extractor app
+app_dir = os.path.realpath(os.path.join(python_dir, '..'))
+
+# Default locations within the app
+data_dir = os.path.join(app_dir, 'waveform-data', 'rf')
+index_dir = os.path.join(app_dir, 'waveform-data', 'index')
+
+# Zone indexes loaded so far, by (index_dir, zone)
+_zones = {}
+
+
+# Path of the index file of a zone
+def zone_file(zone, index_dir=index_dir):
+    return os.path.join(index_dir, zone + '.json')
+
+
+# The [name, size, mtime_ns] of every file in an event directory, in listing order
+def list_capture_files(event_dir):
+    files = []
+    for f in os.listdir(event_dir):
+        stat = os.stat(os.path.join(event_dir, f))
+        files.append([f, stat.st_size, stat.st_mtime_ns])
+    return files
+
+
+# Bring the index of one zone up to date.  old is the previous index of the zone (or None).  Returns the new index and
+# the number of directories that had to be listed.
+def scan_zone(zone_dir, old=None):
+    old_dates = old['dates'] if old is not None else {}
+    dates = {}
+    n_listed = 0
+    for date in sorted(os.listdir(zone_dir)):
+        date_dir = os.path.join(zone_dir, date)
+        if not os.path.isdir(date_dir):
+            continue
+        mtime_ns = os.stat(date_dir).st_mtime_ns
+        old_events = old_dates.get(date, {}).get('events', {})
+        if old_dates.get(date, {}).get('mtime_ns') == mtime_ns:
+            names = list(old_events)
+        else:
+            names = sorted(n for n in os.listdir(date_dir) if os.path.isdir(os.path.join(date_dir, n)))
+            n_listed += 1
+
+        events = {}
+        for name in names:
+            event_dir = os.path.join(date_dir, name)
+            try:
+                event_mtime_ns = os.stat(event_dir).st_mtime_ns
+                if old_events.get(name, {}).get('mtime_ns') == event_mtime_ns:
+                    events[name] = old_events[name]
+                else:
+                    events[name] = {'mtime_ns': event_mtime_ns, 'files': list_capture_files(event_dir)}
+                    n_listed += 1
+            except OSError:
+                # Removed since the date directory was listed
+                continue
+        dates[date] = {'mtime_ns': mtime_ns, 'events': events}
+    return {'dates': dates}, n_listed
+
+
+# Write the index of a zone.  The file is written under a temporary name and renamed so readers never see a partial
+# index.
+def write_zone(zone, index, index_dir=index_dir):
+    os.makedirs(index_dir, exist_ok=True)
+    path = zone_file(zone, index_dir)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as fh:
+        json.dump(index, fh, separators=(',', ':'))
+    os.replace(tmp, path)
+    _zones.pop((index_dir, zone), None)
+
+
+# Return the index of a zone, or None if it has not been indexed.  Indexes are read once per process.
+def load_zone(zone, index_dir=index_dir):
+    key = (index_dir, zone)
+    if key not in _zones:
+        try:
+            with open(zone_file(zone, index_dir), 'r') as fh:
+                index = json.load(fh)
+        except (OSError, ValueError):
+            index = None
+        if index is not None:
+            # Map times of day to the event directories starting with them for quick lookups
+            for date in index['dates'].values():
+                by_time = {}
+                for name in date['events']:
+                    by_time.setdefault(name.split('.')[0], []).append(name)
+                date['by_time'] = by_time
+        _zones[key] = index
+    return _zones[key]
+
+
+# Update the index of the given zones (all of them by default), or build it from scratch with rebuild.  Returns the
+# number of events indexed and the number of directories listed.
+def refresh(zones=None, rebuild=False, data_dir=data_dir, index_dir=index_dir):
+    if zones is None:
+        zones = sorted(z for z in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, z)))
+    n_events = 0
+    n_listed = 0
+    for zone in zones:
+        old = None if rebuild else load_zone(zone, index_dir)
+        index, listed = scan_zone(os.path.join(data_dir, zone), old)
+        if old is None or listed > 0 or set(index['dates']) != set(old['dates']):
+            write_zone(zone, index, index_dir)
+        n_events += sum(len(date['events']) for date in index['dates'].values())
+        n_listed += listed
+    return n_events, n_listed
+
+
+# Find the event directories matching an event's zone, date and time of day (the same directories as the glob
+# <zone>/<date>/<time>.?).  Returns None if the zone has not been indexed.
+def find_event_dirs(zone, date, time_of_day, data_dir=data_dir, index_dir=index_dir):
+    index = load_zone(zone, index_dir)
+    if index is None:
+        return None
+    names = index['dates'].get(date, {}).get('by_time', {}).get(time_of_day, [])
+    return [os.path.join(data_dir, zone, date, n) for n in names if len(n) == len(time_of_day) + 2]
+
+
+# Return the indexed [name, size, mtime_ns] of the capture files in an event directory, or None if it is not indexed
+def capture_files(event_dir, data_dir=data_dir, index_dir=index_dir):
+    rel_path = os.path.relpath(event_dir, data_dir).split(os.sep)
+    if len(rel_path) != 3:
+        return None
+    zone, date, name = rel_path
+    index = load_zone(zone, index_dir)
+    if index is None:
+        return None
+    event = index['dates'].get(date, {}).get('events', {}).get(name)
+    return event['files'] if event is not None else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the index of the waveform tree used by extract.py --index.")
+    subparsers = parser.add_subparsers(dest='command')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--data-dir', default=data_dir, help="waveform tree to index (default: %(default)s)")
+    common.add_argument('--index-dir', default=index_dir, help="location of the index (default: %(default)s)")
+
+    refresh_parser = subparsers.add_parser('refresh', parents=[common],
+                                           help="bring the index up to date with the waveform tree")
+    refresh_parser.add_argument('zones', nargs='*', help="only refresh these zones (default: all)")
+    refresh_parser.add_argument('--rebuild', action='store_true', help="rescan everything, ignoring the old index")
+
+    check_parser = subparsers.add_parser('check', parents=[common],
+                                         help="report label files with missing or ambiguous event directories")
+    check_parser.add_argument('label_files', nargs='+', metavar='label_file',
+                              help="processed label file(s) or directories of label files")
+
+    args = parser.parse_args()
+
+    if args.command == 'refresh':
+        n_events, n_listed = refresh(args.zones if len(args.zones) > 0 else None, args.rebuild, args.data_dir,
+                                     args.index_dir)
+        print("Indexed {} events ({} directories listed)".format(n_events, n_listed))
+    elif args.command == 'check':
+        # extract imports this module, so only pull it in when checking labels
+        import extract
+
+        counts = {'ok': 0, 'missing': 0, 'ambiguous': 0, 'error': 0}
+        for label_file in extract.expand_label_files(args.label_files):
+            try:
+                event = extract.read_label_file(label_file)
+            except (extract.ExtractionError, OSError, KeyError, ValueError) as ex:
+                print("error\t{}\t{}".format(label_file, ex))
+                counts['error'] += 1
+                continue
+            event_dirs = find_event_dirs(event.zone, event.date, event.time, args.data_dir, args.index_dir)
+            if event_dirs is None or len(event_dirs) == 0:
+                print("missing\t{}\t{}".format(label_file, os.path.join(event.zone, event.date, event.time + ".?")))
+                counts['missing'] += 1
+            elif len(event_dirs) > 1:
+                print("ambiguous\t{}\t{}".format(label_file, " ".join(event_dirs)))
+                counts['ambiguous'] += 1
+            else:
+                counts['ok'] += 1
+
+        print("", file=sys.stderr)
+        for status in sorted(counts):
+            print("{}: {}".format(status, counts[status]), file=sys.stderr)
+        if counts['missing'] + counts['ambiguous'] + counts['error'] > 0:
+            exit(1)
+    else:
+        parser.print_usage()
+        exit(1)
@@ -1,13 +1,31 @@
 import pandas as pd
 import numpy as np
+import io
 import os
-import sys
+import copy
 import glob
+import argparse
+import itertools
+import traceback
 
-from tsfresh import extract_features, extract_relevant_features, select_features
-from tsfresh.feature_extraction import ComprehensiveFCParameters, EfficientFCParameters, MinimalFCParameters
+import tsfresh
+from tsfresh import extract_features
+from tsfresh.feature_extraction import ComprehensiveFCParameters
 from tsfresh.utilities.dataframe_functions import impute
 
+import fast_features
+import chunked_features
+import capture_cache
+import feature_cache
+import event_index
+import label_table
+import manifest
+import profiling
+import feature_store
+import feature_selection
+import windowing
+import prefetch
+
 # Where this script currently lives
 python_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -17,234 +35,902 @@ app_dir = os.path.realpath(os.path.join(python_dir, '..'))
 # Locations within the app
 data_dir = os.path.join(app_dir, 'waveform-data', 'rf')
 label_dir = os.path.join(app_dir, 'labeled-examples', 'processed')
+label_table_file = os.path.join(app_dir, 'labeled-examples', 'processed.tsv')
 out_dir = os.path.join(app_dir, 'extracted')
+manifest_dir = os.path.join(out_dir, 'manifest')
+store_dir = os.path.join(out_dir, 'store')
 
 # Essentially how many tsfesh processes to run in parallel.  1 is good if wrapping this in a 'parallel' call
 tsf_jobs = 1
 
-if __name__ == "__main__":
-    # Process simple command line arguments
-    if len(sys.argv) != 3:
-        print("Usage: {} <label_file> <(cavity|trip)>".format(sys.argv[0]))
-        exit(1)
+# Read capture files through the binary cache in waveform-data/cache (see capture_cache.py) instead of always
+# parsing the text files.  Cache misses are parsed and written to the cache for the next run.
+use_cache = False
 
-    # Label file can be relative to the processed lablel-directory or absolute.
-    # Join discards earlier elements if a later element starts with a root '/'
-    label_file = os.path.join(label_dir, sys.argv[1])
-    extract_type = sys.argv[2]
-    
-    # Validate label file
-    if not os.path.exists(label_file):
-        print("Error: label file not found: {}".format(label_file))
-        exit(1)
+# Find event directories and their capture files through the index in waveform-data/index (see event_index.py)
+# instead of globbing and listing directories.  Events that are not in the index are still looked up on disk.
+use_index = False
 
-    # Validate extraction type
-    valid_types = ('cavity', 'trip')
-    if extract_type not in valid_types:
-        print("Error: invalid extraction type specified '{}'.  Valid options are {}".format(extract_type, valid_types))
-        exit(1)
+# Where extracted features go.  'csv' writes a <type>_<zone>_<timestamp>_X.csv and _y.csv per event to extracted/,
+# 'store' appends to the columnar feature store in extracted/store (see feature_store.py).
+output_backends = ('csv', 'store')
+output_backend = 'csv'
 
-    # Read in the labeled data file
-    labeled_df = pd.read_table(label_file, sep='\t')
-    
-    # These files could contain many labeled events, but this process expects there to
-    # only one labeled event per file (with 5 columns)
-    if labeled_df.shape != (1,5):
-        print("Error: '{}' has more than one row".format(label_file))
-        exit(1)
+# Limit extraction to a subset of features, given as a tsfresh kind_to_fc_parameters mapping (see
+# feature_selection.py).  None extracts ComprehensiveFCParameters for every signal.
+feature_subset = None
+
+# Keep the resident size of each job under this many MB (see chunked_features.py).  Waveforms are stored as float32
+# and converted to long format for tsfresh a few signals at a time.  None hands the whole float64 DataFrame to the
+# feature engine at once.  The float32 features are not interchangeable with the float64 ones: some (e.g.,
+# fft_coefficient angles and lempel_ziv_complexity) differ by up to a few percent.
+memory_budget = None
+
+# Only calculate features over the samples with window[0] <= Time <= window[1] (ms around the fault at t=0), and/or
+# from every decimation-th sample after an anti-aliasing filter (see windowing.py).  None and 1 use the whole capture
+# at full resolution.  Feature names carry these settings.
+window = None
+decimation = 1
+
+# Look up calculated features in these feature cache directories, in order, before calculating them (see
+# feature_cache.py).  None calculates every feature.
+feature_cache_dirs = None
 
-    # Needed for mapping zones in the label files to capture file names on disk
-    zone_dict = {'0L04': 'R04', '1L22': 'R1M', '1L23': 'R1N', '1L24': 'R1O', '1L25': 'R1P',
-                '1L26': 'R1Q', '2L22': 'R2M', '2L23': 'R2N', '2L24': 'R2O', '2L25': 'R2P', '2L26': 'R2Q'}
+# How many events to hand to a single extract_features call when running in batch mode
+batch_chunk_size = 16
 
+# In batch mode, load up to this many upcoming events on prefetch_readers threads while features are calculated (see
+# prefetch.py).  0 loads every event when its chunk comes up.
+prefetch_depth = 0
+prefetch_readers = prefetch.default_readers
+
+# The types of extraction we know how to do
+valid_types = ('cavity', 'trip')
+
+# The types of extraction that can be requested.  'both' does the cavity and trip extractions of an event together,
+# reading its capture files once and copying the features of the signals the two share from the cavity features.
+run_types = valid_types + ('both',)
+
+# Implementations of extract_features that can be used to calculate features.  'fast' computes the calculators it
+# supports on all signals and events at once with numpy and hands the rest to tsfresh.
+feature_engines = {'tsfresh': extract_features, 'fast': fast_features.extract_features}
+default_engine = 'tsfresh'
+
+# Needed for mapping zones in the label files to capture file names on disk
+zone_dict = {'0L04': 'R04', '1L22': 'R1M', '1L23': 'R1N', '1L24': 'R1O', '1L25': 'R1P',
+             '1L26': 'R1Q', '2L22': 'R2M', '2L23': 'R2N', '2L24': 'R2O', '2L25': 'R2P', '2L26': 'R2Q'}
+
+# The signals contained in every capture file, in file order
+waveforms = ('IMES', 'QMES', 'GMES', 'PMES', 'IASK', 'QASK', 'GASK', 'PASK', 'CRFP', 'CRFPP', 'CRRP', 'CRRPP',
+             'GLDE', 'PLDE', 'DETA2', 'CFQE2', 'DFQES')
+
+# Since this cavity problem has so many waveforms (8*17) and takes a long time for tsfresh to analyze all of them,
+# we down select to only extract features for the waveforms that Tom is looking at when making his labels
+select_columns = ["Time", "id", "1_GMES", "1_GASK", "1_CRFP", "1_DETA2", "2_GMES", "2_GASK", "2_CRFP", "2_DETA2", "3_GMES",
+       "3_GASK", "3_CRFP", "3_DETA2", "4_GMES", "4_GASK", "4_CRFP", "4_DETA2", "5_GMES", "5_GASK", "5_CRFP",
+       "5_DETA2", "6_GMES", "6_GASK", "6_CRFP", "6_DETA2", "7_GMES", "7_GASK", "7_CRFP", "7_DETA2", "8_GMES",
+       "8_GASK", "8_CRFP", "8_DETA2"]
+
+
+# Raised when a single event cannot be processed.  The message is what gets reported to the user, and the cause
+# groups the failures of a run (see run_state.py).
+class ExtractionError(Exception):
+    cause = 'extraction_error'
+
+
+# Raised when a label file or label table entry is missing or can't be parsed
+class BadLabel(ExtractionError):
+    cause = 'bad_label'
+
+
+# Raised when an event's directory, or the capture file of one of its cavities, can't be found
+class MissingCaptureFile(ExtractionError):
+    cause = 'missing_capture_file'
+
+
+# Raised when a cavity has more than one capture file in an event
+class DuplicateCavity(ExtractionError):
+    cause = 'duplicate_cavity'
+
+
+# Raised when more than one event directory matches a label
+class DuplicateEvent(ExtractionError):
+    cause = 'duplicate_event'
+
+
+# Raised when the capture files of an event don't fit together
+class BadCaptureFile(ExtractionError):
+    cause = 'bad_capture_file'
+
+
+# Raised when an event does not need any extraction (e.g., trip extraction of a multi-cavity event)
+class SkipEvent(Exception):
+    pass
+
+
+# Holds the identifying information and labels parsed from a single processed label file
+class Event:
+    def __init__(self, label_file, zone, date, time, timestamp, cavity, fault):
+        self.label_file = label_file
+        self.zone = zone
+        self.date = date
+        self.time = time
+        self.timestamp = timestamp
+        self.cavity = cavity
+        self.fault = fault
+        self.event_dir = None
+
+    def __repr__(self):
+        return "Event({} {})".format(self.zone, self.timestamp)
+
+
+# Label file can be relative to the processed lablel-directory or absolute.
+# Join discards earlier elements if a later element starts with a root '/'.  Paths that only exist relative to the
+# current directory (e.g., labeled-examples/processed) are also accepted.  Entries of a label table
+# (<table>::<event key>, see label_table.py) are resolved the same way.
+def resolve_label_file(label_file):
+    entry = label_table.split_entry(label_file)
+    if entry is not None:
+        return resolve_label_file(entry[0]) + label_table.entry_separator + entry[1]
+    path = os.path.join(label_dir, label_file)
+    if not os.path.exists(path) and os.path.exists(label_file):
+        return os.path.realpath(label_file)
+    return path
+
+
+# Expand a list of label files, directories of label files and/or label tables into a sorted list of label files
+def expand_label_files(label_paths):
+    label_files = []
+    for path in label_paths:
+        path = resolve_label_file(path)
+        if label_table.is_table(path):
+            label_files.extend(label_table.entries(path))
+        elif os.path.isdir(path):
+            label_files.extend(sorted(os.path.join(path, f) for f in os.listdir(path)
+                                      if os.path.isfile(os.path.join(path, f))))
+        else:
+            label_files.append(path)
+    return label_files
+
+
+# The processed labels to run when none are given: the label table if process.py wrote one (--table), and otherwise
+# the label files in label_dir
+def default_labels():
+    return label_table_file if os.path.exists(label_table_file) else label_dir
+
+
+# Read a processed label file (or label table entry) and return the Event it describes
+@profiling.timed('read_label')
+def read_label_file(label_file):
+    entry = label_table.split_entry(label_file)
+    if entry is not None:
+        contents = label_table.read_entry(*entry) if os.path.exists(entry[0]) else None
+        if contents is None:
+            raise BadLabel("label table entry not found: {}".format(label_file))
+        label_file_or_buffer = io.StringIO(contents)
+    else:
+        # Validate label file
+        if not os.path.exists(label_file):
+            raise BadLabel("label file not found: {}".format(label_file))
+        label_file_or_buffer = label_file
+
+    try:
+        # Read in the labeled data file
+        labeled_df = pd.read_table(label_file_or_buffer, sep='\t')
+
+        # These files could contain many labeled events, but this process expects there to
+        # only one labeled event per file (with 5 columns)
+        if labeled_df.shape != (1, 5):
+            raise BadLabel("'{}' has more than one row".format(label_file))
+
+        return parse_label(label_file, zone=labeled_df.zone[0], time=labeled_df.time[0],
+                           cavity=labeled_df.cavity[0], fault=labeled_df.fault[0])
+    except (AttributeError, KeyError, ValueError) as ex:
+        raise BadLabel("can't parse label file '{}': {}".format(label_file, ex))
+
+
+# Build an Event from the fields of a single label row
+def parse_label(label_file, zone, time, cavity, fault):
     # Save the zone where the event occurred
-    zone = str(labeled_df.zone[0])
+    zone = str(zone)
 
     # Date and time are a sinlge space separated field
-    date, time = str(labeled_df.time[0]).split(" ")
+    date, time_of_day = str(time).split(" ")
 
     # Change date format to match that used on file system
     date = date.replace("/", "_")
 
-    # Change time format to match that used on file system.  The files also include a
-    # fractional second component, so add a shell glob wildcard.
-    time = time.replace(":", "")
-    time_glob = time + ".?"
+    # Change time format to match that used on file system.
+    time_of_day = time_of_day.replace(":", "")
 
     # Save a timestamp that can be used as part of an event identifier
-    timestamp = str(labeled_df.time[0]).replace(":", "").replace(" ", "_").replace("/", "-")
+    timestamp = str(time).replace(":", "").replace(" ", "_").replace("/", "-")
+
+    return Event(label_file, zone, date, time_of_day, timestamp, cavity, fault)
+
+
+# Build an Event for an event directory that has no label file (e.g., one found by watch.py).  The cavity and fault
+# labels are None.
+def event_from_dir(event_dir):
+    event_dir = os.path.realpath(event_dir)
+    date_dir, time_dir = os.path.split(event_dir)
+    zone_dir, date = os.path.split(date_dir)
+
+    # Event directories are named for the time of the fault plus a fractional second, e.g., 040659.4
+    time_of_day = time_dir.split(".")[0]
+    timestamp = "{}_{}".format(date.replace("_", "-"), time_of_day)
+
+    event = Event(None, os.path.basename(zone_dir), date, time_of_day, timestamp, cavity=None, fault=None)
+    event.event_dir = event_dir
+    return event
+
+
+# Unlabeled events don't say which cavity faulted, so trip extraction is done for each of them.  Returns one copy of
+# the event per cavity.
+def cavity_events(event):
+    events = []
+    for cavity in range(1, 9):
+        cavity_event = copy.copy(event)
+        cavity_event.cavity = cavity
+        events.append(cavity_event)
+    return events
+
+
+# Find the directory of capture files on disk that belongs to the event
+@profiling.timed('find_event')
+def find_event_dir(event):
+    # The files also include a fractional second component, so add a shell glob wildcard.
+    time_glob = event.time + ".?"
 
     # File path string that should match the event directory associated with this label
-    event_glob = os.path.join(data_dir, zone, date, time_glob)
+    event_glob = os.path.join(data_dir, event.zone, event.date, time_glob)
 
     # Actual path to event directory (it's a list since it could have multiple matches)
-    event_dir_list = glob.glob(event_glob)
+    event_dir_list = None
+    if use_index:
+        event_dir_list = event_index.find_event_dirs(event.zone, event.date, event.time, data_dir=data_dir)
+    if not event_dir_list:
+        event_dir_list = glob.glob(event_glob)
 
     # Check that we got the directory we expected.
     if len(event_dir_list) == 0:
-        print("Error: no event dirs found that match event glob '{}'".format(event_glob))
-        exit(1)
+        raise MissingCaptureFile("no event dirs found that match event glob '{}'".format(event_glob))
     if len(event_dir_list) > 1:
-        print("Error: more than one event dir matched label - '{}'".format(event_list))
-        exit(1)
+        raise DuplicateEvent("more than one event dir matched label - '{}'".format(event_dir_list))
 
     # Grab the event directory
-    event_dir = event_dir_list[0]
-
-    # Process the data to extract the features needed for cavity labeling models
+    return event_dir_list[0]
+
+
+# The [name, size, mtime_ns] of the capture files in an event directory according to the index, or None if the index
+# is not used or doesn't have the event
+def capture_listing(event_dir):
+    if not use_index:
+        return None
+    return event_index.capture_files(event_dir, data_dir=data_dir)
+
+
+# Names of the capture files in an event directory, in directory listing order
+@profiling.timed('list_files')
+def list_event_files(event_dir):
+    listing = capture_listing(event_dir)
+    if listing is not None:
+        return [f[0] for f in listing]
+    return os.listdir(event_dir)
+
+
+# Read a single tab-separated capture file, through the cache if it is enabled.  usecols selects columns by position.
+@profiling.timed('parse')
+def read_capture_file(capture_file, usecols=None):
+    if use_cache:
+        # Cache entries always hold the whole file so that every extraction type can use them
+        df = capture_cache.read_capture_file(capture_file, data_dir=data_dir)
+        return df if usecols is None else df.iloc[:, usecols]
+    return pd.read_table(capture_file, sep='\t', usecols=usecols)
+
+
+# List the capture files of an event, checking that there is exactly one for each of the eight cavities
+def cavity_capture_files(event):
+    # Get a list of the capture files associated this event
+    capture_files = list_event_files(event.event_dir)
+
+    # Check that we have all eight of the files
+    if len(capture_files) != 8:
+        error = MissingCaptureFile if len(capture_files) < 8 else DuplicateCavity
+        raise error("event {} {} has {} files, not 8".format(event.zone, event.timestamp,
+                                                                       len(capture_files)))
+
+    # Check that we do not have any duplicates
+    cav_list = []
+    cav_set = set()
+    for file in capture_files:
+        cav = file[0:4]
+        cav_list.append(cav)
+        cav_set.add(cav)
+        if len(cav_list) != len(cav_set):
+            raise DuplicateCavity("Duplicate capture files found for a cavity '{}'".format(cav))
+
+    return capture_files
+
+
+# Read the eight capture files of an event into a single wide DataFrame containing the cavity model signals.  Only the
+# Time column and the selected signals are read from each file, and they are copied straight into one preallocated
+# array laid out like select_columns.  capture_data optionally holds the already parsed capture files by name.
+@profiling.timed('assemble')
+def load_cavity_waveforms(event, event_id, capture_data=None):
+    capture_files = cavity_capture_files(event)
+
+    # Position of the Time column and each selected signal within a capture file
+    signals = [c.split("_", 1)[1] for c in select_columns[2:6]]
+    usecols = [0] + [waveforms.index(s) + 1 for s in signals]
+
+    values = None
+    time = None
+    for m in range(0, 8):
+        if capture_data is not None:
+            df = capture_data[capture_files[m]].iloc[:, usecols]
+        else:
+            df = read_capture_file(os.path.join(event.event_dir, capture_files[m]), usecols=usecols)
+
+        if values is None:
+            # The Time axis of the first capture file is used for the event, with the id column next to it
+            time = df.iloc[:, 0].values
+            values = np.empty((len(df), len(select_columns)), dtype=storage_dtype())
+            values[:, 0] = time
+            values[:, 1] = event_id
+        elif len(df) != len(time) or not np.array_equal(df.iloc[:, 0].values, time):
+            raise BadCaptureFile("Time axis of capture file '{}' does not match '{}'".format(capture_files[m],
+                                                                                           capture_files[0]))
+
+        values[:, 2 + 4 * m:6 + 4 * m] = df.iloc[:, 1:].values
+
+    return reduce_waveforms(event, pd.DataFrame(values, columns=select_columns))
+
+
+# Read the capture file of the labeled cavity into a DataFrame with generic (non cavity-specific) column names.
+# capture_data optionally holds the already parsed capture files by name.
+@profiling.timed('assemble')
+def load_trip_waveforms(event, event_id, capture_data=None):
+    # Here we use Tom's labeled cavity to filter this process.  If he said it was a 'Multi Cav Turn off' with
+    # cavity == 0, then we just skip it, since our cavity models will produce this result
+    cavity_label = str(event.cavity)
+    if cavity_label == '0':
+        raise SkipEvent("No feature extraction needed since cavity label was '{}'".format(cavity_label))
+
+    # Get a list of the capture files associated this event
+    capture_files = list_event_files(event.event_dir)
+
+    # Check that we have one capture file for the identified cavity
+    epics_cav = zone_dict[event.zone] + cavity_label
+    cav_files = [file for file in capture_files if file[0:4] == epics_cav]
+    if len(cav_files) == 0:
+        raise MissingCaptureFile("Missing capture file for cavity label {} / EPICS cavity name {}".format(
+            cavity_label, epics_cav))
+    elif len(cav_files) != 1:
+        raise DuplicateCavity("Found {} capture files for cavity label {} / EPICS cavity name {}".format(
+            len(cav_files), cavity_label, epics_cav))
+    cavity_file = os.path.join(event.event_dir, cav_files[0])
+
+    # Construct a dictionary for mapping cavity-specific waveform names to generic waveform names.  Used to
+    # rename the dataframe columns into a generic set that can be analyzed by tsfresh regardless of which cavity
+    # is the one to fault.
+    waveform_mapper = {str(epics_cav) + "WFS" + s: s for s in waveforms}
+
+    # Read in the file and assign the event's ID number for use by tsfresh
+    if capture_data is not None:
+        waveforms_df = capture_data[cav_files[0]].copy()
+    else:
+        waveforms_df = read_capture_file(cavity_file)
+    waveforms_df['id'] = pd.Series(event_id, index=waveforms_df.index)
+
+    if memory_budget is not None:
+        waveforms_df[list(waveform_mapper)] = waveforms_df[list(waveform_mapper)].astype(storage_dtype())
+
+    # Rename the columns to get rid of the cavity specific info.  Not needed since the model will generalize to all
+    # cavities.
+    return reduce_waveforms(event, waveforms_df.rename(columns=waveform_mapper))
+
+
+# Apply the window and decimation settings to the loaded waveforms of an event
+def reduce_waveforms(event, waveforms_df):
+    reduced = windowing.reduce_waveforms(waveforms_df, window, decimation)
+    if reduced is None:
+        raise ExtractionError("event {} {} has no samples in the window {:g} to {:g}".format(
+            event.zone, event.timestamp, window[0], window[1]))
+    return reduced
+
+
+# Load the waveforms needed for the given extraction type
+def load_waveforms(event, extract_type, event_id):
+    if event.event_dir is None:
+        event.event_dir = find_event_dir(event)
     if extract_type == 'cavity':
+        return load_cavity_waveforms(event, event_id)
+    return load_trip_waveforms(event, event_id)
+
+
+# Load the waveforms of an event for both extraction types, parsing each capture file only once.  Returns the cavity
+# waveforms, the trip waveforms (None if the event needs no trip extraction) and the position of the labeled cavity's
+# signals in the cavity waveforms (i.e., the n of n_GMES).
+def load_combined_waveforms(event, event_id):
+    if event.event_dir is None:
+        event.event_dir = find_event_dir(event)
+    capture_files = cavity_capture_files(event)
+    capture_data = {f: read_capture_file(os.path.join(event.event_dir, f)) for f in capture_files}
+
+    cavity_df = load_cavity_waveforms(event, event_id, capture_data)
+    try:
+        trip_df = load_trip_waveforms(event, event_id, capture_data)
+    except SkipEvent:
+        return cavity_df, None, None
+
+    epics_cav = zone_dict[event.zone] + str(event.cavity)
+    position = [f[0:4] for f in capture_files].index(epics_cav) + 1
+    return cavity_df, trip_df, position
+
+
+# Build the label DataFrame written alongside the features
+def make_label(event, extract_type):
+    label = event.cavity if extract_type == 'cavity' else event.fault
+    return pd.DataFrame({'zone': [event.zone], 'time': [event.timestamp], 'label': [label]})
+
+
+# Run tsfresh over a long DataFrame that may contain many events (one per value of 'id').  Imputation is left to the
+# caller since tsfresh's impute uses column statistics across all rows, and we want results identical to processing
+# each event on its own.
+@profiling.timed('calculate')
+def calculate_features(waveforms_df, n_jobs=tsf_jobs, engine=default_engine):
+    default_fc_parameters, kind_to_fc_parameters = extraction_parameters()
+    if kind_to_fc_parameters is not None:
+        # Signals without any selected features don't need to be handed to tsfresh at all
+        waveforms_df = waveforms_df[[c for c in waveforms_df.columns
+                                     if c in ('id', 'Time') or str(c) in kind_to_fc_parameters]]
+    if feature_cache_dirs is not None:
+        return cached_features(waveforms_df, n_jobs=n_jobs, engine=engine)
+    return compute_features(waveforms_df, default_fc_parameters, kind_to_fc_parameters, n_jobs=n_jobs, engine=engine)
+
+
+# Calculate features with the feature engine, within the memory budget if there is one
+def compute_features(waveforms_df, default_fc_parameters, kind_to_fc_parameters, n_jobs=tsf_jobs,
+                     engine=default_engine):
+    if memory_budget is not None:
+        try:
+            X = chunked_features.extract_features(waveforms_df,
+                                                  column_id="id",
+                                                  column_sort="Time",
+                                                  default_fc_parameters=default_fc_parameters,
+                                                  kind_to_fc_parameters=kind_to_fc_parameters,
+                                                  n_jobs=profiling.tsfresh_jobs(n_jobs),
+                                                  engine=engine,
+                                                  budget=memory_budget * 2**20)
+        except chunked_features.BudgetExceeded as ex:
+            raise ExtractionError(str(ex))
+        return order_features(X, [c for c in waveforms_df.columns if c not in ('id', 'Time')])
+    return feature_engines[engine](waveforms_df.astype('float64'),
+                                   column_id="id",
+                                   column_sort="Time",
+                                   default_fc_parameters=default_fc_parameters,
+                                   kind_to_fc_parameters=kind_to_fc_parameters,
+                                   disable_progressbar=True,
+                                   n_jobs=profiling.tsfresh_jobs(n_jobs)
+                                   )
+
+
+# Calculate features through the feature cache, only handing the features it doesn't have yet to the feature engine
+def cached_features(waveforms_df, n_jobs=tsf_jobs, engine=default_engine):
+    def compute(df, kind_to_fc_parameters):
+        with profiling.stage('calculate'):
+            return compute_features(df, {}, kind_to_fc_parameters, n_jobs=n_jobs, engine=engine)
+
+    with profiling.stage('feature_cache'):
+        X, n_cached, n_requested = feature_cache.extract_features(waveforms_df, "id", "Time", kind_parameters,
+                                                                   compute, "{} {}".format(tsfresh.__version__, engine),
+                                                                   feature_cache_dirs)
+    print("Found {} of {} features in the feature cache".format(n_cached, n_requested))
+    return order_features(X, [c for c in waveforms_df.columns if c not in ('id', 'Time')])
+
+
+# The dtype waveforms are stored in
+def storage_dtype():
+    return 'float32' if memory_budget is not None else 'float64'
+
+
+# The default_fc_parameters and kind_to_fc_parameters arguments for extract_features
+def extraction_parameters():
+    if feature_subset is not None:
+        return {}, feature_subset
+    return ComprehensiveFCParameters(), None
+
+
+# The feature calculators that will be run on a signal
+def kind_parameters(kind):
+    default_fc_parameters, kind_to_fc_parameters = extraction_parameters()
+    if kind_to_fc_parameters is None:
+        return default_fc_parameters
+    return kind_to_fc_parameters.get(str(kind), default_fc_parameters)
+
+
+# Put feature columns in the order tsfresh would have used for signals in the order of kinds
+def order_features(X, kinds):
+    if fast_features.probe_sorted_output():
+        return X[sorted(X.columns)]
+    by_kind = {}
+    for column in X.columns:
+        by_kind.setdefault(column.split("__")[0], []).append(column)
+    return X[[column for kind in kinds for column in by_kind.get(str(kind), [])]]
+
+
+# Calculate the cavity and trip features of events loaded with load_combined_waveforms.  trip_frames and positions
+# map event ids to their trip waveforms and labeled cavity position.  The trip features of signals that are also
+# cavity model signals are copied from the features of the labeled cavity when both use the same calculators, so only
+# the remaining trip signals are handed to tsfresh.  Returns the cavity and trip feature matrices indexed by id.
+def calculate_combined_features(cavity_frames, trip_frames, positions, n_jobs=tsf_jobs, engine=default_engine):
+    X_cavity = calculate_features(pd.concat(cavity_frames, axis=0, ignore_index=True, sort=False), n_jobs=n_jobs,
+                                  engine=engine)
+    if len(trip_frames) == 0:
+        return X_cavity, None
+
+    signals = [c.split("_", 1)[1] for c in select_columns[2:6]]
+    reused = [s for s in signals
+              if all(kind_parameters(s) == kind_parameters("{}_{}".format(p, s)) for p in positions.values())]
+
+    trip_df = pd.concat([trip_frames[event_id] for event_id in sorted(trip_frames)], axis=0, ignore_index=True,
+                        sort=False)
+    kinds = [c for c in trip_df.columns if c not in ('id', 'Time')]
+    if len(reused) < len(kinds):
+        X_trip = calculate_features(trip_df.drop(columns=reused), n_jobs=n_jobs, engine=engine)
+    else:
+        X_trip = pd.DataFrame(index=sorted(trip_frames))
+
+    copied = []
+    for event_id in sorted(trip_frames):
+        prefixes = {"{}_{}".format(positions[event_id], s): s for s in reused}
+        columns = {c: prefixes[c.split("__")[0]] + c[c.index("__"):] for c in X_cavity.columns
+                   if c.split("__")[0] in prefixes}
+        copied.append(X_cavity.loc[[event_id], list(columns)].rename(columns=columns))
+    X_trip = pd.concat([X_trip, pd.concat(copied, axis=0)], axis=1)
+    return X_cavity, order_features(X_trip, kinds)
+
+
+# Everything that affects the features calculated for an extraction type.  Recorded in the manifest so that
+# changing any of it causes events to be extracted again.
+def feature_settings(extract_type):
+    settings = {'extract_type': extract_type,
+                'tsfresh_version': tsfresh.__version__,
+                'fc_parameters': extraction_parameters(),
+                'columns': select_columns if extract_type == 'cavity' else list(waveforms)}
+    if memory_budget is not None:
+        # Features calculated from float32 waveforms differ from the float64 ones, by a few percent for some
+        settings['storage'] = storage_dtype()
+    if window is not None:
+        settings['window'] = list(window)
+    if decimation > 1:
+        settings['decimation'] = decimation
+    return settings
+
+
+# Impute a single event's features and add the ID info so we can join files together in the future
+@profiling.timed('impute')
+def finalize_features(X, event):
+    X = impute(X.copy())
+    X.columns = windowing.feature_names(X.columns, window, decimation)
+    X['zone'] = event.zone
+    X['time'] = event.timestamp
+    return X
+
+
+# Save the results and the labels of one or more events for later access, and note them in the manifest.  results is
+# a list of (event, X, y) tuples.  The feature store gets one segment per zone.
+@profiling.timed('write')
+def write_results(extract_type, results):
+    if output_backend == 'store':
+        by_zone = {}
+        for event, X, y in results:
+            by_zone.setdefault(event.zone, []).append((event, X, y))
+        for zone, items in by_zone.items():
+            X = pd.concat([X for event, X, y in items], axis=0, ignore_index=True, sort=False)
+            rows = [make_store_row(event, extract_type, y) for event, X, y in items]
+            outputs = feature_store.write_segment(extract_type, zone, X, rows, store_dir=store_dir)
+            for event, X, y in items:
+                record_extraction(event, extract_type, 'done', outputs)
+        return
+
+    for event, X, y in results:
+        X_file = os.path.join(out_dir, '{}_{}_{}_X.csv'.format(extract_type, event.zone, event.timestamp))
+        y_file = os.path.join(out_dir, '{}_{}_{}_y.csv'.format(extract_type, event.zone, event.timestamp))
+        write_csv(X, X_file)
+        write_csv(y, y_file)
+        record_extraction(event, extract_type, 'done', [X_file, y_file])
+
+
+# Write a DataFrame to a CSV file under a temporary name and rename it into place, so a job that dies while writing
+# never leaves a partial output behind
+def write_csv(df, path):
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+
+# The feature store row of an event.  Unlabeled trip events are extracted once per cavity, so their rows also say
+# which cavity they belong to.
+def make_store_row(event, extract_type, y):
+    cavity = event.cavity if extract_type == 'trip' and event.label_file is None else None
+    return feature_store.make_row(event.zone, event.timestamp, y.label[0], cavity=cavity)
+
+
+# Write the manifest record for an event whose extraction finished (status 'done') or was not needed ('skipped')
+@profiling.timed('manifest')
+def record_extraction(event, extract_type, status, outputs):
+    record = manifest.make_record(event.label_file, event.event_dir, feature_settings(extract_type), status, outputs,
+                                  listing=capture_listing(event.event_dir))
+    manifest.write_record(extract_type, event.zone, event.timestamp, record, manifest_dir=manifest_dir)
+
+
+# Extract features for a single event described by a label file.  With profiling enabled, the event gets its own
+# profile record.
+def extract_event(label_file, extract_type, n_jobs=tsf_jobs, engine=default_engine):
+    with profiling.record(extract_type=extract_type, engine=engine, n_jobs=n_jobs, label_files=[label_file],
+                          n_events=1):
+        event = read_label_file(label_file)
+        if extract_type == 'both':
+            cavity_df, trip_df, position = load_combined_waveforms(event, event_id=1)
+            trip_frames = {1: trip_df} if trip_df is not None else {}
+            extract_combined({1: event}, [cavity_df], trip_frames, {1: position}, n_jobs=n_jobs, engine=engine)
+            if trip_df is None:
+                raise SkipEvent("No trip feature extraction needed since cavity label was '{}'".format(event.cavity))
+            return event
+        try:
+            waveforms_df = load_waveforms(event, extract_type, event_id=1)
+        except SkipEvent:
+            record_extraction(event, extract_type, 'skipped', [])
+            raise
+        X = finalize_features(calculate_features(waveforms_df, n_jobs=n_jobs, engine=engine), event)
+        write_results(extract_type, [(event, X, make_label(event, extract_type))])
+        return event
+
+
+# Extract features for many events, handing chunk_size events at a time to a single extract_features call.  Each
+# event gets its own id so tsfresh can keep them apart, and the output files are the same as running every label
+# file through extract_event.  With prefetch_depth above 0, up to that many upcoming events are loaded by reader
+# threads while the features of the current chunk are calculated (see prefetch.py), and the prefetch metrics are
+# printed at the end.  tsfresh then runs in this process, since forking its worker processes while a reader thread
+# holds a lock (e.g., in malloc or the I/O stack) can leave a child deadlocked; n_jobs above 1 is rejected when parsing
+# the arguments.  Returns a dictionary of label_file -> error message for events that failed.
+def extract_batch(label_files, extract_type, chunk_size=batch_chunk_size, n_jobs=tsf_jobs, engine=default_engine):
+    # Events are numbered from 1 within each chunk
+    items = [(label_file, i % chunk_size + 1) for i, label_file in enumerate(label_files)]
+    if prefetch_depth > 0:
+        # A single tsfresh process does the same work as running in this one (n_jobs 0), without forking
+        if n_jobs == 1:
+            n_jobs = 0
+        prefetcher = prefetch.Prefetcher(lambda item: load_event(item[0], extract_type, item[1]), items,
+                                         prefetch_depth, readers=prefetch_readers)
+        loaded = iter(prefetcher)
+    else:
+        prefetcher = None
+        loaded = ((item, load_event(item[0], extract_type, item[1])) for item in items)
+
+    failures = {}
+    try:
+        for start in range(0, len(label_files), chunk_size):
+            chunk = label_files[start:start + chunk_size]
+            with profiling.record(extract_type=extract_type, engine=engine, n_jobs=n_jobs, label_files=chunk,
+                                  n_events=len(chunk)):
+                chunk_events = [(label_file, event_id, result) for (label_file, event_id), result in
+                                itertools.islice(loaded, len(chunk))]
+                failures.update(extract_chunk(chunk_events, extract_type, n_jobs=n_jobs, engine=engine))
+    finally:
+        # Shut down the reader threads now rather than whenever the generator is collected
+        loaded.close()
+
+    if prefetcher is not None:
+        prefetcher.print_metrics()
+    return failures
+
+
+# Read the label file of an event and load its waveforms for extract_chunk.  Returns (event, waveforms, error), where
+# waveforms is what load_combined_waveforms returns for extract_type 'both', and error is the exception that stopped
+# the event (event is None if that was reading its label file).  This runs on the reader threads when prefetching.
+def load_event(label_file, extract_type, event_id):
+    event = None
+    try:
+        event = read_label_file(label_file)
+        if extract_type == 'both':
+            return event, load_combined_waveforms(event, event_id), None
+        return event, load_waveforms(event, extract_type, event_id), None
+    except (SkipEvent, ExtractionError, OSError, KeyError, ValueError) as ex:
+        return event, None, ex
+
+
+# Extract the features of one chunk of events of extract_batch with a single extract_features call.  loaded holds the
+# (label_file, event_id, load_event result) of each event.  Returns a dictionary of label_file -> error message for
+# events that failed.
+def extract_chunk(loaded, extract_type, n_jobs=tsf_jobs, engine=default_engine):
+    failures = {}
+    events = {}
+    frames = []
+    trip_frames = {}
+    positions = {}
+    for label_file, event_id, (event, waveforms, error) in loaded:
+        if isinstance(error, SkipEvent):
+            record_extraction(event, extract_type, 'skipped', [])
+            print("{}: {}".format(label_file, error))
+        elif error is not None:
+            print("Error: {}: {}".format(label_file, error))
+            failures[label_file] = str(error)
+        elif extract_type == 'both':
+            cavity_df, trip_df, position = waveforms
+            frames.append(cavity_df)
+            if trip_df is not None:
+                trip_frames[event_id] = trip_df
+                positions[event_id] = position
+            events[event_id] = event
+        else:
+            frames.append(waveforms)
+            events[event_id] = event
+
+    if len(frames) == 0:
+        return failures
+
+    # A failure while calculating or writing the features of the chunk (e.g., a memory budget that is too small or a
+    # full disk) fails every event of the chunk, and the batch goes on with the next chunk
+    message = None
+    try:
+        if extract_type == 'both':
+            extract_combined(events, frames, trip_frames, positions, n_jobs=n_jobs, engine=engine)
+        else:
+            extract_loaded(events, frames, extract_type, n_jobs=n_jobs, engine=engine)
+    except ExtractionError as ex:
+        message = str(ex)
+    except Exception as ex:
+        traceback.print_exc()
+        message = "{}: {}".format(type(ex).__name__, ex)
+
+    for event in events.values():
+        if message is not None:
+            print("Error: {}: {}".format(event.label_file, message))
+            failures[event.label_file] = message
+        else:
+            print("Completed {} feature extraction for {}".format(extract_type, event.label_file))
+
+    return failures
+
+
+# Calculate and save the features of several events with a single extract_features call.  frames holds the loaded
+# waveforms of each event and events maps the ids used in frames to their Event.
+def extract_loaded(events, frames, extract_type, n_jobs=tsf_jobs, engine=default_engine):
+    with profiling.stage('assemble'):
+        waveforms_df = pd.concat(frames, axis=0, ignore_index=True, sort=False)
+    X_all = calculate_features(waveforms_df, n_jobs=n_jobs, engine=engine)
+    results = []
+    for event_id, event in events.items():
+        X = finalize_features(X_all.loc[[event_id]], event)
+        results.append((event, X, make_label(event, extract_type)))
+    write_results(extract_type, results)
+
+
+# Calculate and save the cavity and trip features of events loaded with load_combined_waveforms.  Events without
+# trip waveforms are recorded as skipped for the trip extraction.
+def extract_combined(events, cavity_frames, trip_frames, positions, n_jobs=tsf_jobs, engine=default_engine):
+    X_cavity, X_trip = calculate_combined_features(cavity_frames, trip_frames, positions, n_jobs=n_jobs,
+                                                   engine=engine)
+    for extract_type, X_all in (('cavity', X_cavity), ('trip', X_trip)):
+        results = []
+        for event_id, event in events.items():
+            if extract_type == 'trip' and event_id not in trip_frames:
+                record_extraction(event, extract_type, 'skipped', [])
+                continue
+            X = finalize_features(X_all.loc[[event_id]], event)
+            results.append((event, X, make_label(event, extract_type)))
+        if len(results) > 0:
+            write_results(extract_type, results)
 
-        # Get a list of the capture files associated this event
-        capture_files = os.listdir(event_dir)
 
-        # Check that we have all eight of the files
-        if len(capture_files) != 8:
-            print("Error: event {} {} has {} files, not 8".format(zone,
-                timestamp, len(capture_files)))
-            exit(1)
+if __name__ == "__main__":
+    # Process simple command line arguments
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [options] <label_file|label_dir> [...] <(cavity|trip)>",
+        description="Extract tsfresh features for one or more labeled RF fault events.  Passing more than one "
+                    "label file, or a directory of them, runs in batch mode where several events share a single "
+                    "tsfresh call.")
+    parser.add_argument('label_files', nargs='+', metavar='label_file',
+                        help="processed label file(s) or directories of label files")
+    parser.add_argument('extract_type', help="one of {}".format(run_types))
+    parser.add_argument('--chunk-size', type=int, default=batch_chunk_size,
+                        help="number of events per extract_features call in batch mode (default: %(default)s)")
+    parser.add_argument('--prefetch', type=int, default=prefetch_depth, metavar='DEPTH',
+                        help="in batch mode, load up to DEPTH upcoming events while features are calculated, and "
+                             "report whether the run is I/O-bound or CPU-bound.  tsfresh then runs in this process, so "
+                             "--n-jobs must be 1 (default: %(default)s, see prefetch.py)")
+    parser.add_argument('--readers', type=int, default=prefetch_readers,
+                        help="number of threads loading events for --prefetch (default: %(default)s)")
+    parser.add_argument('--n-jobs', type=int, default=tsf_jobs,
+                        help="number of tsfresh processes (default: %(default)s)")
+    parser.add_argument('--engine', choices=sorted(feature_engines), default=default_engine,
+                        help="feature calculation engine (default: %(default)s)")
+    parser.add_argument('--cache', action='store_true',
+                        help="read capture files through the binary cache in waveform-data/cache")
+    parser.add_argument('--index', action='store_true',
+                        help="find events through the index in waveform-data/index (see event_index.py)")
+    parser.add_argument('--output', choices=output_backends, default=output_backend,
+                        help="write per-event CSV files or append to the feature store (default: %(default)s)")
+    parser.add_argument('--features', metavar='SUBSET_FILE',
+                        help="only extract the features listed in this file (see feature_selection.py)")
+    parser.add_argument('--profile', metavar='PROFILE_FILE',
+                        help="append the time and memory used by each stage and feature calculator to this file "
+                             "(see profiling.py)")
+    parser.add_argument('--mem-budget', type=float, metavar='MB',
+                        help="keep the resident size under this many MB by storing waveforms as float32 and "
+                             "calculating features a few signals at a time (see chunked_features.py).  Some features "
+                             "then differ from the float64 ones by up to a few percent")
+    parser.add_argument('--window', type=float, nargs=2, metavar=('START', 'END'),
+                        help="only use the samples from START to END ms of the Time column, around the fault at t=0 "
+                             "(see windowing.py)")
+    parser.add_argument('--decimate', type=int, default=decimation, metavar='Q',
+                        help="use every Q-th sample after an anti-aliasing filter (default: %(default)s)")
+    parser.add_argument('--feature-cache', nargs='?', const=feature_cache.cache_dir, metavar='CACHE_DIR',
+                        help="only calculate the features that are not in the feature cache, and add them to it "
+                             "(default cache: {}, see feature_cache.py)".format(feature_cache.cache_dir))
+    parser.add_argument('--feature-cache-local', metavar='LOCAL_DIR',
+                        help="keep a copy of the feature cache entries used in this directory on local disk, "
+                             "in front of the shared --feature-cache")
+    parser.add_argument('--feature-cache-size', type=float, metavar='GB',
+                        help="when done, remove the least recently used feature cache entries until each cache "
+                             "directory is under this size")
+    args = parser.parse_args()
+
+    use_cache = args.cache
+    use_index = args.index
+    output_backend = args.output
+    memory_budget = args.mem_budget
+    window = args.window
+    decimation = args.decimate
+    prefetch_depth = args.prefetch
+    prefetch_readers = args.readers
+    if prefetch_depth > 0 and args.n_jobs > 1:
+        print("Error: --prefetch can't be used with --n-jobs above 1, since tsfresh would fork its worker processes "
+              "while the reader threads are running")
+        exit(1)
+    message = windowing.check_settings(window, decimation)
+    if message is not None:
+        print("Error: {}".format(message))
+        exit(1)
+    if args.features is not None:
+        feature_subset = feature_selection.read_feature_subset(args.features)
+    if args.profile is not None:
+        profiling.enable(args.profile)
+    if args.feature_cache is not None:
+        feature_cache_dirs = feature_cache.tiers(args.feature_cache, args.feature_cache_local)
 
-        # Check that we do not have any duplicates
-        cav_list = []
-        cav_set = set()
-        for file in capture_files:
-            cav = file[0:4]
-            cav_list.append(cav)
-            cav_set.add(cav)
-            if len(cav_list) != len(cav_set):
-                print("Error: Duplicate capture files found for a cavity '{}'".format(cav))
-                exit(1)
-        
-        waveforms_df = pd.DataFrame()
-
-        event_id = 1 # Since the file only has one label, just assign a static ID.  Needed by tsfresh.
-        for m in range(0,8):
-            f = os.path.join(event_dir, capture_files[m])
-            df = pd.read_table(f, sep='\t')
-            sLength = len(df['Time'])
-            tStep = (df.Time[2] - df.Time[1]) # in milliseconds
-            df['id'] = pd.Series(event_id, index=df.index)
-            col = ['Time', 
-                    f'{m+1}_IMES', f'{m+1}_QMES', f'{m+1}_GMES', f'{m+1}_PMES', f'{m+1}_IASK', f'{m+1}_QASK', 
-                    f'{m+1}_GASK', f'{m+1}_PASK', f'{m+1}_CRFP', f'{m+1}_CRFPP', f'{m+1}_CRRP', f'{m+1}_CRRPP', 
-                    f'{m+1}_GLDE', f'{m+1}_PLDE', f'{m+1}_DETA2_', f'{m+1}_CFQE2_', f'{m+1}_DFQES',
-                    'id']
-            df.columns=col
-            waveforms_df = pd.concat([waveforms_df, df], axis=1, sort=False)
-            #print("j = {0:}, k = {1:}, input shape = {2:}, master shape = {3:}, time step = {4:3.2f} ms".format(j, k, df.shape, master_df.shape, tStep))
-            waveforms_df = waveforms_df.loc[:,~waveforms_df.columns.duplicated()]
-    
-
-        # Remove any trailing '_' from column names
-        mapper = {
-                  "1_DETA2_":"1_DETA2", "2_DETA2_":"2_DETA2", "3_DETA2_":"3_DETA2",
-                  "4_DETA2_":"4_DETA2", "5_DETA2_":"5_DETA2", "6_DETA2_":"6_DETA2",
-                  "7_DETA2_":"7_DETA2", "8_DETA2_":"8_DETA2"
-                 }
-        waveforms_df = waveforms_df.rename(columns=mapper)
-
-        # Since this cavity problem has so many waveforms (8*17) and takes a long time for tsfresh to analyze all of them,
-        # we down select to only extract features for the waveforms that Tom is looking at when making his labels
-        select_columns = ["Time", "id", "1_GMES", "1_GASK", "1_CRFP", "1_DETA2", "2_GMES", "2_GASK", "2_CRFP", "2_DETA2", "3_GMES", 
-               "3_GASK", "3_CRFP", "3_DETA2", "4_GMES", "4_GASK", "4_CRFP", "4_DETA2", "5_GMES", "5_GASK", "5_CRFP", 
-               "5_DETA2", "6_GMES", "6_GASK", "6_CRFP", "6_DETA2", "7_GMES", "7_GASK", "7_CRFP", "7_DETA2", "8_GMES", 
-               "8_GASK", "8_CRFP", "8_DETA2"]
-        waveforms_df = waveforms_df[select_columns]
-
-        # Grab the label and include identifying info
-        y = pd.DataFrame({'zone': zone, 'time': timestamp, 'label': labeled_df.cavity})
-
-        # Perform the cavity extraction
-        extraction_settings = ComprehensiveFCParameters()
-        X = extract_features(waveforms_df.astype('float64'),
-                             column_id="id",
-                             column_sort="Time",
-                             impute_function=impute,
-                             default_fc_parameters=extraction_settings,
-                             disable_progressbar=True,
-                             n_jobs=tsf_jobs
-                            )
-
-        # Add the ID info to the tsfresh output so we can join files together in the future
-        X['zone'] = zone
-        X['time'] = timestamp
-
-
-        # Save the results and the label in files for later access
-        X.to_csv(os.path.join(out_dir, 'cavity_{}_{}_X.csv'.format(zone, timestamp)), index=False)
-        y.to_csv(os.path.join(out_dir, 'cavity_{}_{}_y.csv'.format(zone, timestamp)), index=False)
-
-        print("Completed cavity feature extraction")
-
-    # Extract the features needed to train our trip classifier model
-    if extract_type == 'trip':
-        # Here we use Tom's labeled cavity to filter this process.  If he said it was a 'Multi Cav Turn off' with
-        # cavity == 0, then we just skip it, since our cavity models will produce this result
-        cavity_label = str(labeled_df.cavity[0])
-        if cavity_label == 0:
-            print("No feature extraction needed since cavity label was '{}'".format(cavity_label))
-            exit()
+    extract_type = args.extract_type
 
-        # Get a list of the capture files associated this event
-        capture_files = os.listdir(event_dir)
-
-        # Check that we have one capture file for the identified cavity
-        epics_cav = zone_dict[zone] + cavity_label
-        cav_file_count = 0
-        for file in capture_files:
-            if file[0:4] == epics_cav:
-                cav_file_count += 1
-        if cav_file_count == 0:
-            print("Error: Missing capture file for cavity label {} / EPICS cavity name {}".format(cavity_label, epics_cav))
-            exit(1)
-        elif cav_file_count != 1:
-            print("Error: Found {} capture files for cavity label {} / EPICS cavity name {}".format(cav_file_count, cavity_label, epics_cav))
+    # Validate extraction type
+    if extract_type not in run_types:
+        print("Error: invalid extraction type specified '{}'.  Valid options are {}".format(extract_type, run_types))
+        exit(1)
+
+    label_files = expand_label_files(args.label_files)
+    first_path = resolve_label_file(args.label_files[0])
+    batch_mode = len(label_files) != 1 or os.path.isdir(first_path) or label_table.is_table(first_path)
+
+    if not batch_mode:
+        try:
+            extract_event(label_files[0], extract_type, n_jobs=args.n_jobs, engine=args.engine)
+        except SkipEvent as ex:
+            print(ex)
+            exit()
+        except ExtractionError as ex:
+            print("Error: {}".format(ex))
             exit(1)
-        
-        # Go through the list of files and grab the file that matches the needed cavity
-        cavity_file = ""
-        for file in capture_files:
-            if file[0:4] == epics_cav:
-                cavity_file = os.path.join(event_dir, file)
-                break
-
-        # Construct a dictionary for mapping cavity-specific waveform names to generic waveform names.  Used to
-        # rename the dataframe columns into a generic set that can be analyzed by tsfresh regardless of which cavity
-        # is the one to fault.
-        waveforms = ('IMES', 'QMES', 'GMES', 'PMES', 'IASK', 'QASK', 'GASK', 'PASK', 'CRFP', 'CRFPP', 'CRRP', 'CRRPP',
-                     'GLDE', 'PLDE', 'DETA2', 'CFQE2', 'DFQES')
-        waveform_mapper = {str(epics_cav) + "WFS" + s: s for s in waveforms}
-        fault_columns = list(waveform_mapper.keys())
-        fault_columns.insert(0, 'id')
-        fault_columns.insert(0, 'Time')
-
-        # Read in the file.  Since only one label/event, assign single ID number for use by tsfresh
-        waveforms_df = pd.read_table(cavity_file, sep='\t')
-        waveforms_df['id'] = pd.Series(1, index=waveforms_df.index)
-
-        # Rename the columns to get rid of the cavity specific info.  Not needed since the model will generalize to all
-        # cavities.
-        waveforms_df = waveforms_df.rename(columns=waveform_mapper)
-
-        # Grab the label and include identifying info
-        y = pd.DataFrame({'zone': zone, 'time': timestamp, 'label': labeled_df.fault})
-
-        # Calculate all of time series features available
-        extraction_settings = ComprehensiveFCParameters()
-        X = extract_features(waveforms_df.astype('float64'),
-                            column_id="id",
-                            column_sort="Time",
-                            impute_function=impute,
-                            default_fc_parameters=extraction_settings,
-                            disable_progressbar=True,
-                            n_jobs=tsf_jobs
-                            )
-
-        # Add the ID info to the tsfresh output so we can join files together in the future
-        X['zone'] = zone
-        X['time'] = timestamp
-
-        # Save the results and the label in files for later access
-        X.to_csv(os.path.join(out_dir, 'trip_{}_{}_X.csv'.format(zone, timestamp)), index=False)
-        y.to_csv(os.path.join(out_dir, 'trip_{}_{}_y.csv'.format(zone, timestamp)), index=False)
-
-        print("Completed trip feature extraction") 
+        print("Completed {} feature extraction".format(extract_type))
+    else:
+        failures = extract_batch(label_files, extract_type, chunk_size=args.chunk_size, n_jobs=args.n_jobs,
+                                 engine=args.engine)
+        print("Completed {} feature extraction for {} of {} events".format(extract_type,
+                                                                           len(label_files) - len(failures),
+                                                                           len(label_files)))
+
+    if feature_cache_dirs is not None and args.feature_cache_size is not None:
+        feature_cache.prune_tiers(feature_cache_dirs, args.feature_cache_size * 2**30)
+    if batch_mode and len(failures) > 0:
+        exit(1)
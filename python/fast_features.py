@@ -0,0 +1,433 @@
+import numpy as np
+import pandas as pd
+
+import tsfresh
+from tsfresh.feature_extraction import feature_calculators
+from tsfresh.utilities.string_manipulation import convert_to_output_format
+
+# This module is a drop-in replacement for tsfresh.extract_features for the wide DataFrames built by extract.py.  The
+# feature calculators listed in fast_calculators are computed for every signal of every event at once on a 2-D array
+# with one row per (event, signal).  Everything else is handed to tsfresh.  Each vectorized calculator follows the
+# formula of the tsfresh calculator of the same name, and feature names are generated with tsfresh's own helpers, so
+# the output matches what tsfresh would produce.
+#
+# Rows are kept contiguous and reduced along the last axis so numpy uses the same summation as it does for the 1-D
+# arrays tsfresh works on.
+
+
+# Calculators without parameters return a single array, one value per row of x
+def _mean(x, params):
+    return [x.mean(axis=1)]
+
+
+def _median(x, params):
+    return [np.median(x, axis=1)]
+
+
+def _minimum(x, params):
+    return [x.min(axis=1)]
+
+
+def _maximum(x, params):
+    return [x.max(axis=1)]
+
+
+def _standard_deviation(x, params):
+    return [x.std(axis=1)]
+
+
+def _variance(x, params):
+    return [x.var(axis=1)]
+
+
+def _sum_values(x, params):
+    return [x.sum(axis=1)]
+
+
+def _length(x, params):
+    return [np.full(x.shape[0], x.shape[1], dtype=float)]
+
+
+def _abs_energy(x, params):
+    return [(x * x).sum(axis=1)]
+
+
+def _mean_abs_change(x, params):
+    return [np.abs(np.diff(x, axis=1)).mean(axis=1)]
+
+
+def _mean_change(x, params):
+    n = x.shape[1]
+    if n < 2:
+        return [np.full(x.shape[0], np.nan)]
+    return [(x[:, -1] - x[:, 0]) / (n - 1)]
+
+
+def _absolute_sum_of_changes(x, params):
+    return [np.abs(np.diff(x, axis=1)).sum(axis=1)]
+
+
+def _mean_second_derivative_central(x, params):
+    n = x.shape[1]
+    if n < 3:
+        return [np.full(x.shape[0], np.nan)]
+    return [(x[:, -1] - x[:, -2] - x[:, 1] + x[:, 0]) / (2 * (n - 2))]
+
+
+def _variance_larger_than_standard_deviation(x, params):
+    y = x.var(axis=1)
+    return [y > np.sqrt(y)]
+
+
+def _count_above_mean(x, params):
+    return [(x > x.mean(axis=1, keepdims=True)).sum(axis=1)]
+
+
+def _count_below_mean(x, params):
+    return [(x < x.mean(axis=1, keepdims=True)).sum(axis=1)]
+
+
+def _first_location_of_maximum(x, params):
+    return [np.argmax(x, axis=1) / x.shape[1]]
+
+
+def _last_location_of_maximum(x, params):
+    return [1.0 - np.argmax(x[:, ::-1], axis=1) / x.shape[1]]
+
+
+def _first_location_of_minimum(x, params):
+    return [np.argmin(x, axis=1) / x.shape[1]]
+
+
+def _last_location_of_minimum(x, params):
+    return [1.0 - np.argmin(x[:, ::-1], axis=1) / x.shape[1]]
+
+
+# tsfresh uses pandas for these two, so let pandas do the same calculation one column per row of x
+def _skewness(x, params):
+    return [pd.DataFrame(x.T).skew().values]
+
+
+def _kurtosis(x, params):
+    return [pd.DataFrame(x.T).kurtosis().values]
+
+
+def _has_duplicate_max(x, params):
+    return [(x == x.max(axis=1, keepdims=True)).sum(axis=1) >= 2]
+
+
+def _has_duplicate_min(x, params):
+    return [(x == x.min(axis=1, keepdims=True)).sum(axis=1) >= 2]
+
+
+def _has_duplicate(x, params):
+    return [(np.diff(np.sort(x, axis=1), axis=1) == 0).any(axis=1)]
+
+
+# Calculators with parameters return one array per entry of params, in the same order
+def _quantile(x, params):
+    q = np.quantile(x, [p["q"] for p in params], axis=1)
+    return list(q)
+
+
+def _large_standard_deviation(x, params):
+    std = x.std(axis=1)
+    spread = x.max(axis=1) - x.min(axis=1)
+    return [std > (p["r"] * spread) for p in params]
+
+
+def _symmetry_looking(x, params):
+    mean_median_difference = np.abs(x.mean(axis=1) - np.median(x, axis=1))
+    max_min_difference = x.max(axis=1) - x.min(axis=1)
+    return [mean_median_difference < (p["r"] * max_min_difference) for p in params]
+
+
+def _ratio_beyond_r_sigma(x, params):
+    deviation = np.abs(x - x.mean(axis=1, keepdims=True))
+    std = x.std(axis=1, keepdims=True)
+    return [(deviation > p["r"] * std).sum(axis=1) / x.shape[1] for p in params]
+
+
+def _autocorrelation(x, params):
+    n = x.shape[1]
+    x_mean = x.mean(axis=1, keepdims=True)
+    v = x.var(axis=1)
+    res = []
+    for p in params:
+        lag = p["lag"]
+        if n < lag:
+            res.append(np.full(x.shape[0], np.nan))
+            continue
+        sum_product = ((x[:, :n - lag] - x_mean) * (x[:, lag:] - x_mean)).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res.append(np.where(np.isclose(v, 0), np.nan, sum_product / ((n - lag) * v)))
+    return res
+
+
+def _fft_coefficient(x, params):
+    fft = np.fft.rfft(x, axis=1)
+    res = []
+    for p in params:
+        if p["coeff"] >= fft.shape[1]:
+            res.append(np.full(x.shape[0], np.nan))
+            continue
+        c = fft[:, p["coeff"]]
+        if p["attr"] == "real":
+            res.append(c.real)
+        elif p["attr"] == "imag":
+            res.append(c.imag)
+        elif p["attr"] == "abs":
+            res.append(np.abs(c))
+        else:
+            res.append(np.angle(c, deg=True))
+    return res
+
+
+def _energy_ratio_by_chunks(x, params):
+    full_series_energy = (x ** 2).sum(axis=1)
+    res = []
+    for p in params:
+        # Same segment boundaries as np.array_split
+        segments = np.array_split(np.arange(x.shape[1]), p["num_segments"])[p["segment_focus"]]
+        segment_energy = (x[:, segments[0]:segments[-1] + 1] ** 2.0).sum(axis=1) if len(segments) > 0 else 0.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res.append(np.where(full_series_energy == 0, np.nan, segment_energy / full_series_energy))
+    return res
+
+
+def _index_mass_quantile(x, params):
+    abs_x = np.abs(x)
+    s = abs_x.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mass_centralized = np.cumsum(abs_x, axis=1) / s
+    s = s[:, 0]
+    return [np.where(s == 0, np.nan, (np.argmax(mass_centralized >= p["q"], axis=1) + 1) / x.shape[1])
+            for p in params]
+
+
+def _c3(x, params):
+    n = x.shape[1]
+    res = []
+    for p in params:
+        lag = p["lag"]
+        if 2 * lag >= n:
+            res.append(np.zeros(x.shape[0]))
+        else:
+            res.append((x[:, 2 * lag:] * x[:, lag:n - lag] * x[:, :n - 2 * lag]).mean(axis=1))
+    return res
+
+
+def _cid_ce(x, params):
+    res = []
+    for p in params:
+        if p["normalize"]:
+            s = x.std(axis=1, keepdims=True)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                z = (x - x.mean(axis=1, keepdims=True)) / s
+            d = np.diff(z, axis=1)
+            res.append(np.where(s[:, 0] != 0, np.sqrt((d * d).sum(axis=1)), 0.0))
+        else:
+            d = np.diff(x, axis=1)
+            res.append(np.sqrt((d * d).sum(axis=1)))
+    return res
+
+
+def _time_reversal_asymmetry_statistic(x, params):
+    n = x.shape[1]
+    res = []
+    for p in params:
+        lag = p["lag"]
+        if 2 * lag >= n:
+            res.append(np.zeros(x.shape[0]))
+            continue
+        x0 = x[:, :n - 2 * lag]
+        one_lag = x[:, lag:n - lag]
+        two_lag = x[:, 2 * lag:]
+        res.append((two_lag * two_lag * one_lag - one_lag * x0 * x0).mean(axis=1))
+    return res
+
+
+def _range_count(x, params):
+    return [((x >= p["min"]) & (x < p["max"])).sum(axis=1) for p in params]
+
+
+def _value_count(x, params):
+    return [np.isnan(x).sum(axis=1) if np.isnan(p["value"]) else (x == p["value"]).sum(axis=1) for p in params]
+
+
+def _number_crossing_m(x, params):
+    return [np.diff(x > p["m"], axis=1).sum(axis=1) for p in params]
+
+
+# The tsfresh calculators that have a vectorized version
+fast_calculators = {
+    'mean': _mean,
+    'median': _median,
+    'minimum': _minimum,
+    'maximum': _maximum,
+    'standard_deviation': _standard_deviation,
+    'variance': _variance,
+    'sum_values': _sum_values,
+    'length': _length,
+    'abs_energy': _abs_energy,
+    'mean_abs_change': _mean_abs_change,
+    'mean_change': _mean_change,
+    'absolute_sum_of_changes': _absolute_sum_of_changes,
+    'mean_second_derivative_central': _mean_second_derivative_central,
+    'variance_larger_than_standard_deviation': _variance_larger_than_standard_deviation,
+    'count_above_mean': _count_above_mean,
+    'count_below_mean': _count_below_mean,
+    'first_location_of_maximum': _first_location_of_maximum,
+    'last_location_of_maximum': _last_location_of_maximum,
+    'first_location_of_minimum': _first_location_of_minimum,
+    'last_location_of_minimum': _last_location_of_minimum,
+    'skewness': _skewness,
+    'kurtosis': _kurtosis,
+    'has_duplicate_max': _has_duplicate_max,
+    'has_duplicate_min': _has_duplicate_min,
+    'has_duplicate': _has_duplicate,
+    'quantile': _quantile,
+    'large_standard_deviation': _large_standard_deviation,
+    'symmetry_looking': _symmetry_looking,
+    'ratio_beyond_r_sigma': _ratio_beyond_r_sigma,
+    'autocorrelation': _autocorrelation,
+    'fft_coefficient': _fft_coefficient,
+    'energy_ratio_by_chunks': _energy_ratio_by_chunks,
+    'index_mass_quantile': _index_mass_quantile,
+    'c3': _c3,
+    'cid_ce': _cid_ce,
+    'time_reversal_asymmetry_statistic': _time_reversal_asymmetry_statistic,
+    'range_count': _range_count,
+    'value_count': _value_count,
+    'number_crossing_m': _number_crossing_m,
+}
+
+# Cached result of probe_sorted_output()
+_sorted_output = None
+
+
+# Split feature extraction settings into the part we can compute here and the part that needs tsfresh
+def split_parameters(fc_parameters):
+    fast = {}
+    slow = {}
+    for name, params in fc_parameters.items():
+        if name in fast_calculators:
+            fast[name] = params
+        else:
+            slow[name] = params
+    return fast, slow
+
+
+# The feature name suffixes tsfresh would produce for a calculator, in the order of params.  Combiners name their own
+# outputs, so ask the installed version of tsfresh by calling it on a small dummy series.
+def feature_keys(name, params):
+    func = getattr(feature_calculators, name)
+    if func.fctype == "combiner":
+        return [key for key, value in func(np.linspace(1.0, 2.0, 16), param=params)]
+    if params:
+        return [convert_to_output_format(p) for p in params]
+    return [""]
+
+
+# Older versions of tsfresh pivot their result, which sorts the columns by name.  Newer versions keep the order of
+# the signals and calculators.  Find out which one we have so the output columns can be put in the same order.
+def probe_sorted_output():
+    global _sorted_output
+    if _sorted_output is None:
+        df = pd.DataFrame({'id': [1, 1, 1], 'Time': [0.0, 1.0, 2.0], 'b': [1.0, 2.0, 4.0], 'a': [1.0, 3.0, 2.0]})
+        X = tsfresh.extract_features(df, column_id='id', column_sort='Time',
+                                     default_fc_parameters={'mean': None, 'length': None},
+                                     disable_progressbar=True, n_jobs=0)
+        _sorted_output = list(X.columns) == sorted(X.columns)
+    return _sorted_output
+
+
+# Compute the vectorized features.  Events are grouped by length so that each group is a single 2-D array with one
+# row per (event, signal).  Returns a DataFrame indexed by id.
+def _extract_fast(df, column_id, column_sort, kinds, fc_parameters):
+    names = []
+    for name, params in fc_parameters.items():
+        names.extend("__" + name + ("__" + key if key else "") for key in feature_keys(name, params))
+
+    by_length = {}
+    for event_id, group in df.groupby(column_id, sort=True):
+        values = group.sort_values(column_sort)[kinds].values.astype('float64').T
+        by_length.setdefault(values.shape[1], []).append((event_id, values))
+
+    frames = []
+    for items in by_length.values():
+        x = np.ascontiguousarray(np.concatenate([values for event_id, values in items], axis=0))
+        results = []
+        for name, params in fc_parameters.items():
+            results.extend(fast_calculators[name](x, params))
+
+        # Rows of x are event-major, so this gives (events, kinds * features) with features varying fastest
+        features = np.stack([np.asarray(r, dtype='float64') for r in results], axis=1)
+        features = features.reshape(len(items), len(kinds) * len(names))
+        columns = [str(kind) + suffix for kind in kinds for suffix in names]
+        frames.append(pd.DataFrame(features, index=[event_id for event_id, values in items], columns=columns))
+
+    return pd.concat(frames, axis=0).sort_index()
+
+
+# Put the columns in the order tsfresh itself would have used.  kind_parameters maps each signal to its settings.
+def _order_columns(X, kinds, kind_parameters, fast_columns, slow_columns):
+    if probe_sorted_output():
+        return X[sorted(X.columns)]
+
+    slow_by_prefix = {}
+    for column in slow_columns:
+        kind, name = column.split("__")[0:2]
+        slow_by_prefix.setdefault((kind, name), []).append(column)
+
+    fast_columns = set(fast_columns)
+    order = []
+    for kind in kinds:
+        for name, params in kind_parameters[kind].items():
+            if name in fast_calculators:
+                order.extend("{}__{}".format(kind, name) + ("__" + key if key else "")
+                             for key in feature_keys(name, params)
+                             if "{}__{}".format(kind, name) + ("__" + key if key else "") in fast_columns)
+            else:
+                order.extend(slow_by_prefix.get((str(kind), name), []))
+    return X[order]
+
+
+# Same interface as tsfresh.extract_features for the arguments extract.py uses.  As with tsfresh, signals listed in
+# kind_to_fc_parameters use their own settings and all others use default_fc_parameters.
+def extract_features(timeseries_container, column_id, column_sort, default_fc_parameters, kind_to_fc_parameters=None,
+                     n_jobs=1, disable_progressbar=True, impute_function=None):
+    df = timeseries_container
+    kinds = [c for c in df.columns if c not in (column_id, column_sort)]
+    if kind_to_fc_parameters is None:
+        kind_to_fc_parameters = {}
+    kind_parameters = {kind: kind_to_fc_parameters.get(str(kind), default_fc_parameters) for kind in kinds}
+
+    # Signals sharing the same vectorized settings are computed together
+    fast_groups = {}
+    slow = {}
+    for kind in kinds:
+        fast, slow[kind] = split_parameters(kind_parameters[kind])
+        if len(fast) > 0:
+            fast_groups.setdefault(repr(fast), (fast, []))[1].append(kind)
+    slow = {kind: params for kind, params in slow.items() if len(params) > 0}
+
+    fast_frames = [_extract_fast(df, column_id, column_sort, group_kinds, fast)
+                   for fast, group_kinds in fast_groups.values()]
+    frames = list(fast_frames)
+    if len(slow) > 0:
+        frames.append(tsfresh.extract_features(df[[column_id, column_sort] + list(slow)],
+                                               column_id=column_id, column_sort=column_sort,
+                                               default_fc_parameters={},
+                                               kind_to_fc_parameters={str(k): p for k, p in slow.items()},
+                                               disable_progressbar=disable_progressbar, n_jobs=n_jobs))
+
+    X = pd.concat(frames, axis=1) if len(frames) > 1 else frames[0]
+    X = _order_columns(X, kinds, kind_parameters,
+                       [c for frame in fast_frames for c in frame.columns],
+                       frames[-1].columns if len(slow) > 0 else [])
+    X.index.name = column_id
+
+    if impute_function is not None:
+        impute_function(X)
+    return X
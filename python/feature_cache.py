@@ -0,0 +1,282 @@
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from tsfresh.utilities.string_manipulation import convert_to_output_format
+
+# This module caches calculated features by the contents of the signal they were calculated from (extract.py
+# --feature-cache), so that changing the feature settings only calculates the features that haven't been calculated
+# before.  Every signal of every event is one cache entry
+#   <cache_dir>/<key[:2]>/<key>.json  - for every feature calculated so far, its name (without the signal name) and
+#                                       the [column, value] pairs it gave, e.g., {"mean": [["mean", 0.5]], ...}
+# where the key is a hash of the signal's values in Time order, their dtype, and the tsfresh version and feature
+# engine.  Since the key is the content of the signal, it covers the capture file the signal came from, and the window,
+# decimation and storage settings it was read with.  Identical signals share an entry no matter which extraction type
+# read them, e.g., the trip features of a GMES signal are found in the entry written by the cavity extraction.
+# A feature usually gives exactly one column of the same name, but some calculators add default parameters to their
+# names (e.g., augmented_dickey_fuller's autolag) or give nothing for some data (e.g., linear_trend_timewise without
+# a time index), so the columns are kept as tsfresh named them.
+#
+# Entries are only added to, never changed, so concurrent jobs can share a cache: an entry is written under a
+# temporary name and renamed into place, and at worst two jobs that add to the same entry at once both keep only
+# their own new features.  Reading an entry updates its mtime, and prune removes the least recently used entries
+# until the cache is under a size limit.
+#
+# The cache can have two tiers, e.g., a directory on each node's local disk in front of the shared (NFS) cache.
+# Entries are looked up in order, and an entry found in a later tier is copied to the earlier ones.  New entries are
+# written to every tier, so other nodes find them in the shared cache.  A tier that can't be written to (e.g., a
+# missing local scratch disk) is dropped, and the cache falls back to the rest.
+
+# Where this script currently lives
+python_dir = os.path.dirname(os.path.realpath(__file__))
+
+# The root of the rfw_tsf_extractor app
+app_dir = os.path.realpath(os.path.join(python_dir, '..'))
+
+# Default location of the shared cache
+cache_dir = os.path.join(app_dir, 'extracted', 'feature-cache')
+
+
+# Return the tiers of cache_dirs that can be written to, warning about the others
+def usable_dirs(cache_dirs):
+    usable = []
+    for d in cache_dirs:
+        try:
+            os.makedirs(d, exist_ok=True)
+            if os.access(d, os.W_OK):
+                usable.append(d)
+                continue
+        except OSError:
+            pass
+        print("Warning: can't use feature cache directory {}".format(d))
+    return usable
+
+
+# The cache directories to use: the local directory (if any) in front of the shared one, leaving out any that can't
+# be used.  Returns None if neither can be used.
+def tiers(shared_dir, local_dir=None):
+    cache_dirs = usable_dirs([local_dir, shared_dir] if local_dir is not None else [shared_dir])
+    return cache_dirs if len(cache_dirs) > 0 else None
+
+
+# The cache key of a signal.  values are the samples of one signal of one event in Time order, and salt holds
+# anything else the features depend on.
+def series_key(values, salt):
+    h = hashlib.sha1("{}|{}|{}|".format(salt, values.dtype.str, len(values)).encode('utf-8'))
+    h.update(np.ascontiguousarray(values).tobytes())
+    return h.hexdigest()
+
+
+# Path of the cache entry for a key
+def entry_path(key, cache_dir=cache_dir):
+    return os.path.join(cache_dir, key[:2], key + '.json')
+
+
+# Return the cached features of a signal, or an empty dict if no tier has the entry.  The entry is marked as used, and
+# copied to earlier tiers that didn't have it.
+def load_entry(key, cache_dirs):
+    for i, d in enumerate(cache_dirs):
+        path = entry_path(key, d)
+        try:
+            with open(path, 'r') as fh:
+                entry = json.load(fh)
+            os.utime(path)
+        except (OSError, ValueError):
+            continue
+        for earlier in cache_dirs[:i]:
+            write_entry(key, entry, earlier)
+        return entry
+    return {}
+
+
+# Write a cache entry to one tier
+def write_entry(key, entry, cache_dir):
+    path = entry_path(key, cache_dir)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'w') as fh:
+            json.dump(entry, fh)
+        os.replace(tmp, path)
+    except OSError as ex:
+        print("Warning: could not write feature cache entry {}: {}".format(path, ex))
+
+
+# Names of the features fc_parameters asks for on a signal (without the signal name), in the order tsfresh calculates
+# them, along with the calculator and parameters of each
+def feature_names(fc_parameters):
+    names = []
+    for calculator, params in fc_parameters.items():
+        if params is None:
+            names.append((calculator, calculator, None))
+        else:
+            for param in params:
+                names.append(("{}__{}".format(calculator, convert_to_output_format(param)), calculator, param))
+    return names
+
+
+# Calculate features through the cache.  kind_parameters(kind) gives the fc_parameters of each signal, and
+# compute(df, kind_to_fc_parameters) calculates the features of a wide DataFrame like waveforms_df, indexed by id.
+# Only the features of the signals and events that are missing from the cache are handed to compute, and its results
+# are added to the cache.  Returns the features of every event (indexed by id), the number of features found in the
+# cache and the number asked for.
+def extract_features(waveforms_df, column_id, column_sort, kind_parameters, compute, salt, cache_dirs):
+    kinds = [c for c in waveforms_df.columns if c not in (column_id, column_sort)]
+    ids = waveforms_df[column_id].values
+    order = np.lexsort((waveforms_df[column_sort].values, ids))
+    sorted_ids = ids[order]
+    boundaries = np.flatnonzero(sorted_ids[1:] != sorted_ids[:-1]) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(sorted_ids)]])
+    event_ids = sorted_ids[starts]
+
+    # Look up every signal of every event, and collect the features each is missing
+    names = {kind: feature_names(kind_parameters(kind)) for kind in kinds}
+    keys = {}
+    entries = {}
+    missing = {}
+    n_cached = 0
+    n_requested = 0
+    for kind in kinds:
+        values = waveforms_df[kind].values[order]
+        for event_id, start, end in zip(event_ids, starts, ends):
+            key = series_key(values[start:end], salt)
+            entry = load_entry(key, cache_dirs)
+            keys[(event_id, kind)] = key
+            entries[(event_id, kind)] = entry
+            n_requested += len(names[kind])
+            for name, calculator, param in names[kind]:
+                if name in entry:
+                    n_cached += 1
+                else:
+                    # The calculator and parameters of the feature, and the events missing it
+                    feature = missing.setdefault(kind, {}).setdefault(name, (calculator, param, set()))
+                    feature[2].add(event_id)
+
+    # Calculate the missing features of the events that miss any, and add them to the cache
+    if len(missing) > 0:
+        kind_to_fc_parameters = {}
+        missing_ids = set()
+        for kind, features in missing.items():
+            fc_parameters = kind_to_fc_parameters.setdefault(str(kind), {})
+            for name, (calculator, param, feature_ids) in features.items():
+                missing_ids.update(feature_ids)
+                if param is None:
+                    fc_parameters[calculator] = None
+                else:
+                    fc_parameters.setdefault(calculator, []).append(param)
+        rows = np.isin(ids, list(missing_ids))
+        subset = waveforms_df[[column_id, column_sort] + list(missing)]
+        X_new = compute(subset[rows] if not rows.all() else subset, kind_to_fc_parameters)
+
+        for kind, features in missing.items():
+            columns = assign_columns([c for c in X_new.columns if c.split("__", 1)[0] == str(kind)], features)
+            for event_id in X_new.index:
+                entry = entries[(event_id, kind)]
+                for name, feature_columns in columns.items():
+                    entry[name] = [[c.split("__", 1)[1], float(X_new.at[event_id, c])] for c in feature_columns]
+                for d in cache_dirs:
+                    write_entry(keys[(event_id, kind)], entry, d)
+
+    # Assemble the features of every event in tsfresh's order.  The columns of a feature are the same for every event
+    # since they only depend on the calculator and parameters.
+    columns = []
+    data = []
+    for kind in kinds:
+        for name, calculator, param in names[kind]:
+            pairs = [entries[(event_id, kind)][name] for event_id in event_ids]
+            columns.extend("{}__{}".format(kind, c) for c, value in pairs[0])
+            data.append(np.array([[value for c, value in p] for p in pairs], dtype='float64').reshape(
+                len(event_ids), len(pairs[0])))
+    X = pd.DataFrame(np.hstack(data) if len(data) > 0 else np.empty((len(event_ids), 0)), index=event_ids,
+                     columns=columns)
+    X.index.name = column_id
+    return X, n_cached, n_requested
+
+
+# Work out which of the columns tsfresh gave for a signal belong to which of the features asked for.  features maps the
+# feature names to (calculator, param, ...).  A column belongs to the feature of the same name, or else to the feature
+# whose name it extends with more parameters.  Any other column of a calculator is kept with its last feature.
+def assign_columns(columns, features):
+    assigned = {name: [] for name in features}
+    last = {}
+    for name, feature in features.items():
+        last[feature[0]] = name
+    for column in columns:
+        name = column.split("__", 1)[1]
+        if name not in assigned:
+            extended = [n for n in assigned if name.startswith(n + "__")]
+            calculator = name.split("__", 1)[0]
+            if len(extended) > 0:
+                name = max(extended, key=len)
+            elif calculator in last:
+                name = last[calculator]
+            else:
+                continue
+        assigned[name].append(column)
+    return assigned
+
+
+# Remove the least recently used entries of a cache until it holds at most max_bytes.  Returns the number of entries
+# and bytes removed, and the size of the cache afterwards.
+def prune(cache_dir, max_bytes):
+    entries = []
+    for root, dirs, files in os.walk(cache_dir):
+        for f in files:
+            path = os.path.join(root, f)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+
+    total = sum(size for mtime, size, path in entries)
+    n_removed = 0
+    bytes_removed = 0
+    for mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        n_removed += 1
+        bytes_removed += size
+    return n_removed, bytes_removed, total
+
+
+# Prune every tier of a cache to max_bytes, printing what was removed
+def prune_tiers(cache_dirs, max_bytes):
+    for d in cache_dirs:
+        n_removed, bytes_removed, total = prune(d, max_bytes)
+        print("{}: removed {} entries ({:.1f} MB), {:.1f} MB left".format(d, n_removed, bytes_removed / 2**20,
+                                                                         total / 2**20))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the feature cache used by extract.py --feature-cache.")
+    subparsers = parser.add_subparsers(dest='command')
+    prune_parser = subparsers.add_parser('prune', help="remove the least recently used entries until the cache is "
+                                                       "under a size limit")
+    prune_parser.add_argument('cache_dirs', nargs='*', metavar='cache_dir',
+                              help="cache directories (default: {})".format(cache_dir))
+    prune_parser.add_argument('--max-size', type=float, required=True, metavar='GB',
+                              help="size limit of each cache directory")
+    args = parser.parse_args()
+
+    if args.command != 'prune':
+        parser.print_usage()
+        exit(1)
+
+    cache_dirs = args.cache_dirs if len(args.cache_dirs) > 0 else [cache_dir]
+    for d in cache_dirs:
+        if not os.path.isdir(d):
+            print("Error: directory not found '{}'".format(d))
+            exit(1)
+    prune_tiers(cache_dirs, args.max_size * 2**30)
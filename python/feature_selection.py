@@ -0,0 +1,136 @@
+import os
+import json
+import glob
+import argparse
+
+import pandas as pd
+
+from tsfresh import select_features
+from tsfresh.feature_extraction.settings import from_columns
+
+import feature_store
+import windowing
+
+# This module creates and reads feature subset files, which limit extraction to the features a model actually uses
+# (see extract.py --features).  A feature subset file is either
+#   - a CSV with a 'feature' column holding one tsfresh feature name per row (what this script writes),
+#   - any other CSV, in which case its column names are used (e.g., a reduced X file from a selection run), or
+#   - a .json file holding a tsfresh kind_to_fc_parameters mapping.
+# Feature names are the most robust choice since JSON cannot represent the tuple parameters some calculators use.
+
+# Where this script currently lives
+python_dir = os.path.dirname(os.path.realpath(__file__))
+
+# The root of the rfw_tsf_extractor app
+app_dir = os.path.realpath(os.path.join(python_dir, '..'))
+
+# Default location of the per-event CSV files
+csv_dir = os.path.join(app_dir, 'extracted')
+
+# Columns of extracted X files and feature store rows that are not features.  Store rows of unlabeled trip events
+# extracted per cavity (see watch.py) also carry their cavity.
+non_feature_columns = ['zone', 'time', 'label', 'cavity']
+
+
+# JSON turns tuples into lists, but tsfresh needs hashable parameters (and uses their repr in feature names)
+def _lists_to_tuples(value):
+    if isinstance(value, list):
+        return tuple(_lists_to_tuples(v) for v in value)
+    return value
+
+
+# Read a feature subset file and return the matching tsfresh kind_to_fc_parameters mapping
+def read_feature_subset(path):
+    if path.endswith('.json'):
+        with open(path, 'r') as fh:
+            kind_to_fc_parameters = json.load(fh)
+        for fc_parameters in kind_to_fc_parameters.values():
+            for name, params in fc_parameters.items():
+                if params is not None:
+                    fc_parameters[name] = [{k: _lists_to_tuples(v) for k, v in p.items()} for p in params]
+        return kind_to_fc_parameters
+
+    df = pd.read_csv(path)
+    if 'feature' in df.columns:
+        columns = [str(c) for c in df['feature']]
+    else:
+        columns = [str(c) for c in df.columns]
+    # Features of windowed or decimated extractions (see windowing.py) select the calculators of their signal
+    kind_to_fc_parameters = {}
+    for kind, fc_parameters in from_columns(columns, columns_to_ignore=non_feature_columns).items():
+        kind_to_fc_parameters.setdefault(windowing.base_kind(kind), {}).update(fc_parameters)
+    return kind_to_fc_parameters
+
+
+# Write the names of the selected features as a feature subset file
+def write_feature_subset(columns, path):
+    pd.DataFrame({'feature': list(columns)}).to_csv(path, index=False)
+
+
+# Load the per-event CSV files of an extraction type into a single X (features only) and y (labels) pair
+def load_csv_dataset(extract_type, csv_dir=csv_dir):
+    X_frames = []
+    labels = []
+    for X_file in sorted(glob.glob(os.path.join(csv_dir, '{}_*_X.csv'.format(extract_type)))):
+        y_file = X_file[:-len('_X.csv')] + '_y.csv'
+        if not os.path.exists(y_file):
+            print("Warning: skipping {} since {} is missing".format(X_file, y_file))
+            continue
+        X_frames.append(pd.read_csv(X_file))
+        labels.append(pd.read_csv(y_file).label[0])
+
+    if len(X_frames) == 0:
+        return pd.DataFrame(), pd.Series(labels)
+    X = pd.concat(X_frames, axis=0, ignore_index=True, sort=False)
+    return X.drop(columns=[c for c in non_feature_columns if c in X.columns]), pd.Series(labels, index=X.index)
+
+
+# Select the features that are relevant to the labels.  tsfresh only tests binary or real targets, so a label with
+# more than two classes is handled one-vs-rest and the features relevant to any class are kept.  Returns the names
+# of the selected features in the order of X's columns.
+def select_relevant_features(X, y, fdr_level=0.05, n_jobs=1):
+    classes = sorted(y.unique(), key=str)
+    targets = [y] if len(classes) <= 2 else [y == c for c in classes]
+
+    selected = set()
+    for target in targets:
+        if target.nunique() < 2:
+            continue
+        X_selected = select_features(X, target, fdr_level=fdr_level, n_jobs=n_jobs)
+        selected.update(X_selected.columns)
+    return [c for c in X.columns if c in selected]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create a feature subset file for extract.py --features by "
+                                                 "selecting the features of an extracted dataset that are relevant "
+                                                 "to its labels.")
+    parser.add_argument('extract_type', help="cavity or trip")
+    parser.add_argument('subset_file', help="feature subset file to write (CSV of feature names)")
+    parser.add_argument('--csv-dir', default=csv_dir,
+                        help="directory of per-event CSV files to read (default: %(default)s)")
+    parser.add_argument('--store', action='store_true', help="read the feature store instead of the CSV files")
+    parser.add_argument('--fdr-level', type=float, default=0.05,
+                        help="expected share of irrelevant features among those selected (default: %(default)s)")
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help="number of tsfresh processes (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.store:
+        X, y = feature_store.load_X_y(args.extract_type)
+        # Events extracted without a label file (see watch.py) can't be used for selection
+        labeled = y['label'].notnull().values
+        X = X[labeled].drop(columns=[c for c in non_feature_columns if c in X.columns]).reset_index(drop=True)
+        y = y['label'][labeled].reset_index(drop=True)
+    else:
+        X, y = load_csv_dataset(args.extract_type, args.csv_dir)
+
+    if len(X) == 0:
+        print("Error: no extracted {} features found".format(args.extract_type))
+        exit(1)
+
+    columns = select_relevant_features(X, y, fdr_level=args.fdr_level, n_jobs=args.n_jobs)
+    write_feature_subset(columns, args.subset_file)
+    n_kinds = len(set(c.split('__')[0] for c in columns))
+    print("Selected {} of {} features from {} signals across {} events".format(len(columns), X.shape[1], n_kinds,
+                                                                              len(X)))
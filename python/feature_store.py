@@ -0,0 +1,228 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import socket
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# This module stores extracted features as a columnar dataset instead of a pair of CSV files per event.  The dataset
+# is partitioned by extraction type and zone, and each partition holds any number of segments, one per extraction
+# job (a single event, or a whole chunk in batch mode):
+#   <store_dir>/<type>/<zone>/<segment>.npy   - float64 feature matrix, one row per event, stored column-major so a
+#                                               subset of columns can be read from the memory-mapped file cheaply
+#   <store_dir>/<type>/<zone>/<segment>.json  - the zone/time/label of each row, when it was written, and the hash of
+#                                               its list of feature names
+#   <store_dir>/<type>/_columns/<hash>.json   - each distinct list of feature names, stored once since it is about as
+#                                               large as a row of features
+# X and y are joined: every row carries its zone, time and label.  Segments are written under temporary names and
+# renamed into place, .json last, so readers never see a partial segment.  If an event was extracted more than once
+# the most recently written row wins.
+
+# Where this script currently lives
+python_dir = os.path.dirname(os.path.realpath(__file__))
+
+# The root of the rfw_tsf_extractor app
+app_dir = os.path.realpath(os.path.join(python_dir, '..'))
+
+# Default location of the store
+store_dir = os.path.join(app_dir, 'extracted', 'store')
+
+# Identifying columns stored in the segment metadata rather than the feature matrix
+id_columns = ['zone', 'time', 'label']
+
+
+# Build the metadata row of an event, converting numpy scalars so they can be written as JSON.  Rows of features
+# extracted per cavity (unlabeled trip events, see watch.py) also carry the cavity number.
+def make_row(zone, time, label, cavity=None):
+    if hasattr(label, 'item'):
+        label = label.item()
+    row = {'zone': str(zone), 'time': str(time), 'label': label}
+    if cavity is not None:
+        row['cavity'] = int(cavity)
+    return row
+
+
+# Rows for the same event (and cavity, if given) supersede each other
+def row_key(row):
+    return row['zone'], row['time'], row.get('cavity')
+
+
+# Write one segment holding the features of one or more events of a zone.  X is a DataFrame of features (any zone
+# and time columns are ignored) and rows is a list of {'zone', 'time', 'label'} dicts in the same order.  Returns the
+# paths of the two files written.
+def write_segment(extract_type, zone, X, rows, store_dir=store_dir):
+    part_dir = os.path.join(store_dir, extract_type, zone)
+    os.makedirs(part_dir, exist_ok=True)
+
+    written = time.time()
+    name = "{}_{}_{}_{}".format(rows[0]['time'], socket.gethostname(), os.getpid(), int(written * 1e6))
+    path = os.path.join(part_dir, name)
+
+    features = X.drop(columns=[c for c in ('zone', 'time') if c in X.columns])
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fh:
+        np.save(fh, np.asfortranarray(features.values, dtype='float64'))
+    os.replace(tmp, path + '.npy')
+
+    columns = [str(c) for c in features.columns]
+    columns_id = hashlib.sha1(json.dumps(columns).encode('utf-8')).hexdigest()
+    columns_file = os.path.join(store_dir, extract_type, '_columns', columns_id + '.json')
+    if not os.path.exists(columns_file):
+        os.makedirs(os.path.dirname(columns_file), exist_ok=True)
+        with open(tmp, 'w') as fh:
+            json.dump(columns, fh)
+        os.replace(tmp, columns_file)
+
+    meta = {'columns_id': columns_id, 'rows': rows, 'written': written}
+    with open(tmp, 'w') as fh:
+        json.dump(meta, fh, default=str)
+    os.replace(tmp, path + '.json')
+
+    return [path + '.npy', path + '.json']
+
+
+# List the segments of an extraction type (optionally only those of some zones), oldest first, as (path, metadata).
+# The feature names of each segment are added to its metadata as 'columns'.
+def list_segments(extract_type, zones=None, store_dir=store_dir):
+    type_dir = os.path.join(store_dir, extract_type)
+    if zones is None:
+        zones = sorted(z for z in os.listdir(type_dir) if not z.startswith('_')) if os.path.isdir(type_dir) else []
+
+    columns = {}
+    segments = []
+    for zone in zones:
+        for meta_file in glob.glob(os.path.join(type_dir, zone, '*.json')):
+            with open(meta_file, 'r') as fh:
+                meta = json.load(fh)
+            if meta['columns_id'] not in columns:
+                with open(os.path.join(type_dir, '_columns', meta['columns_id'] + '.json'), 'r') as fh:
+                    columns[meta['columns_id']] = json.load(fh)
+            meta['columns'] = columns[meta['columns_id']]
+            segments.append((meta_file[:-len('.json')], meta))
+    segments.sort(key=lambda s: s[1]['written'])
+    return segments
+
+
+# The feature names found in the store, in the order they were first seen
+def list_columns(extract_type, zones=None, store_dir=store_dir):
+    columns = []
+    seen = set()
+    for path, meta in list_segments(extract_type, zones, store_dir):
+        for c in meta['columns']:
+            if c not in seen:
+                seen.add(c)
+                columns.append(c)
+    return columns
+
+
+# Lazily yield one DataFrame per segment holding the requested feature columns (all of them if columns is None) plus
+# the zone, time and label columns (and a cavity column for per-cavity rows).  Only the requested columns are read
+# from disk.  Columns missing from a segment are filled with NaN.  Rows superseded by a later extraction of the same
+# event are dropped.
+def iter_segments(extract_type, zones=None, columns=None, store_dir=store_dir):
+    segments = list_segments(extract_type, zones, store_dir)
+
+    # The newest segment holding each event
+    latest = {}
+    for i, (path, meta) in enumerate(segments):
+        for row in meta['rows']:
+            latest[row_key(row)] = i
+
+    for i, (path, meta) in enumerate(segments):
+        keep = [j for j, row in enumerate(meta['rows']) if latest[row_key(row)] == i]
+        if len(keep) == 0:
+            continue
+
+        values = np.load(path + '.npy', mmap_mode='r')
+        wanted = meta['columns'] if columns is None else list(columns)
+        index = {c: k for k, c in enumerate(meta['columns'])}
+        data = {}
+        for c in wanted:
+            data[c] = values[keep, index[c]] if c in index else np.full(len(keep), np.nan)
+
+        df = pd.DataFrame(data, columns=wanted)
+        for c in id_columns:
+            df[c] = [meta['rows'][j][c] for j in keep]
+        if any('cavity' in meta['rows'][j] for j in keep):
+            df['cavity'] = [meta['rows'][j].get('cavity') for j in keep]
+        yield df
+
+
+# Load a combined feature matrix with one row per event.  See iter_segments for the arguments.
+def load(extract_type, zones=None, columns=None, store_dir=store_dir):
+    if columns is None:
+        columns = list_columns(extract_type, zones, store_dir)
+    frames = list(iter_segments(extract_type, zones, columns, store_dir))
+    if len(frames) == 0:
+        return pd.DataFrame(columns=list(columns) + id_columns)
+    return pd.concat(frames, axis=0, ignore_index=True, sort=False)
+
+
+# Load the features of a store split into the usual X (features plus zone and time) and y (zone, time, label) frames
+def load_X_y(extract_type, zones=None, columns=None, store_dir=store_dir):
+    df = load(extract_type, zones, columns, store_dir)
+    return df.drop(columns=['label']), df[id_columns]
+
+
+# Copy the per-event CSV files of an extraction type in csv_dir into the store, one segment per zone.  Returns the
+# number of events imported.
+def import_csv(extract_type, csv_dir, store_dir=store_dir):
+    by_zone = {}
+    for X_file in sorted(glob.glob(os.path.join(csv_dir, '{}_*_X.csv'.format(extract_type)))):
+        y_file = X_file[:-len('_X.csv')] + '_y.csv'
+        if not os.path.exists(y_file):
+            print("Warning: skipping {} since {} is missing".format(X_file, y_file))
+            continue
+        X = pd.read_csv(X_file)
+        y = pd.read_csv(y_file)
+        row = make_row(y.zone[0], y.time[0], y.label[0])
+        by_zone.setdefault(row['zone'], []).append((X, row))
+
+    n_events = 0
+    for zone, items in sorted(by_zone.items()):
+        X = pd.concat([X for X, row in items], axis=0, ignore_index=True, sort=False)
+        write_segment(extract_type, zone, X, [row for X, row in items], store_dir)
+        n_events += len(items)
+    return n_events
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Work with the extracted feature store.")
+    subparsers = parser.add_subparsers(dest='command')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--store-dir', default=store_dir, help="location of the store (default: %(default)s)")
+
+    import_parser = subparsers.add_parser('import-csv', parents=[common],
+                                          help="copy per-event CSV files into the store")
+    import_parser.add_argument('extract_type')
+    import_parser.add_argument('csv_dir', help="directory holding <type>_<zone>_<timestamp>_(X|y).csv files")
+
+    export_parser = subparsers.add_parser('export-csv', parents=[common],
+                                          help="write the combined feature matrix to a single CSV")
+    export_parser.add_argument('extract_type')
+    export_parser.add_argument('csv_file')
+    export_parser.add_argument('--zones', nargs='+', help="only export these zones")
+
+    info_parser = subparsers.add_parser('info', parents=[common], help="summarize the contents of the store")
+    info_parser.add_argument('extract_type')
+
+    args = parser.parse_args()
+
+    if args.command == 'import-csv':
+        n_events = import_csv(args.extract_type, args.csv_dir, args.store_dir)
+        print("Imported {} events".format(n_events))
+    elif args.command == 'export-csv':
+        load(args.extract_type, args.zones, store_dir=args.store_dir).to_csv(args.csv_file, index=False)
+    elif args.command == 'info':
+        segments = list_segments(args.extract_type, store_dir=args.store_dir)
+        events = set(row_key(row) for path, meta in segments for row in meta['rows'])
+        print("Segments: {}".format(len(segments)))
+        print("Events: {}".format(len(events)))
+        print("Feature columns: {}".format(len(list_columns(args.extract_type, store_dir=args.store_dir))))
+    else:
+        parser.print_usage()
+        exit(1)
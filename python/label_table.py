@@ -0,0 +1,116 @@
+import os
+import json
+import bisect
+
+# This module stores processed label files as a single indexed table instead of one small file per event (see
+# process.py --table).  A table is
+#   <table>      - a TSV with the usual label header followed by one label line per event, sorted by event key
+#   <table>.idx  - JSON holding the header, the number of events, and the first event key and byte offset of every
+#                  block of block_size lines
+# The event key of a line is <zone>_<timestamp>, the name its label file would have.  Looking up an event reads the
+# small index and a single block of the table, so the index stays small and cheap to load for every job even with
+# hundreds of thousands of events.
+#
+# A single event of a table is named <table>::<event key> wherever a label file can be given (extract.py, run.py,
+# worker.py, manifest.py).  Reading an entry gives exactly the contents of the label file it replaces, so manifest
+# records stay valid when switching between label files and a table.
+
+# Separates the table path from the event key in an entry name
+entry_separator = '::'
+
+# Number of lines per indexed block
+block_size = 256
+
+# Indexes read so far, by table path
+_indexes = {}
+
+
+# Build the identifier of the event a label line belongs to, <zone>_<timestamp>
+def event_key(line):
+    fields = line.split('\t')
+    zone = fields[0]
+    ts = fields[4].replace("/", "-").replace(" ", "_").replace(":", "")
+    return "{}_{}".format(zone, ts)
+
+
+# Path of the index of a table
+def index_path(table):
+    return table + '.idx'
+
+
+# True if path is a label table
+def is_table(path):
+    return os.path.isfile(path) and os.path.isfile(index_path(path))
+
+
+# Split an entry name into (table, event key), or return None if it does not name a table entry
+def split_entry(label_file):
+    if entry_separator not in label_file:
+        return None
+    table, key = label_file.rsplit(entry_separator, 1)
+    return table, key
+
+
+# Write a table.  rows is an iterable of (event key, label line) and header is the header line, both without the
+# trailing newline.  The table and its index are written under temporary names and renamed into place.  Returns the
+# number of events written.
+def write_table(table, header, rows):
+    rows = sorted(rows)
+    blocks = []
+    tmp = "{}.{}.tmp".format(table, os.getpid())
+    with open(tmp, 'wb') as fh:
+        fh.write((header + "\n").encode('utf-8'))
+        for i, (key, line) in enumerate(rows):
+            if i % block_size == 0:
+                blocks.append([key, fh.tell()])
+            fh.write((line + "\n").encode('utf-8'))
+        end = fh.tell()
+
+    with open(tmp + '.idx', 'w') as fh:
+        json.dump({'header': header, 'count': len(rows), 'end': end, 'blocks': blocks}, fh)
+    os.replace(tmp, table)
+    os.replace(tmp + '.idx', index_path(table))
+    _indexes.pop(table, None)
+    return len(rows)
+
+
+# Return the index of a table, reading it once per process
+def read_index(table):
+    if table not in _indexes:
+        with open(index_path(table), 'r') as fh:
+            index = json.load(fh)
+        index['keys'] = [key for key, offset in index['blocks']]
+        _indexes[table] = index
+    return _indexes[table]
+
+
+# Yield the (event key, label line) of every event in a table, in key order
+def iter_rows(table):
+    with open(table, 'r') as fh:
+        fh.readline()
+        for line in fh:
+            line = line.rstrip("\n")
+            yield event_key(line), line
+
+
+# The entry names of every event in a table, sorted by event key
+def entries(table):
+    return ["{}{}{}".format(table, entry_separator, key) for key, line in iter_rows(table)]
+
+
+# Return the contents of the label file of one event in a table (the header plus its label line), or None if the
+# table doesn't have the event
+def read_entry(table, key):
+    index = read_index(table)
+    i = bisect.bisect_right(index['keys'], key) - 1
+    if i < 0:
+        return None
+    start = index['blocks'][i][1]
+    end = index['blocks'][i + 1][1] if i + 1 < len(index['blocks']) else index['end']
+    with open(table, 'rb') as fh:
+        fh.seek(start)
+        block = fh.read(end - start).decode('utf-8')
+    for line in block.split("\n"):
+        if line and event_key(line) == key:
+            return index['header'] + "\n" + line + "\n"
+    return None
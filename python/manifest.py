@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import label_table
+
+# This module keeps track of what inputs each extraction was run on, so that re-runs only need to process events
+# that are new, changed, or missing output.  The manifest is a directory holding one small JSON record per
+# extraction type and event (<manifest_dir>/<type>_<zone>_<timestamp>.json), so parallel jobs never write to the
+# same file.  Each record holds three hashes:
+#   label_hash    - the contents of the processed label file
+#   capture_hash  - the name, size and mtime of every capture file in the event directory.  The files themselves
+#                   are not read since that would cost nearly as much as parsing them.
+#   settings_hash - the feature extraction settings (see extract.feature_settings)
+
+# Where this script currently lives
+python_dir = os.path.dirname(os.path.realpath(__file__))
+
+# The root of the rfw_tsf_extractor app
+app_dir = os.path.realpath(os.path.join(python_dir, '..'))
+
+# Default location of the manifest
+manifest_dir = os.path.join(app_dir, 'extracted', 'manifest')
+
+
+# Hash a JSON-able object.  Anything json doesn't know how to write (tuples inside sets, numpy values, etc.) is
+# written with repr.
+def hash_object(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+
+# Hash the contents of a label file.  Entries of a label table hash the same as the label file they replace.  Raises
+# extract.BadLabel if the entry is no longer in its table.
+def hash_label_file(label_file):
+    entry = label_table.split_entry(label_file)
+    if entry is not None:
+        contents = label_table.read_entry(*entry) if os.path.exists(entry[0]) else None
+        if contents is None:
+            # extract imports this module, so only pull it in when needed
+            import extract
+            raise extract.BadLabel("label table entry not found: {}".format(label_file))
+        return hashlib.sha1(contents.encode('utf-8')).hexdigest()
+    with open(label_file, 'rb') as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
+
+
+# Hash the name, size and mtime of the files of an event directory.  listing optionally gives the files (e.g., from the
+# event index) so the directory doesn't have to be read.  Only the names are taken from it: the files are always
+# stat'ed, since a capture file rewritten in place doesn't change the mtime of its directory and so isn't seen by the
+# index.
+def hash_capture_files(event_dir, listing=None):
+    names = [f[0] for f in listing] if listing is not None else os.listdir(event_dir)
+    files = []
+    for f in names:
+        stat = os.stat(os.path.join(event_dir, f))
+        files.append([f, stat.st_size, stat.st_mtime_ns])
+    return hash_object(sorted(files))
+
+
+# Path of the manifest record for an extraction
+def record_path(extract_type, zone, timestamp, manifest_dir=manifest_dir):
+    return os.path.join(manifest_dir, "{}_{}_{}.json".format(extract_type, zone, timestamp))
+
+
+# Return the manifest record of an extraction, or None if there isn't one
+def read_record(extract_type, zone, timestamp, manifest_dir=manifest_dir):
+    try:
+        with open(record_path(extract_type, zone, timestamp, manifest_dir), 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+# Write the manifest record of a finished extraction.  status is 'done' or 'skipped'.
+def write_record(extract_type, zone, timestamp, record, manifest_dir=manifest_dir):
+    os.makedirs(manifest_dir, exist_ok=True)
+    path = record_path(extract_type, zone, timestamp, manifest_dir)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as fh:
+        json.dump(record, fh, sort_keys=True, indent=1)
+    os.replace(tmp, path)
+
+
+# Build the record describing the inputs of an extraction.  label_file is None for unlabeled events (see watch.py),
+# which makes them stale once a label file is written for them.
+def make_record(label_file, event_dir, settings, status, outputs, listing=None):
+    return {'label_file': os.path.realpath(label_file) if label_file is not None else None,
+            'label_hash': hash_label_file(label_file) if label_file is not None else None,
+            'capture_hash': hash_capture_files(event_dir, listing),
+            'settings_hash': hash_object(settings),
+            'status': status,
+            'outputs': outputs}
+
+
+# Figure out whether an extraction needs to be run.  Returns None if the existing outputs are up to date, and
+# otherwise a short reason.  See hash_capture_files for listing.
+def stale_reason(record, label_file, event_dir, settings, listing=None):
+    if record is None:
+        return 'new'
+    if record['label_hash'] != hash_label_file(label_file):
+        return 'label_changed'
+    if record['capture_hash'] != hash_capture_files(event_dir, listing):
+        return 'capture_files_changed'
+    if record['settings_hash'] != hash_object(settings):
+        return 'settings_changed'
+    if not all(os.path.exists(f) for f in record['outputs']):
+        return 'output_missing'
+    return None
+
+
+# Decide which label files need to be extracted.  Returns a list of (label_file, reason) for every label file,
+# where reason is None for up to date extractions.  Label files that can't be planned (e.g., a missing event
+# directory or table entry, or an unreadable file) are returned with an 'error: ...' reason so that the extraction
+# job fails on them and the error shows up in the job log as it always has.  For extract_type 'both', a label file is
+# run if either extraction is out of date.
+def plan(extract_type, label_files, force=False):
+    # extract imports this module, so only pull it in when planning
+    import extract
+
+    extract_types = extract.valid_types if extract_type == 'both' else (extract_type,)
+    settings = {t: extract.feature_settings(t) for t in extract_types}
+    planned = []
+    for label_file in label_files:
+        if force:
+            reason = 'forced'
+        else:
+            try:
+                event = extract.read_label_file(label_file)
+                event_dir = extract.find_event_dir(event)
+                listing = extract.capture_listing(event_dir)
+                reason = None
+                for t in extract_types:
+                    record = read_record(t, event.zone, event.timestamp, extract.manifest_dir)
+                    reason = stale_reason(record, label_file, event_dir, settings[t], listing)
+                    if reason is not None:
+                        break
+            except (extract.ExtractionError, OSError) as ex:
+                reason = 'error: {}'.format(ex)
+        planned.append((label_file, reason))
+    return planned
+
+
+if __name__ == "__main__":
+    import extract
+    import feature_selection
+
+    parser = argparse.ArgumentParser(description="List the label files whose extraction is out of date.  Prints "
+                                                 "one label file per line, suitable for piping into parallel.")
+    subparsers = parser.add_subparsers(dest='command')
+    plan_parser = subparsers.add_parser('plan', help="list label files that need to be extracted")
+    plan_parser.add_argument('extract_type', help="one of {}".format(extract.run_types))
+    plan_parser.add_argument('label_files', nargs='+', metavar='label_file',
+                             help="processed label file(s) or directories of label files")
+    plan_parser.add_argument('--force', action='store_true', help="list every label file, ignoring the manifest")
+    plan_parser.add_argument('--index', action='store_true',
+                             help="find events through the index in waveform-data/index (see event_index.py)")
+    plan_parser.add_argument('--explain', action='store_true',
+                             help="dry run: also print why each label file would be run, and a summary")
+    plan_parser.add_argument('--mem-budget', type=float, metavar='MB',
+                             help="plan for extraction with this memory budget, which stores waveforms as float32 "
+                                  "(see chunked_features.py)")
+    plan_parser.add_argument('--window', type=float, nargs=2, metavar=('START', 'END'),
+                             help="plan for extraction from the samples from START to END ms (see windowing.py)")
+    plan_parser.add_argument('--decimate', type=int, default=1, metavar='Q',
+                             help="plan for extraction from every Q-th sample (default: %(default)s)")
+    plan_parser.add_argument('--features', metavar='SUBSET_FILE',
+                             help="plan for extraction of the features listed in this file (see "
+                                  "feature_selection.py)")
+    args = parser.parse_args()
+
+    if args.command != 'plan':
+        parser.print_usage()
+        exit(1)
+    if args.extract_type not in extract.run_types:
+        print("Error: invalid extraction type specified '{}'.  Valid options are {}".format(
+            args.extract_type, extract.run_types), file=sys.stderr)
+        exit(1)
+
+    extract.use_index = args.index
+    extract.memory_budget = args.mem_budget
+    extract.window = args.window
+    extract.decimation = args.decimate
+    if args.features is not None:
+        extract.feature_subset = feature_selection.read_feature_subset(args.features)
+    counts = {}
+    for label_file, reason in plan(args.extract_type, extract.expand_label_files(args.label_files), args.force):
+        key = reason.split(':')[0] if reason else 'up_to_date'
+        counts[key] = counts.get(key, 0) + 1
+        if reason is None:
+            continue
+        if args.explain:
+            print("{}\t{}".format(reason, label_file))
+        else:
+            print(label_file)
+
+    if args.explain:
+        print("", file=sys.stderr)
+        for reason in sorted(counts):
+            print("{}: {}".format(reason, counts[reason]), file=sys.stderr)
@@ -0,0 +1,133 @@
+import time
+import itertools
+import threading
+import collections
+import concurrent.futures
+
+# This module overlaps reading events with calculating features in batch mode (extract.py --prefetch).  Without it,
+# every event's capture files are read from shared storage one after the other, and only then does tsfresh start, so
+# the cores sit idle while NFS answers.  With it, a pool of reader threads loads the next events (label file, event
+# directory lookup, capture file parsing and assembly) while the main thread calculates the features of the current
+# ones.  The threads mostly wait on I/O, which releases the GIL, so they don't slow down the calculation much.
+#
+# The readers stay at most depth events ahead of the calculation, which bounds the memory held by loaded events that
+# are waiting their turn.  Events come out in the order they were given, whatever order the reads finish in.
+#
+# The queue is measured so a run shows what limits it:
+#   - stall time is how long the calculation waited for an event that wasn't loaded yet.  A large share of the run
+#     means it is I/O-bound: more readers, a deeper queue or the capture file cache (--cache) would help.
+#   - queue depth is the number of loaded events waiting when the calculation takes the next one.  A queue that stays
+#     full means the run is CPU-bound, and reading is completely hidden behind the calculation.
+
+# Default number of reader threads
+default_readers = 4
+
+# Share of the run spent stalled above which a run counts as I/O-bound, and below which it counts as CPU-bound
+io_bound_stall_share = 0.2
+cpu_bound_stall_share = 0.05
+
+# Mean share of the queue that is full above which a run counts as CPU-bound
+cpu_bound_queue_share = 0.5
+
+
+# Loads items on reader threads ahead of the consumer.  load(item) is called on a reader thread for every item, and
+# iterating yields (item, load(item)) in the order of items.  An exception raised by load is raised again when its
+# item is taken.  The metrics cover everything taken so far.
+class Prefetcher:
+    def __init__(self, load, items, depth, readers=default_readers):
+        self.load = load
+        self.items = items
+        self.depth = max(1, depth)
+        self.readers = max(1, readers)
+        self.n_taken = 0
+        self.n_stalls = 0
+        self.stall_s = 0.0
+        self.read_s = 0.0
+        self.wall_s = 0.0
+        self.queue_depths = []
+        self._lock = threading.Lock()
+
+    # Run load on a reader thread, adding up the time it took
+    def _timed_load(self, item):
+        start = time.perf_counter()
+        try:
+            return self.load(item)
+        finally:
+            with self._lock:
+                self.read_s += time.perf_counter() - start
+
+    def __iter__(self):
+        start = time.perf_counter()
+        upcoming = iter(self.items)
+        pending = collections.deque()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.readers)
+        try:
+            for item in itertools.islice(upcoming, self.depth):
+                pending.append((item, pool.submit(self._timed_load, item)))
+
+            while len(pending) > 0:
+                item, future = pending.popleft()
+                self.queue_depths.append(int(future.done()) + sum(1 for i, f in pending if f.done()))
+                if not future.done():
+                    stall_start = time.perf_counter()
+                    concurrent.futures.wait([future])
+                    self.stall_s += time.perf_counter() - stall_start
+                    self.n_stalls += 1
+
+                # Keep the readers depth events ahead
+                for next_item in itertools.islice(upcoming, 1):
+                    pending.append((next_item, pool.submit(self._timed_load, next_item)))
+
+                self.n_taken += 1
+                self.wall_s = time.perf_counter() - start
+                yield item, future.result()
+        finally:
+            # Don't read events that won't be taken (e.g., the consumer raised)
+            for item, future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+            self.wall_s = time.perf_counter() - start
+
+    # What limited the run so far: 'io-bound', 'cpu-bound' or 'balanced'
+    def bottleneck(self):
+        stall_share = self.stall_s / self.wall_s if self.wall_s > 0 else 0.0
+        if stall_share > io_bound_stall_share:
+            return 'io-bound'
+        if stall_share < cpu_bound_stall_share or (len(self.queue_depths) > 0 and sum(self.queue_depths) / float(
+                len(self.queue_depths)) >= cpu_bound_queue_share * self.depth):
+            return 'cpu-bound'
+        return 'balanced'
+
+    # The metrics as a dictionary
+    def metrics(self):
+        n = len(self.queue_depths)
+        return {'events': self.n_taken,
+                'depth': self.depth,
+                'readers': self.readers,
+                'wall_s': round(self.wall_s, 3),
+                'read_s': round(self.read_s, 3),
+                'stall_s': round(self.stall_s, 3),
+                'stalls': self.n_stalls,
+                'mean_queue_depth': round(sum(self.queue_depths) / float(n), 3) if n > 0 else 0.0,
+                'empty_queue_share': round(sum(1 for d in self.queue_depths if d == 0) / float(n), 3) if n > 0
+                else 0.0,
+                'bottleneck': self.bottleneck()}
+
+    def print_metrics(self):
+        m = self.metrics()
+        wall = m['wall_s'] if m['wall_s'] > 0 else 1.0
+        print("\n#### Prefetch: {} events, depth {}, {} readers ####\n".format(m['events'], m['depth'], m['readers']))
+        print("Wall time:          {:10.2f} s".format(m['wall_s']))
+        print("Reading:            {:10.2f} s  (readers busy {:.0%} of the time)".format(
+            m['read_s'], m['read_s'] / (wall * m['readers'])))
+        print("Stalled:            {:10.2f} s  ({:.0%} of the time, on {} events)".format(
+            m['stall_s'], m['stall_s'] / wall, m['stalls']))
+        print("Mean queue depth:   {:10.2f}    (empty {:.0%} of the time)".format(m['mean_queue_depth'],
+                                                                                m['empty_queue_share']))
+        if m['bottleneck'] == 'io-bound':
+            print("The run is I/O-bound: the calculation waited for reads.  More --readers, a deeper --prefetch or "
+                  "--cache would help.")
+        elif m['bottleneck'] == 'cpu-bound':
+            print("The run is CPU-bound: reading was hidden behind the calculation.")
+        else:
+            print("The run is balanced between reading and calculation.")
@@ -0,0 +1,338 @@
+import os
+import sys
+import json
+import time
+import socket
+import inspect
+import resource
+import threading
+import argparse
+import functools
+import contextlib
+
+from tsfresh.feature_extraction import feature_calculators
+
+import fast_features
+
+# This module records where the time of extraction jobs goes.  When enabled (extract.py, run.py and worker.py
+# --profile), every extraction appends one JSON line to the profile file with
+#   - the wall time, CPU time and peak RSS of each stage of the job (reading the label, finding the event, parsing
+#     capture files, assembling DataFrames, calculating features, imputing, writing results and the manifest).  Stages
+#     can be nested, e.g., parse runs inside assemble, and each stage only counts its own time, not that of the stages
+#     inside it.
+#   - the number of calls, wall time, CPU time and peak RSS growth of each feature calculator, both tsfresh's and the
+#     vectorized ones of fast_features.py.  Calculators are timed by wrapping the functions tsfresh looks up by name,
+#     so they are only seen when tsfresh runs them in this process (n_jobs 0 or 1).  Like nested stages, their time
+#     is left out of the stage they run in, so the calculate stage is the overhead of tsfresh itself.
+# A line covers a single event, or the chunk of events that shared one extract_features call in batch mode.  Peak RSS
+# is the high water mark of the process, so "growth" is how much a stage or calculator raised it.
+# With prefetching (extract.py --prefetch), events are loaded on reader threads, and their stages go into the record
+# of the chunk being calculated at the time.  CPU time is that of the whole process, so the stages that run on reader
+# threads also count the CPU used by the calculation meanwhile.
+#
+# The report command ranks calculators and stages across any number of profile files, e.g.,
+#   > python python/profiling.py report log/cavity_<timestamp>
+
+# Whether profiling is on, and the file records are appended to
+enabled = False
+profile_file = None
+
+# Accumulated [calls, wall, cpu, rss growth] by stage and calculator name since the last record was written
+_stages = {}
+_calculators = {}
+
+# Stack of [child wall, child cpu] of the stages currently running on each thread, so that a stage can leave out the
+# time of the stages inside it
+_local = threading.local()
+
+# Guards the totals, which reader threads add to while prefetching
+_lock = threading.Lock()
+
+# Start of the current record
+_record_start = None
+
+
+# Peak RSS of this process in MB.  ru_maxrss is in KB on Linux.
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# The stage stack of the current thread
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _add(totals, name, wall, cpu, rss_growth):
+    with _lock:
+        entry = totals.setdefault(name, [0, 0.0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += wall
+        entry[2] += cpu
+        entry[3] += rss_growth
+
+
+# Wrap a feature calculator so that its calls are timed while profiling is enabled.  functools.wraps copies the
+# attributes tsfresh looks at (fctype, input, ...), and the signature is copied as well since tsfresh's settings pick
+# the calculators without parameters by their argument list.
+def _timed_calculator(name, func):
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        start_rss = peak_rss_mb()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            stack = _stack()
+            if len(stack) > 0:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+            _add(_calculators, name, wall, cpu, peak_rss_mb() - start_rss)
+    timed.__signature__ = inspect.signature(func)
+    timed.profiled = True
+    return timed
+
+
+# Replace the tsfresh and fast_features calculators with timed versions (only once per process)
+def _install_calculator_wrappers():
+    for name in dir(feature_calculators):
+        func = getattr(feature_calculators, name)
+        if callable(func) and hasattr(func, 'fctype') and not getattr(func, 'profiled', False):
+            setattr(feature_calculators, name, _timed_calculator(name, func))
+    for name, func in fast_features.fast_calculators.items():
+        if not getattr(func, 'profiled', False):
+            fast_features.fast_calculators[name] = _timed_calculator(name, func)
+
+
+# Turn on profiling, appending records to path
+def enable(path):
+    global enabled, profile_file, _record_start
+    _install_calculator_wrappers()
+    profile_file = os.path.realpath(path)
+    enabled = True
+    _record_start = (time.perf_counter(), time.process_time(), peak_rss_mb())
+
+
+# Time a stage of a job
+@contextlib.contextmanager
+def stage(name):
+    if not enabled:
+        yield
+        return
+    stack = _stack()
+    children = [0.0, 0.0]
+    stack.append(children)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    start_rss = peak_rss_mb()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1][0] += wall
+            stack[-1][1] += cpu
+        _add(_stages, name, wall - children[0], cpu - children[1], peak_rss_mb() - start_rss)
+
+
+# Decorator timing every call of a function as a stage
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# The number of tsfresh processes to use.  Calculators can only be timed when tsfresh runs them in this process, which
+# it does for n_jobs 0.  A single tsfresh process does the same work as running in this one, so use that instead.
+def tsfresh_jobs(n_jobs):
+    if enabled and n_jobs == 1:
+        return 0
+    return n_jobs
+
+
+def _totals(totals):
+    return {name: {'calls': calls, 'wall_s': round(wall, 6), 'cpu_s': round(cpu, 6),
+                   'rss_growth_mb': round(rss_growth, 3)}
+            for name, (calls, wall, cpu, rss_growth) in sorted(totals.items())}
+
+
+# Collect the stages and calculators of one extraction (a single event, or a chunk of events in batch mode) and append
+# them to the profile file as a JSON line.  fields describe the job (extraction type, events, ...).  If the block
+# raises, the record notes the exception.
+@contextlib.contextmanager
+def record(**fields):
+    global _record_start
+    if not enabled:
+        yield
+        return
+    with _lock:
+        _stages.clear()
+        _calculators.clear()
+    _record_start = (time.perf_counter(), time.process_time(), peak_rss_mb())
+    try:
+        yield
+    except BaseException as ex:
+        fields['exception'] = type(ex).__name__
+        raise
+    finally:
+        write_record(fields)
+
+
+# Append a record with everything accumulated since the last one
+def write_record(fields):
+    global _record_start
+    start_wall, start_cpu, start_rss = _record_start
+    with _lock:
+        stages = _totals(_stages)
+        calculators = _totals(_calculators)
+        _stages.clear()
+        _calculators.clear()
+    line = dict(fields)
+    line.update({'written': time.strftime("%Y-%m-%d %H:%M:%S"),
+                 'host': socket.gethostname(),
+                 'pid': os.getpid(),
+                 'wall_s': round(time.perf_counter() - start_wall, 6),
+                 'cpu_s': round(time.process_time() - start_cpu, 6),
+                 'peak_rss_mb': round(peak_rss_mb(), 3),
+                 'rss_growth_mb': round(peak_rss_mb() - start_rss, 3),
+                 'stages': stages,
+                 'calculators': calculators})
+
+    # A single write to a file opened for appending, so jobs running at the same time don't mix their lines
+    fd = os.open(profile_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(line, sort_keys=True) + "\n").encode('utf-8'))
+    finally:
+        os.close(fd)
+    _record_start = (time.perf_counter(), time.process_time(), peak_rss_mb())
+
+
+# Yield every record in the given profile files and directories (searched for *.jsonl files)
+def read_records(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.extend(os.path.join(root, n) for n in sorted(names) if n.endswith('.jsonl'))
+        else:
+            files.append(path)
+    for path in files:
+        with open(path, 'r') as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A job killed while writing leaves a partial line
+                    print("Warning: skipping bad line in {}".format(path), file=sys.stderr)
+
+
+# Sum the stages and calculators of many records.  Returns (number of records, number of events, stage totals,
+# calculator totals, job totals), where totals map names to [calls, wall, cpu, max rss growth].
+def aggregate(records, extract_type=None):
+    n_records = 0
+    n_events = 0
+    stages = {}
+    calculators = {}
+    jobs = [0, 0.0, 0.0, 0.0]
+    for r in records:
+        if extract_type is not None and r.get('extract_type') != extract_type:
+            continue
+        n_records += 1
+        n_events += r.get('n_events', 1)
+        for totals, part in ((stages, r['stages']), (calculators, r['calculators'])):
+            for name, values in part.items():
+                entry = totals.setdefault(name, [0, 0.0, 0.0, 0.0])
+                entry[0] += values['calls']
+                entry[1] += values['wall_s']
+                entry[2] += values['cpu_s']
+                entry[3] = max(entry[3], values['rss_growth_mb'])
+        jobs[0] += 1
+        jobs[1] += r['wall_s']
+        jobs[2] += r['cpu_s']
+        jobs[3] = max(jobs[3], r['peak_rss_mb'])
+    return n_records, n_events, stages, calculators, jobs
+
+
+# Print a table of totals ranked by wall time, with each row's share of total_wall and the running share
+def print_ranking(title, totals, total_wall, n_events, top=None):
+    print(title)
+    fmt = "{:>4}  {:<45} {:>10} {:>10} {:>10} {:>7} {:>7} {:>12} {:>12}"
+    print(fmt.format("rank", "name", "calls", "wall_s", "cpu_s", "share", "cum", "ms/event", "rss_grow_mb"))
+    ranked = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)
+    cumulative = 0.0
+    for rank, (name, (calls, wall, cpu, rss_growth)) in enumerate(ranked[:top] if top else ranked, start=1):
+        share = wall / total_wall if total_wall > 0 else 0.0
+        cumulative += share
+        print(fmt.format(rank, name, calls, "{:.3f}".format(wall), "{:.3f}".format(cpu),
+                         "{:.1%}".format(share), "{:.1%}".format(cumulative),
+                         "{:.2f}".format(1000 * wall / max(n_events, 1)), "{:.1f}".format(rss_growth)))
+    print("")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize extraction profiles written with --profile.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    report_parser = subparsers.add_parser('report', help="rank the most expensive stages and feature calculators")
+    report_parser.add_argument('paths', nargs='+', metavar='path',
+                               help="profile file(s), or directories searched for *.jsonl files")
+    report_parser.add_argument('--type', dest='extract_type', default=None,
+                               help="only include records of this extraction type")
+    report_parser.add_argument('--top', type=int, default=None, help="only list the top N calculators")
+    report_parser.add_argument('--json', action='store_true', help="print the totals as JSON instead of tables")
+
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        for path in args.paths:
+            if not os.path.exists(path):
+                print("Error: profile not found '{}'".format(path))
+                exit(1)
+        n_records, n_events, stages, calculators, jobs = aggregate(read_records(args.paths), args.extract_type)
+        if n_records == 0:
+            print("Error: no profile records found")
+            exit(1)
+
+        if args.json:
+            names = ('calls', 'wall_s', 'cpu_s', 'rss_growth_mb')
+            print(json.dumps({'records': n_records, 'events': n_events,
+                              'wall_s': jobs[1], 'cpu_s': jobs[2], 'peak_rss_mb': jobs[3],
+                              'stages': {k: dict(zip(names, v)) for k, v in stages.items()},
+                              'calculators': {k: dict(zip(names, v)) for k, v in calculators.items()}},
+                             indent=2, sort_keys=True))
+            exit()
+
+        calculator_wall = sum(v[1] for v in calculators.values())
+        print("{} records, {} events, {:.1f}s wall, {:.1f}s CPU, max peak RSS {:.0f} MB".format(
+            n_records, n_events, jobs[1], jobs[2], jobs[3]))
+        print("Feature calculators: {:.1f}s of the {:.1f}s spent calculating features".format(
+            calculator_wall, stages.get('calculate', [0, 0.0])[1] + calculator_wall))
+        print("")
+        # Time not in any stage is the job's own overhead (imports are not included)
+        stages['(other)'] = [n_records, max(0.0, jobs[1] - sum(v[1] for v in stages.values()) - calculator_wall),
+                             max(0.0, jobs[2] - sum(v[2] for v in stages.values()) - sum(v[2] for v in
+                                                                                        calculators.values())),
+                             0.0]
+        stages['(calculators)'] = [sum(v[0] for v in calculators.values()), calculator_wall,
+                                   sum(v[2] for v in calculators.values()),
+                                   max([v[3] for v in calculators.values()] + [0.0])]
+        print_ranking("Stages (own time, without nested stages or calculators)", stages, jobs[1], n_events)
+        print_ranking("Feature calculators", calculators, calculator_wall, n_events, args.top)
+    else:
+        parser.print_usage()
+        exit(1)
@@ -0,0 +1,412 @@
+import os
+import sys
+import time
+import signal
+import argparse
+import contextlib
+import traceback
+import concurrent.futures
+
+import psutil
+
+# Importing extract pulls in pandas and tsfresh.  The pool's worker processes are forked after this import so each one
+# starts warm.
+import extract
+import manifest
+import profiling
+import feature_cache
+import windowing
+import run_state
+import event_index
+import feature_selection
+
+# This script runs extraction jobs on a local process pool, as an alternative to the GNU parallel + ssh scripts for a
+# single large host.  Each processed label file is one job, and jobs are
+#   - planned with the manifest, so only new or changed events are run (unless --force).  Events whose directory is
+#     missing or ambiguous are all reported before anything is started, and are not run.
+#   - started longest first, using the size of the event's capture files as the estimate of its run time, so that
+#     big events don't end up running alone at the end,
+#   - stopped after --timeout seconds,
+#   - retried up to --retries times if they fail for a cause that may not happen again (a timeout, a worker that
+#     died or an I/O error, see run_state.transient_causes).  Other failures, e.g., a missing capture file, would
+#     only fail the same way again.
+# Every attempt is written to a joblog in the same format as GNU parallel's --joblog.  Each job's output goes to its
+# own log file, named as with bin/do_*_extraction.bash.  With --profile, every job also appends its stage and feature
+# calculator timings to a profile file in the log directory (see profiling.py).
+#
+# The status of every event (pending, running, done, skipped or failed, with the cause of the failure) is kept in a
+# state file in the log directory (see run_state.py), and outputs are written under a temporary name and renamed into
+# place, so a run whose host died can be picked up with
+#   run.py resume <log dir> [--retry-failed] [options]
+# which runs the events that didn't finish, and those that failed for a transient cause (e.g., a timeout), with the
+# options of the original run plus any given.  The run ends with a summary of the failures grouped by cause.
+
+# Where this script currently lives
+python_dir = os.path.dirname(os.path.realpath(__file__))
+
+# The root of the rfw_tsf_extractor app
+app_dir = os.path.realpath(os.path.join(python_dir, '..'))
+
+# Prefix of the per-job log files, matching bin/do_*_extraction.bash
+log_prefixes = {'cavity': 'cav', 'trip': 'trip', 'both': 'both'}
+
+# Exit values written to the joblog
+exit_ok = 0
+exit_failed = 1
+
+
+# Raised inside a job that has run longer than its timeout
+class JobTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise JobTimeout()
+
+
+# Number of worker processes to use: one per available core, limited so that each worker has mem_per_job bytes of
+# the currently available memory
+def pool_size(mem_per_job):
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    if mem_per_job <= 0:
+        return cores
+    return max(1, min(cores, int(psutil.virtual_memory().available // mem_per_job)))
+
+
+# Estimate the relative run time of a job by the total size of the event's capture files.  Events whose directory
+# can't be found get 0, which puts them last (they fail quickly anyway).
+def estimate_cost(label_file):
+    try:
+        event_dir = extract.find_event_dir(extract.read_label_file(label_file))
+        return sum(os.path.getsize(os.path.join(event_dir, f)) for f in os.listdir(event_dir))
+    except (extract.ExtractionError, OSError, KeyError, ValueError):
+        return 0
+
+
+# The command line that runs the same job by hand (or through parallel --retry-failed) as written to the joblog
+def job_command(label_file, extract_type):
+    return "{} {} {} {}".format(sys.executable, os.path.join(python_dir, 'extract.py'), label_file, extract_type)
+
+
+# Run a single extraction job in a worker process.  settings holds the extract module settings, which are set here
+# so that they don't depend on the pool forking the parent.  profile_file is where to write the job's profile, or None.
+# Returns (exit value, signal, status, cause of a failure, message).
+def run_job(label_file, extract_type, settings, timeout, log_file, profile_file=None):
+    for name, value in settings.items():
+        setattr(extract, name, value)
+    if profile_file is not None and profiling.profile_file != profile_file:
+        profiling.enable(profile_file)
+
+    with open(log_file, 'a') as fh, contextlib.redirect_stdout(fh), contextlib.redirect_stderr(fh):
+        if timeout > 0:
+            signal.signal(signal.SIGALRM, _raise_timeout)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            extract.extract_event(label_file, extract_type, n_jobs=settings['tsf_jobs'],
+                                  engine=settings['default_engine'])
+            print("Completed {} feature extraction".format(extract_type))
+            return exit_ok, 0, 'done', None, None
+        except extract.SkipEvent as ex:
+            print(ex)
+            return exit_ok, 0, 'skipped', None, str(ex)
+        except JobTimeout:
+            message = "timed out after {} seconds".format(timeout)
+            print("Error: {}".format(message))
+            return exit_failed, signal.SIGALRM, 'timeout', 'timeout', message
+        except extract.ExtractionError as ex:
+            print("Error: {}".format(ex))
+            return exit_failed, 0, 'failed', ex.cause, str(ex)
+        except OSError as ex:
+            traceback.print_exc()
+            return exit_failed, 0, 'failed', 'io_error', "{}: {}".format(type(ex).__name__, ex)
+        except Exception as ex:
+            traceback.print_exc()
+            return exit_failed, 0, 'failed', 'error', "{}: {}".format(type(ex).__name__, ex)
+        finally:
+            if timeout > 0:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+# Append a line to a GNU parallel style joblog
+def write_joblog_line(fh, seq, start, runtime, exitval, signum, command):
+    fh.write("{}\t{}\t{:.3f}\t{:10.3f}\t{}\t{}\t{}\t{}\t{}\n".format(seq, ':', start, runtime, 0, 0, exitval, signum,
+                                                                 command))
+    fh.flush()
+
+
+# Look up the event directory of a label file.  Returns the ExtractionError that the lookup raised, or None.  An I/O
+# error may not happen again, so the event is left to its job, which records it as a transient io_error.
+def lookup_error(label_file):
+    try:
+        extract.find_event_dir(extract.read_label_file(label_file))
+    except extract.ExtractionError as ex:
+        return ex
+    except OSError:
+        return None
+    return None
+
+
+# Run all jobs on a pool of n_workers processes, recording the status of every event in state.  Returns the list of
+# label files that still failed after retries.  The joblog is appended to, so a resumed run keeps a single joblog.
+def run_jobs(label_files, extract_type, n_workers, settings, timeout, retries, log_dir, job_log, state,
+             profile_file=None):
+    state.set_many(label_files, 'pending')
+    costs = {label_file: estimate_cost(label_file) for label_file in label_files}
+    queue = sorted(label_files, key=lambda f: costs[f], reverse=True)
+    attempts = {label_file: 0 for label_file in label_files}
+    failed = []
+    n_done = 0
+    seq = 0
+
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers)
+    with open(job_log, 'a') as log_fh:
+        if log_fh.tell() == 0:
+            log_fh.write("Seq\tHost\tStarttime\tJobRuntime\tSend\tReceive\tExitval\tSignal\tCommand\n")
+        else:
+            # Carry on numbering from the last line of the joblog
+            with open(job_log, 'r') as fh:
+                seq = sum(1 for line in fh) - 1
+        running = {}
+
+        while len(queue) > 0 or len(running) > 0:
+            # Keep only as many jobs in the pool as there are workers, so a retried job goes ahead of the smaller
+            # jobs still waiting.  Jobs that failed for a transient cause are retried as soon as they come back.
+            while len(queue) > 0 and len(running) < n_workers:
+                label_file = queue.pop(0)
+                seq += 1
+                attempts[label_file] += 1
+                log_file = os.path.join(log_dir, "{}.{}.log".format(log_prefixes[extract_type],
+                                                                    os.path.basename(label_file)))
+                future = pool.submit(run_job, label_file, extract_type, settings, timeout, log_file, profile_file)
+                running[future] = (seq, label_file, time.time(), pool)
+                state.set(label_file, 'running', attempt=attempts[label_file])
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                seq_no, label_file, start, job_pool = running.pop(future)
+                try:
+                    exitval, signum, status, cause, message = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    # A worker process died (e.g., killed for running out of memory), which takes the pool down with
+                    # it.  Every job that was running fails and is retried on a new pool.
+                    exitval, signum, status, cause, message = exit_failed, 0, 'failed', 'worker_died', \
+                        "worker process died"
+                    if job_pool is pool:
+                        pool.shutdown(wait=False)
+                        pool = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers)
+                runtime = time.time() - start
+                write_joblog_line(log_fh, seq_no, start, runtime, exitval, signum,
+                                  job_command(label_file, extract_type))
+
+                if exitval != exit_ok:
+                    state.fail(label_file, cause, message, attempt=attempts[label_file])
+                    status = "failed ({})".format(cause)
+                else:
+                    state.set(label_file, status, attempt=attempts[label_file])
+
+                if exitval != exit_ok and cause in run_state.transient_causes and attempts[label_file] <= retries:
+                    status += ", retrying"
+                    queue.insert(0, label_file)
+                elif exitval != exit_ok:
+                    failed.append(label_file)
+                    n_done += 1
+                else:
+                    n_done += 1
+                print("[{}/{}] {}\t{}\t{:.1f}s".format(n_done, len(label_files), status, label_file, runtime),
+                      flush=True)
+
+    pool.shutdown()
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run feature extraction jobs on a local process pool.  Only events "
+                                                 "that need it are run (see manifest.py).  'run.py resume <log dir>' "
+                                                 "picks up a run that didn't finish.")
+    parser.add_argument('extract_type', help="one of {}".format(extract.run_types))
+    parser.add_argument('label_files', nargs='*', metavar='label_file',
+                        help="processed label file(s), label tables or directories of label files (default: {} "
+                             "if it exists, else {})".format(extract.label_table_file, extract.label_dir))
+    parser.add_argument('--force', action='store_true', help="run every event, ignoring the manifest")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="list the events that would be run, and why, without running anything")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of worker processes (default: one per core, limited by --mem-per-job or "
+                             "--mem-budget)")
+    parser.add_argument('--mem-per-job', type=float, default=2.0,
+                        help="GB of memory to allow each worker when sizing the pool, 0 for no limit "
+                             "(default: %(default)s)")
+    parser.add_argument('--timeout', type=float, default=0,
+                        help="seconds before a job is stopped, 0 for no limit (default: %(default)s)")
+    parser.add_argument('--retries', type=int, default=1,
+                        help="number of times to retry a job that failed for a transient cause (timeout, worker "
+                             "died or I/O error) (default: %(default)s)")
+    parser.add_argument('--log-dir', default=None,
+                        help="directory for the joblog and job logs (default: log/<type>_<timestamp>)")
+    parser.add_argument('--n-jobs', type=int, default=extract.tsf_jobs,
+                        help="number of tsfresh processes per job (default: %(default)s)")
+    parser.add_argument('--engine', choices=sorted(extract.feature_engines), default=extract.default_engine,
+                        help="feature calculation engine (default: %(default)s)")
+    parser.add_argument('--cache', action='store_true',
+                        help="read capture files through the binary cache in waveform-data/cache")
+    parser.add_argument('--index', action='store_true',
+                        help="refresh the index in waveform-data/index and find events through it (see "
+                             "event_index.py)")
+    parser.add_argument('--output', choices=extract.output_backends, default=extract.output_backend,
+                        help="write per-event CSV files or append to the feature store (default: %(default)s)")
+    parser.add_argument('--features', metavar='SUBSET_FILE',
+                        help="only extract the features listed in this file (see feature_selection.py)")
+    parser.add_argument('--profile', action='store_true',
+                        help="write the time and memory used by each stage and feature calculator of every job to "
+                             "<log dir>/<type>_<timestamp>_profile.jsonl (see profiling.py)")
+    parser.add_argument('--mem-budget', type=float, default=None, metavar='MB',
+                        help="keep each job under this many MB of resident memory (see chunked_features.py), and "
+                             "size the pool by it instead of --mem-per-job")
+    parser.add_argument('--window', type=float, nargs=2, metavar=('START', 'END'),
+                        help="only use the samples from START to END ms around the fault (see windowing.py)")
+    parser.add_argument('--decimate', type=int, default=extract.decimation, metavar='Q',
+                        help="use every Q-th sample after an anti-aliasing filter (default: %(default)s)")
+    parser.add_argument('--feature-cache', nargs='?', const=feature_cache.cache_dir, metavar='CACHE_DIR',
+                        help="only calculate the features that are not in the feature cache, and add them to it "
+                             "(default cache: {}, see feature_cache.py)".format(feature_cache.cache_dir))
+    parser.add_argument('--feature-cache-local', metavar='LOCAL_DIR',
+                        help="keep a copy of the feature cache entries used in this directory on local disk, "
+                             "in front of the shared --feature-cache")
+    parser.add_argument('--feature-cache-size', type=float, metavar='GB',
+                        help="when done, remove the least recently used feature cache entries until each cache "
+                             "directory is under this size")
+
+    # A resumed run is parsed with the arguments of the original run, plus any options given to resume
+    argv = sys.argv[1:]
+    state_file = None
+    if len(argv) > 0 and argv[0] == 'resume':
+        resume_parser = argparse.ArgumentParser(
+            prog="run.py resume", usage="%(prog)s [--retry-failed] <log_dir|state_file> [run.py options]",
+            description="Run the events of an earlier run that didn't finish, or failed for a transient cause, with "
+                        "the options of that run.  Any other run.py options given override them.")
+        resume_parser.add_argument('state', help="log directory of the run, or its state file")
+        resume_parser.add_argument('--retry-failed', action='store_true',
+                                   help="also run the events that failed for a cause that isn't transient")
+        resume_args, overrides = resume_parser.parse_known_args(argv[1:])
+        state_file = run_state.find_state_file(resume_args.state)
+        if state_file is None:
+            print("Error: no state file found at '{}'".format(resume_args.state))
+            exit(1)
+        header, events = run_state.read(state_file)
+        if header is None:
+            print("Error: '{}' is not the state file of a run".format(state_file))
+            exit(1)
+        argv = header['argv'] + overrides
+    args = parser.parse_args(argv)
+
+    extract_type = args.extract_type
+    if extract_type not in extract.run_types:
+        print("Error: invalid extraction type specified '{}'.  Valid options are {}".format(extract_type,
+                                                                                          extract.run_types))
+        exit(1)
+
+    settings = {'use_cache': args.cache,
+                'use_index': args.index,
+                'output_backend': args.output,
+                'feature_subset': None,
+                'tsf_jobs': args.n_jobs,
+                'default_engine': args.engine,
+                'memory_budget': args.mem_budget,
+                'window': args.window,
+                'decimation': args.decimate,
+                'feature_cache_dirs': None}
+    message = windowing.check_settings(args.window, args.decimate)
+    if message is not None:
+        print("Error: {}".format(message))
+        exit(1)
+    if args.feature_cache is not None:
+        settings['feature_cache_dirs'] = feature_cache.tiers(args.feature_cache, args.feature_cache_local)
+    if args.features is not None:
+        settings['feature_subset'] = feature_selection.read_feature_subset(args.features)
+    for name, value in settings.items():
+        setattr(extract, name, value)
+
+    if args.index:
+        n_events, n_listed = event_index.refresh()
+        print("Indexed {} events ({} directories listed)".format(n_events, n_listed), flush=True)
+
+    now = time.strftime("%Y-%m-%d_%H:%M:%S")
+    if state_file is not None:
+        # The events to run come from the state file instead of the manifest, and the run keeps its log directory
+        todo = run_state.unfinished(events, resume_args.retry_failed)
+        errors = []
+        if args.dry_run:
+            for label_file in todo:
+                print("{}\t{}".format(events[label_file]['status'], label_file))
+            exit()
+        log_dir = os.path.dirname(os.path.realpath(state_file))
+        job_log = header['job_log']
+        profile_file = header.get('profile_file')
+        if args.profile and profile_file is None:
+            profile_file = os.path.join(log_dir, "{}_{}_profile.jsonl".format(extract_type, now))
+        n_events = len(events)
+        state = run_state.reopen(state_file, sys.argv[1:])
+        print("Resuming the run in {}".format(log_dir), flush=True)
+    else:
+        label_files = extract.expand_label_files(args.label_files if len(args.label_files) > 0 else
+                                                 [extract.default_labels()])
+        planned = manifest.plan(extract_type, label_files, force=args.force)
+        if args.dry_run:
+            for label_file, reason in planned:
+                if reason is not None:
+                    print("{}\t{}".format(reason, label_file))
+            exit()
+
+        # --force skips the lookups done by planning, so look up every event here to find the broken ones.  Planning
+        # only keeps the message of an error, so the lookup is also redone to find its cause.
+        errors = []
+        todo = []
+        for label_file, reason in planned:
+            if reason == 'forced' or (reason is not None and reason.startswith('error: ')):
+                error = lookup_error(label_file)
+                if error is not None:
+                    errors.append((label_file, error))
+                    continue
+            if reason is not None:
+                todo.append(label_file)
+        for label_file, error in errors:
+            print("Error: {}: {}".format(label_file, error))
+        if len(errors) > 0:
+            print("Not running {} events that can't be matched to their capture files".format(len(errors)),
+                  flush=True)
+
+        log_dir = args.log_dir
+        if log_dir is None:
+            log_dir = os.path.join(app_dir, 'log', "{}_{}".format(extract_type, now))
+        os.makedirs(log_dir, exist_ok=True)
+        job_log = os.path.join(log_dir, "{}_{}_jobs.log".format(extract_type, now))
+        profile_file = os.path.join(log_dir, "{}_{}_profile.jsonl".format(extract_type, now)) if args.profile \
+            else None
+        n_events = len(label_files)
+
+        state_file = os.path.join(log_dir, "{}_{}_state.jsonl".format(extract_type, now))
+        state = run_state.create(state_file, sys.argv[1:], extract_type, job_log=job_log, profile_file=profile_file)
+        state.set_many([label_file for label_file, reason in planned if reason is None], 'skipped',
+                       reason='up to date')
+        for label_file, error in errors:
+            state.fail(label_file, error.cause, str(error))
+
+    mem_per_job = args.mem_per_job * 2**30 if args.mem_budget is None else args.mem_budget * 2**20
+    n_workers = args.workers if args.workers is not None else pool_size(mem_per_job)
+    print("Running {} of {} {} jobs on {} workers, joblog in {}".format(len(todo), n_events, extract_type, n_workers,
+                                                                       job_log), flush=True)
+
+    failed = run_jobs(todo, extract_type, n_workers, settings, args.timeout, args.retries, log_dir, job_log, state,
+                      profile_file=profile_file)
+    state.close()
+    print("Completed {} feature extraction for {} of {} events".format(extract_type, len(todo) - len(failed),
+                                                                       len(todo) + len(errors)))
+    if settings['feature_cache_dirs'] is not None and args.feature_cache_size is not None:
+        feature_cache.prune_tiers(settings['feature_cache_dirs'], args.feature_cache_size * 2**30)
+
+    # Summarize the whole run, including the events run before it was resumed
+    header, events = run_state.read(state_file)
+    run_state.print_summary(events)
+    print("State file: {}".format(state_file))
+    if run_state.count_statuses(events)['failed'] > 0:
+        exit(1)
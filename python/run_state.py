@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import socket
+import argparse
+
+# This module keeps the state of an extraction run by run.py, so that a run whose host died can be resumed and the
+# failures of a run can be summarized without reading job logs.  The state file,
+# <log dir>/<type>_<timestamp>_state.jsonl, is a journal with one JSON line per change:
+#   {"run": {...}}                  - first line: the run.py arguments, log files and start time
+#   {"resume": {...}}               - each time the run is resumed
+#   {"label_file": ..., "status": ..., "time": ...}
+#                                   - an event's new status: pending, running (with its attempt), done, skipped or
+#                                     failed (with the cause, the error message and whether it is transient)
+# Every line is flushed and fsync'ed as it is written, so the file survives the host going down, and the last line of
+# each event is its status.  A line cut short by a crash is ignored when reading.
+#
+# Failures have a cause, so they can be grouped: the cause of an extract.ExtractionError (bad_label,
+# missing_capture_file, duplicate_cavity, ...), or timeout, worker_died, io_error or error for anything else.
+# Transient causes are the ones that may not happen again, and are retried by run.py resume.
+
+# Every status an event can have
+statuses = ('pending', 'running', 'done', 'skipped', 'failed')
+
+# Causes of failures that may go away when the event is run again
+transient_causes = ('timeout', 'worker_died', 'io_error')
+
+
+# Appends status changes to a state file
+class RunState:
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'a')
+
+    def write(self, record):
+        self.fh.write(json.dumps(record) + "\n")
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    # Record a new status for an event, with any other fields (attempt, cause, error, ...)
+    def set(self, label_file, status, **fields):
+        record = {'label_file': label_file, 'status': status, 'time': time.time()}
+        record.update(fields)
+        self.write(record)
+
+    # Record the same status for many events at once, with a single sync
+    def set_many(self, label_files, status, **fields):
+        now = time.time()
+        for label_file in label_files:
+            record = {'label_file': label_file, 'status': status, 'time': now}
+            record.update(fields)
+            self.fh.write(json.dumps(record) + "\n")
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    # Record a failure.  cause is one of the causes above.
+    def fail(self, label_file, cause, error, **fields):
+        self.set(label_file, 'failed', cause=cause, error=error, transient=cause in transient_causes, **fields)
+
+    def close(self):
+        self.fh.close()
+
+
+# Start the state file of a new run
+def create(path, argv, extract_type, **fields):
+    state = RunState(path)
+    run = {'argv': list(argv), 'extract_type': extract_type, 'host': socket.gethostname(), 'started': time.time()}
+    run.update(fields)
+    state.write({'run': run})
+    return state
+
+
+# Reopen the state file of a run to resume it
+def reopen(path, argv):
+    state = RunState(path)
+    state.write({'resume': {'argv': list(argv), 'host': socket.gethostname(), 'time': time.time()}})
+    return state
+
+
+# Find the state file of a run given the file itself or the run's log directory
+def find_state_file(path):
+    if os.path.isdir(path):
+        state_files = sorted(f for f in os.listdir(path) if f.endswith('_state.jsonl'))
+        if len(state_files) != 1:
+            return None
+        return os.path.join(path, state_files[0])
+    return path if os.path.isfile(path) else None
+
+
+# Read a state file.  Returns the run's header and the last record of every event, in the order events first appear.
+def read(path):
+    header = None
+    events = {}
+    with open(path, 'r') as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'run' in record:
+                header = record['run']
+            elif 'label_file' in record:
+                events[record['label_file']] = record
+    return header, events
+
+
+# The label files that a resumed run should run: everything that didn't finish, and failures with a transient cause
+# (or every failure if retry_failed)
+def unfinished(events, retry_failed=False):
+    todo = []
+    for label_file, record in events.items():
+        if record['status'] in ('pending', 'running'):
+            todo.append(label_file)
+        elif record['status'] == 'failed' and (retry_failed or record.get('transient')):
+            todo.append(label_file)
+    return todo
+
+
+# Count the events of each status
+def count_statuses(events):
+    counts = dict.fromkeys(statuses, 0)
+    for record in events.values():
+        counts[record['status']] = counts.get(record['status'], 0) + 1
+    return counts
+
+
+# Print the number of events of each status, and the failures grouped by cause with a few examples of each
+def print_summary(events, n_examples=3):
+    counts = count_statuses(events)
+    print("\n#### Run state ####\n")
+    print("  ".join("{}: {}".format(s, counts[s]) for s in statuses))
+
+    by_cause = {}
+    for label_file, record in events.items():
+        if record['status'] == 'failed':
+            by_cause.setdefault(record.get('cause', 'error'), []).append(record)
+    if len(by_cause) == 0:
+        return
+
+    print("\nFailures by cause:")
+    for cause, records in sorted(by_cause.items(), key=lambda item: -len(item[1])):
+        print("  {:<24}{:>8}{}".format(cause, len(records), "  (transient)" if cause in transient_causes else ""))
+        for record in records[:n_examples]:
+            print("      {}: {}".format(record['label_file'], record.get('error', '')))
+        if len(records) > n_examples:
+            print("      ... and {} more".format(len(records) - n_examples))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the state of a run.py extraction run, which can also be "
+                                                 "one that is still going or whose host died.")
+    subparsers = parser.add_subparsers(dest='command')
+    summary_parser = subparsers.add_parser('summary', help="count events by status and group failures by cause")
+    summary_parser.add_argument('state', help="state file, or the log directory of the run")
+    summary_parser.add_argument('--examples', type=int, default=3,
+                                help="number of failed events to list per cause (default: %(default)s)")
+    list_parser = subparsers.add_parser('list', help="list the label files with a given status")
+    list_parser.add_argument('state', help="state file, or the log directory of the run")
+    list_parser.add_argument('status', choices=statuses)
+    list_parser.add_argument('--cause', help="only list failures with this cause")
+    args = parser.parse_args()
+
+    if args.command not in ('summary', 'list'):
+        parser.print_usage()
+        exit(1)
+    state_file = find_state_file(args.state)
+    if state_file is None:
+        print("Error: no state file found at '{}'".format(args.state))
+        exit(1)
+    header, events = read(state_file)
+
+    if args.command == 'summary':
+        if header is not None:
+            print("Run: run.py {} on {}, started {}".format(" ".join(header['argv']), header['host'],
+                                                            time.ctime(header['started'])))
+        print_summary(events, args.examples)
+    else:
+        for label_file, record in events.items():
+            if record['status'] == args.status and (args.cause is None or record.get('cause') == args.cause):
+                print(label_file)
@@ -0,0 +1,339 @@
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import argparse
+import datetime
+import traceback
+
+import extract
+import manifest
+import feature_selection
+
+# This script watches waveform-data/rf/<zone>/<date>/ for newly harvested fault events and extracts their features as
+# soon as they are complete, without waiting for a label file.  An event directory is complete once it holds all 8
+# capture files and its listing (names, sizes, mtimes) has not changed for --settle seconds.  Events that complete
+# close together are coalesced into a batch and handed to a single extract_features call per extraction type.
+#
+# Since there is no label, the features are written to the feature store with a label of None.  The trip model needs
+# the features of the faulted cavity, which is not known yet, so trip features are extracted for all 8 cavities and
+# each store row carries its cavity number.  The manifest records of these extractions have no label hash, so the
+# usual label-driven runs still extract these events once they are labeled.
+#
+# On Linux, inotify is used to wake up as soon as something changes under the watched directories.  Elsewhere (or if
+# inotify is not available) the directories are polled every --poll-interval seconds.
+
+# Number of capture files in a complete event
+n_capture_files = 8
+
+# Give up on an event directory that has not completed after this many seconds
+incomplete_timeout = 600
+
+# inotify event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+# Minimal inotify wrapper around libc.  Only used to wake up the scan loop, so the events themselves are discarded.
+class Inotify:
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    # Start watching a directory.  Failures (e.g., the directory was removed, or too many watches) are ignored since
+    # the regular rescans still find everything.
+    def watch(self, path):
+        if path in self.watches:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd >= 0:
+            self.watches[path] = wd
+
+    def unwatch(self, path):
+        wd = self.watches.pop(path, None)
+        if wd is not None:
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    # Block until something changes or timeout seconds pass
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            try:
+                os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+
+# Return an Inotify object, or None if inotify is not available on this system
+def open_inotify():
+    try:
+        return Inotify()
+    except (OSError, AttributeError):
+        return None
+
+
+# Name, size and mtime of every file in an event directory
+def list_capture_files(event_dir):
+    listing = []
+    for f in sorted(os.listdir(event_dir)):
+        stat = os.stat(os.path.join(event_dir, f))
+        listing.append((f, stat.st_size, stat.st_mtime))
+    return listing
+
+
+# Keeps track of the event directories under data_dir and reports the ones that have completed
+class EventScanner:
+    def __init__(self, data_dir, zones, settle, notifier=None):
+        self.data_dir = data_dir
+        self.zones = zones
+        self.settle = settle
+        self.notifier = notifier
+
+        # event_dir -> (listing, time first seen) for events that have not completed yet
+        self.pending = {}
+
+        # Event directories that have been reported or given up on
+        self.seen = set()
+
+        # mtime of each date directory when it was last listed, so unchanged directories are not listed again
+        self.date_mtimes = {}
+
+    def zone_dirs(self):
+        zones = self.zones
+        if zones is None:
+            zones = sorted(os.listdir(self.data_dir)) if os.path.isdir(self.data_dir) else []
+        return [os.path.join(self.data_dir, z) for z in zones if os.path.isdir(os.path.join(self.data_dir, z))]
+
+    # Find event directories that have appeared since the last scan and add them to pending
+    def find_new_events(self):
+        now = time.time()
+        for zone_dir in self.zone_dirs():
+            date_dirs = sorted(os.path.join(zone_dir, d) for d in os.listdir(zone_dir))
+            if self.notifier is not None:
+                # New date directories show up in the zone directory, and new events in the latest date directory
+                self.notifier.watch(zone_dir)
+                if len(date_dirs) > 0:
+                    self.notifier.watch(date_dirs[-1])
+
+            for date_dir in date_dirs:
+                try:
+                    mtime = os.stat(date_dir).st_mtime
+                except OSError:
+                    continue
+                if self.date_mtimes.get(date_dir) == mtime:
+                    continue
+                self.date_mtimes[date_dir] = mtime
+
+                for name in os.listdir(date_dir):
+                    event_dir = os.path.join(date_dir, name)
+                    if event_dir not in self.seen and event_dir not in self.pending and os.path.isdir(event_dir):
+                        self.pending[event_dir] = (None, now)
+                        if self.notifier is not None:
+                            self.notifier.watch(event_dir)
+
+    # Mark the event directories that already exist as seen, without reporting them.  Events still being written are
+    # kept.  With skip_extracted, only events that already have a cavity manifest record are skipped, so the rest are
+    # extracted.
+    def skip_existing(self, skip_extracted=False):
+        self.find_new_events()
+        now = time.time()
+        for event_dir in list(self.pending):
+            if skip_extracted:
+                event = extract.event_from_dir(event_dir)
+                if manifest.read_record('cavity', event.zone, event.timestamp,
+                                        manifest_dir=extract.manifest_dir) is None:
+                    continue
+            else:
+                try:
+                    mtimes = [mtime for f, size, mtime in list_capture_files(event_dir)]
+                    mtimes.append(os.stat(event_dir).st_mtime)
+                except OSError:
+                    mtimes = []
+                if any(now - mtime < self.settle for mtime in mtimes):
+                    continue
+            self.forget(event_dir)
+
+    def forget(self, event_dir):
+        del self.pending[event_dir]
+        self.seen.add(event_dir)
+        if self.notifier is not None:
+            self.notifier.unwatch(event_dir)
+
+    # Scan for changes and return a list of (event_dir, completed) for the events that are now complete.  completed
+    # is the mtime of the newest capture file, i.e., when the harvester finished writing the event.
+    def scan(self):
+        self.find_new_events()
+        now = time.time()
+        ready = []
+        for event_dir, (previous, first_seen) in list(self.pending.items()):
+            try:
+                listing = list_capture_files(event_dir)
+            except OSError:
+                # Removed or renamed while we were looking at it
+                self.forget(event_dir)
+                continue
+
+            newest = max([mtime for f, size, mtime in listing], default=first_seen)
+            if len(listing) == n_capture_files and listing == previous and now - newest >= self.settle:
+                self.forget(event_dir)
+                ready.append((event_dir, newest))
+            elif now - first_seen > incomplete_timeout and now - newest > incomplete_timeout:
+                print("Warning: giving up on {} with {} capture files".format(event_dir, len(listing)), flush=True)
+                self.forget(event_dir)
+            else:
+                self.pending[event_dir] = (listing, first_seen)
+        return ready
+
+
+# Extract the features of a batch of completed events for each extraction type.  events is a list of
+# (event_dir, completed, detected) tuples.  Prints one line per event with its latency and returns the latencies.
+def extract_events(events, extract_types, n_jobs, engine):
+    start = time.time()
+    failed = {}
+    for extract_type in extract_types:
+        by_id = {}
+        frames = []
+        loaded_dirs = []
+        for event_dir, completed, detected in events:
+            event = extract.event_from_dir(event_dir)
+            type_events = [event] if extract_type == 'cavity' else extract.cavity_events(event)
+            try:
+                type_frames = [extract.load_waveforms(e, extract_type, event_id=len(by_id) + i + 1)
+                               for i, e in enumerate(type_events)]
+            except (extract.ExtractionError, OSError, KeyError, ValueError) as ex:
+                print("Error: {} {}: {}".format(event_dir, extract_type, ex), flush=True)
+                failed.setdefault(event_dir, []).append(extract_type)
+                continue
+            for e, frame in zip(type_events, type_frames):
+                by_id[len(by_id) + 1] = e
+                frames.append(frame)
+            loaded_dirs.append(event_dir)
+
+        if len(frames) == 0:
+            continue
+        # A failure while calculating or writing the features of the batch (e.g., a full disk) fails its events, but
+        # must not stop the watcher
+        try:
+            extract.extract_loaded(by_id, frames, extract_type, n_jobs=n_jobs, engine=engine)
+        except Exception as ex:
+            print("Error: {} extraction of {} events failed: {}: {}".format(extract_type, len(loaded_dirs),
+                                                                           type(ex).__name__, ex), flush=True)
+            traceback.print_exc()
+            for event_dir in loaded_dirs:
+                print("Error: {} {}: not extracted".format(event_dir, extract_type), flush=True)
+                failed.setdefault(event_dir, []).append(extract_type)
+    written = time.time()
+
+    latencies = []
+    for event_dir, completed, detected in events:
+        if len(failed.get(event_dir, [])) == len(extract_types):
+            continue
+        latencies.append(written - completed)
+        print("{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}\t{}".format(
+            datetime.datetime.fromtimestamp(written).strftime("%Y-%m-%d %H:%M:%S"), event_dir, detected - completed,
+            written - start, written - completed, len(events)), flush=True)
+    return latencies
+
+
+# Watch for new events until interrupted (or, with once, until nothing is left pending)
+def watch(scanner, notifier, extract_types, poll_interval, batch_window, max_batch, n_jobs, engine, once=False):
+    batch = []
+    batch_started = None
+    latencies = []
+    print("written\tevent_dir\tdetect_s\textract_s\tlatency_s\tbatch_size", flush=True)
+    try:
+        while True:
+            now = time.time()
+            for event_dir, completed in scanner.scan():
+                if len(batch) == 0:
+                    batch_started = now
+                batch.append((event_dir, completed, now))
+
+            flush = len(batch) >= max_batch or (len(batch) > 0 and now - batch_started >= batch_window)
+            if once and len(scanner.pending) == 0 and len(batch) > 0:
+                flush = True
+            if flush:
+                latencies.extend(extract_events(batch, extract_types, n_jobs, engine))
+                batch = []
+                continue
+            if once and len(scanner.pending) == 0:
+                break
+
+            # Pending events may complete without any further file system activity once they settle, so they
+            # need a timed rescan even when inotify is used
+            timeout = poll_interval
+            if len(scanner.pending) > 0:
+                timeout = min(timeout, max(scanner.settle / 2, 0.1))
+            if len(batch) > 0:
+                timeout = min(timeout, max(batch_started + batch_window - now, 0.0))
+            if notifier is not None:
+                notifier.wait(timeout)
+            else:
+                time.sleep(timeout)
+    except KeyboardInterrupt:
+        pass
+
+    if len(latencies) > 0:
+        print("Extracted {} events, latency mean {:.2f}s, max {:.2f}s".format(
+            len(latencies), sum(latencies) / len(latencies), max(latencies)), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch the waveform data for new fault events and extract their "
+                                                 "features into the feature store as soon as they are complete.  "
+                                                 "Prints one line per event with its latency (seconds from the last "
+                                                 "capture file being written to the features being stored).")
+    parser.add_argument('zones', nargs='*', help="only watch these zones (default: all)")
+    parser.add_argument('--types', nargs='+', choices=extract.valid_types, default=list(extract.valid_types),
+                        help="extraction types to run (default: %(default)s)")
+    parser.add_argument('--settle', type=float, default=5.0,
+                        help="seconds an event directory must be unchanged to be complete (default: %(default)s)")
+    parser.add_argument('--batch-window', type=float, default=2.0,
+                        help="seconds to wait for more events before extracting a batch (default: %(default)s)")
+    parser.add_argument('--max-batch', type=int, default=extract.batch_chunk_size,
+                        help="extract a batch as soon as it has this many events (default: %(default)s)")
+    parser.add_argument('--poll-interval', type=float, default=None,
+                        help="seconds between scans (default: 60 with inotify, 5 without)")
+    parser.add_argument('--no-inotify', action='store_true', help="always poll, e.g., for data on NFS")
+    parser.add_argument('--backfill', action='store_true',
+                        help="also extract existing events that have no manifest record, instead of only new ones")
+    parser.add_argument('--once', action='store_true',
+                        help="exit once no events are pending instead of watching forever")
+    parser.add_argument('--n-jobs', type=int, default=extract.tsf_jobs,
+                        help="number of tsfresh processes (default: %(default)s)")
+    parser.add_argument('--engine', choices=sorted(extract.feature_engines), default=extract.default_engine,
+                        help="feature calculation engine (default: %(default)s)")
+    parser.add_argument('--cache', action='store_true',
+                        help="read capture files through the binary cache in waveform-data/cache")
+    parser.add_argument('--features', metavar='SUBSET_FILE',
+                        help="only extract the features listed in this file (see feature_selection.py)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(extract.data_dir):
+        print("Error: waveform data directory not found: {}".format(extract.data_dir))
+        exit(1)
+
+    extract.use_cache = args.cache
+    extract.output_backend = 'store'
+    if args.features is not None:
+        extract.feature_subset = feature_selection.read_feature_subset(args.features)
+
+    notifier = None if args.no_inotify else open_inotify()
+    poll_interval = args.poll_interval
+    if poll_interval is None:
+        poll_interval = 60.0 if notifier is not None else 5.0
+    print("Watching {} using {}".format(extract.data_dir, "inotify" if notifier is not None else "polling"),
+          flush=True)
+
+    scanner = EventScanner(extract.data_dir, args.zones if len(args.zones) > 0 else None, args.settle, notifier)
+    scanner.skip_existing(skip_extracted=args.backfill)
+    watch(scanner, notifier, args.types, poll_interval, args.batch_window, args.max_batch, args.n_jobs, args.engine,
+          once=args.once)
@@ -0,0 +1,188 @@
+import time
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import extract
+import windowing
+
+# Compares extraction from windowed and/or decimated waveforms (extract.py --window and --decimate) against the full
+# resolution extraction of the same events.  Every event is extracted both ways in this process, without writing any
+# output, and the report shows
+#   - the time spent loading waveforms and calculating features each way, and how much of it the reduction saves, and
+#   - how far each feature drifts from its full resolution value.  The drift of a feature in one event is
+#     |reduced - full| / (|reduced| + |full|), which is 0 for identical values and 1 when one of them is 0 or their
+#     signs differ.  Features are summarized by their median drift over the events, and with three or more events,
+#     the correlation of the two versions across events (how well the reduced feature still ranks the events).
+# Drift is also summarized by calculator, which shows which kinds of features survive the reduction.
+
+
+# Load the waveforms of an event and calculate its features with the current window and decimation settings.  Returns
+# the imputed features, with the settings suffix removed from their names, and the load and calculate times.
+def extract_features(event, extract_type, n_jobs, engine):
+    start = time.perf_counter()
+    waveforms_df = extract.load_waveforms(event, extract_type, event_id=1)
+    loaded = time.perf_counter()
+    X = extract.calculate_features(waveforms_df, n_jobs=n_jobs, engine=engine)
+    calculated = time.perf_counter()
+    X = extract.finalize_features(X, event).drop(columns=['zone', 'time'])
+    suffix = windowing.kind_suffix(extract.window, extract.decimation)
+    X.columns = [c.replace(suffix + "__", "__", 1) for c in X.columns]
+    return X, loaded - start, calculated - loaded
+
+
+# Extract every event at full resolution and with the given settings.  Returns the full and reduced features (one row
+# per event) and the [load, calculate] times of each.
+def compare_events(label_files, extract_type, window, decimation, n_jobs, engine):
+    rows = {'full': [], 'reduced': []}
+    times = {'full': [0.0, 0.0], 'reduced': [0.0, 0.0]}
+    for label_file in label_files:
+        try:
+            event = extract.read_label_file(label_file)
+            features = {}
+            for name, settings in (('full', (None, 1)), ('reduced', (window, decimation))):
+                extract.window, extract.decimation = settings
+                X, load_time, calculate_time = extract_features(event, extract_type, n_jobs, engine)
+                features[name] = X
+                times[name][0] += load_time
+                times[name][1] += calculate_time
+        except extract.SkipEvent as ex:
+            print("{}: {}".format(label_file, ex))
+            continue
+        except (extract.ExtractionError, OSError, KeyError, ValueError) as ex:
+            print("Error: {}: {}".format(label_file, ex))
+            continue
+        for name in rows:
+            rows[name].append(features[name].iloc[0].rename(label_file))
+        print("Compared {}".format(label_file), flush=True)
+    return pd.DataFrame(rows['full']), pd.DataFrame(rows['reduced']), times
+
+
+# The drift of every feature in every event (see above), for the features both extractions have
+def feature_drift(X_full, X_reduced):
+    columns = [c for c in X_full.columns if c in X_reduced.columns]
+    full = X_full[columns].values.astype('float64')
+    reduced = X_reduced[columns].values.astype('float64')
+    scale = np.abs(full) + np.abs(reduced)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        drift = np.where(scale > 0, np.abs(reduced - full) / scale, 0.0)
+    return pd.DataFrame(drift, index=X_full.index, columns=columns)
+
+
+# Correlation of the full and reduced values of each feature across events, NaN where either is constant
+def feature_correlation(X_full, X_reduced, columns):
+    correlations = {}
+    for c in columns:
+        full = X_full[c].values.astype('float64')
+        reduced = X_reduced[c].values.astype('float64')
+        if np.std(full) > 0 and np.std(reduced) > 0:
+            correlations[c] = float(np.corrcoef(full, reduced)[0, 1])
+        else:
+            correlations[c] = float('nan')
+    return pd.Series(correlations)
+
+
+# Summarize the drift of each feature and of each calculator
+def summarize(drift, correlation):
+    features = pd.DataFrame({'median_drift': drift.median(axis=0), 'max_drift': drift.max(axis=0),
+                             'correlation': correlation})
+    calculators = [c.split("__")[1] for c in features.index]
+    by_calculator = features.groupby(calculators).agg({'median_drift': ['count', 'median'],
+                                                       'correlation': 'median'})
+    by_calculator.columns = ['features', 'median_drift', 'median_correlation']
+    return features, by_calculator.sort_values('median_drift', ascending=False)
+
+
+def print_report(n_events, window, decimation, times, features, by_calculator, top):
+    settings = []
+    if window is not None:
+        settings.append("window {:g} to {:g} ms".format(window[0], window[1]))
+    if decimation > 1:
+        settings.append("decimation by {}".format(decimation))
+    print("\n#### {} events, {} vs full resolution ####\n".format(n_events, ", ".join(settings)))
+
+    fmt = "{:<12}{:>12}{:>12}{:>10}"
+    print(fmt.format("", "full (s)", "reduced (s)", "saved"))
+    full_total = sum(times['full'])
+    reduced_total = sum(times['reduced'])
+    for name, full, reduced in (('load', times['full'][0], times['reduced'][0]),
+                                ('calculate', times['full'][1], times['reduced'][1]),
+                                ('total', full_total, reduced_total)):
+        saved = "{:.0%}".format(1 - reduced / full) if full > 0 else ""
+        print(fmt.format(name, "{:.2f}".format(full), "{:.2f}".format(reduced), saved))
+
+    drift = features['median_drift']
+    print("\nFeatures compared: {}".format(len(features)))
+    for threshold in (0.001, 0.01, 0.1):
+        print("Median drift under {:g}: {} ({:.0%})".format(threshold, int((drift < threshold).sum()),
+                                                            (drift < threshold).mean() if len(drift) > 0 else 0))
+    if features['correlation'].notnull().any():
+        print("Median correlation across events: {:.3f}".format(features['correlation'].median()))
+
+    print("\nDrift by calculator (most drifted first)")
+    print(by_calculator.head(top).to_string(float_format=lambda v: "{:.4f}".format(v)))
+    print("\nMost drifted features")
+    print(features.sort_values('median_drift', ascending=False).head(top).to_string(
+        float_format=lambda v: "{:.4f}".format(v)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [options] <label_file|label_dir> [...] <(cavity|trip)>",
+        description="Compare the run time and features of windowed and/or decimated extraction against full "
+                    "resolution extraction of the same events.  Nothing is written to extracted/.")
+    parser.add_argument('label_files', nargs='+', metavar='label_file',
+                        help="processed label file(s) or directories of label files")
+    parser.add_argument('extract_type', help="one of {}".format(extract.valid_types))
+    parser.add_argument('--window', type=float, nargs=2, metavar=('START', 'END'),
+                        help="only use the samples from START to END ms around the fault (see windowing.py)")
+    parser.add_argument('--decimate', type=int, default=1, metavar='Q',
+                        help="use every Q-th sample after an anti-aliasing filter (default: %(default)s)")
+    parser.add_argument('--n-jobs', type=int, default=extract.tsf_jobs,
+                        help="number of tsfresh processes (default: %(default)s)")
+    parser.add_argument('--engine', choices=sorted(extract.feature_engines), default=extract.default_engine,
+                        help="feature calculation engine (default: %(default)s)")
+    parser.add_argument('--cache', action='store_true',
+                        help="read capture files through the binary cache in waveform-data/cache")
+    parser.add_argument('--top', type=int, default=20, help="number of rows per table (default: %(default)s)")
+    parser.add_argument('--json', metavar='REPORT_FILE',
+                        help="also write the times and the drift of every feature to this file")
+    args = parser.parse_args()
+
+    if args.extract_type not in extract.valid_types:
+        print("Error: invalid extraction type specified '{}'.  Valid options are {}".format(args.extract_type,
+                                                                                          extract.valid_types))
+        exit(1)
+    message = windowing.check_settings(args.window, args.decimate)
+    if message is None and args.window is None and args.decimate <= 1:
+        message = "nothing to compare, give --window and/or --decimate"
+    if message is not None:
+        print("Error: {}".format(message))
+        exit(1)
+    extract.use_cache = args.cache
+
+    label_files = extract.expand_label_files(args.label_files)
+    X_full, X_reduced, times = compare_events(label_files, args.extract_type, args.window, args.decimate,
+                                              args.n_jobs, args.engine)
+    if len(X_full) == 0:
+        print("Error: no events could be compared")
+        exit(1)
+
+    drift = feature_drift(X_full, X_reduced)
+    correlation = feature_correlation(X_full, X_reduced, drift.columns) if len(X_full) >= 3 else \
+        pd.Series(float('nan'), index=drift.columns)
+    features, by_calculator = summarize(drift, correlation)
+    print_report(len(X_full), args.window, args.decimate, times, features, by_calculator, args.top)
+
+    if args.json is not None:
+        with open(args.json, 'w') as fh:
+            json.dump({'extract_type': args.extract_type,
+                       'window': args.window,
+                       'decimation': args.decimate,
+                       'engine': args.engine,
+                       'n_events': len(X_full),
+                       'times': times,
+                       'features': {c: {k: (None if pd.isnull(v) else v) for k, v in row.items()}
+                                    for c, row in features.to_dict(orient='index').items()}}, fh, indent=1)
@@ -0,0 +1,70 @@
+import scipy.signal
+
+# This module reduces the waveforms of an event before features are calculated (extract.py --window and --decimate).
+# Most of what separates fault types happens around the fault at t=0 of the Time column, so
+#   - a window keeps only the samples with start <= Time <= end (in the units of Time, ms), and
+#   - decimation by q keeps every q-th sample, after a zero phase low-pass FIR filter at the new Nyquist frequency
+#     (scipy.signal.decimate) so that faster content doesn't alias into the kept samples.
+# Decimation is done on the whole capture before windowing so that the filter has no edge effects inside the window.
+#
+# Features calculated from reduced waveforms are not comparable with full resolution ones, so the signal name of every
+# feature carries the settings, e.g., 1_GMES@w-100:100@d4__mean.  Everything before the first '@' is the signal.
+# window_report.py measures the run time saved and how far the features drift from the full resolution ones.
+
+# Separates the signal name from the window and decimation settings in feature names
+suffix_separator = '@'
+
+
+# The suffix added to signal names for the given settings.  Empty if the waveforms are not reduced.
+def kind_suffix(window, decimation):
+    suffix = ''
+    if window is not None:
+        suffix += "{}w{:g}:{:g}".format(suffix_separator, window[0], window[1])
+    if decimation is not None and decimation > 1:
+        suffix += "{}d{}".format(suffix_separator, decimation)
+    return suffix
+
+
+# The signal name of a (possibly suffixed) kind
+def base_kind(kind):
+    return str(kind).split(suffix_separator, 1)[0]
+
+
+# Add the settings suffix to the signal name of each feature column.  Columns that are not features (no '__') are
+# left alone.
+def feature_names(columns, window, decimation):
+    suffix = kind_suffix(window, decimation)
+    if suffix == '':
+        return list(columns)
+    return [c.replace("__", suffix + "__", 1) if "__" in c else c for c in columns]
+
+
+# Check the window and decimation settings, returning an error message or None
+def check_settings(window, decimation):
+    if window is not None and window[0] >= window[1]:
+        return "window start {:g} is not before its end {:g}".format(window[0], window[1])
+    if decimation is not None and decimation < 1:
+        return "decimation must be at least 1, not {}".format(decimation)
+    return None
+
+
+# Decimate and window the waveforms of a single event.  df has a Time column, an id column and one column per signal.
+# Returns the reduced DataFrame (df itself if nothing needs to be done), or None if no samples fall in the window.
+def reduce_waveforms(df, window, decimation, column_id='id', column_sort='Time'):
+    if window is None and (decimation is None or decimation <= 1):
+        return df
+
+    if decimation is not None and decimation > 1:
+        signals = [c for c in df.columns if c not in (column_id, column_sort)]
+        values = df[signals].values
+        filtered = scipy.signal.decimate(values.astype('float64'), decimation, ftype='fir', axis=0,
+                                         zero_phase=True)
+        df = df.iloc[::decimation].reset_index(drop=True)
+        df[signals] = filtered[:len(df)].astype(values.dtype)
+
+    if window is not None:
+        time = df[column_sort].values
+        df = df[(time >= window[0]) & (time <= window[1])].reset_index(drop=True)
+        if len(df) == 0:
+            return None
+    return df
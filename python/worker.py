@@ -0,0 +1,230 @@
+import os
+import time
+import socket
+import hashlib
+import argparse
+import traceback
+import multiprocessing
+
+# Importing extract pulls in pandas and tsfresh.  Worker processes are forked after this import so each one starts
+# warm instead of paying the import cost for every job.
+import extract
+import profiling
+import feature_cache
+import windowing
+import feature_selection
+
+# This script runs long-lived extraction workers that pull jobs from a spool directory.  A spool directory looks like
+#   <spool>/queue/    - job files waiting to be run
+#   <spool>/running/  - job files claimed by a worker (renamed to include the host and pid of the worker)
+#   <spool>/done/     - finished jobs, with a status line appended
+#   <spool>/failed/   - failed jobs, with a status line appended
+#   <spool>/stop      - if this file exists, workers exit after their current job
+# Each job file holds a single line of "<extraction type>\t<label file>".  Jobs are claimed with an atomic rename, so
+# any number of workers on any number of hosts can share a spool directory on NFS.
+
+spool_dirs = ('queue', 'running', 'done', 'failed')
+
+
+# Create the spool directory structure if needed
+def init_spool(spool_dir):
+    for d in spool_dirs:
+        os.makedirs(os.path.join(spool_dir, d), exist_ok=True)
+
+
+# Name of the job file of a label file.  Label files with the same name in different directories get different jobs,
+# since the name includes a hash of the label file's full path.
+def job_name(label_file, extract_type):
+    path_hash = hashlib.sha1(os.path.realpath(label_file).encode('utf-8')).hexdigest()[:10]
+    return "{}.{}.{}.job".format(os.path.basename(label_file), path_hash, extract_type)
+
+
+# Write a job file for each label file into the queue.  Files are written under a temporary name and renamed so a
+# worker never sees a partially written job.  Returns the number of jobs submitted.
+def submit_jobs(spool_dir, extract_type, label_files):
+    init_spool(spool_dir)
+    queue_dir = os.path.join(spool_dir, 'queue')
+    n_jobs = 0
+    for label_file in label_files:
+        name = job_name(label_file, extract_type)
+        tmp_file = os.path.join(queue_dir, "." + name + ".tmp")
+        with open(tmp_file, 'w') as fh:
+            fh.write("{}\t{}\n".format(extract_type, os.path.realpath(label_file)))
+        os.rename(tmp_file, os.path.join(queue_dir, name))
+        n_jobs += 1
+    return n_jobs
+
+
+# Try to take ownership of a job from the queue.  Returns the path of the claimed job file, or None if another worker
+# got there first.
+def claim_job(spool_dir, name, worker_id):
+    src = os.path.join(spool_dir, 'queue', name)
+    dst = os.path.join(spool_dir, 'running', "{}.{}".format(worker_id, name))
+    try:
+        os.rename(src, dst)
+    except OSError:
+        return None
+    return dst
+
+
+# Append a status line to the job file and move it into the done or failed directory
+def finish_job(spool_dir, job_file, name, status, elapsed, message):
+    with open(job_file, 'a') as fh:
+        fh.write("{}\t{:.2f}\t{}\n".format(status, elapsed, message.replace("\n", " ")))
+    dest = 'failed' if status == 'failed' else 'done'
+    os.rename(job_file, os.path.join(spool_dir, dest, name))
+
+
+# Run the extraction for a single claimed job.  Returns a (status, message) tuple.
+def run_job(job_file, n_jobs):
+    with open(job_file, 'r') as fh:
+        extract_type, label_file = fh.readline().rstrip("\n").split("\t")
+
+    if extract_type not in extract.run_types:
+        return 'failed', "invalid extraction type '{}'".format(extract_type)
+
+    try:
+        extract.extract_event(label_file, extract_type, n_jobs=n_jobs)
+    except extract.SkipEvent as ex:
+        return 'skipped', str(ex)
+    except extract.ExtractionError as ex:
+        return 'failed', str(ex)
+    except Exception as ex:
+        traceback.print_exc()
+        return 'failed', "{}: {}".format(type(ex).__name__, ex)
+    return 'done', "Completed {} feature extraction".format(extract_type)
+
+
+# Main loop of a single worker process.  Polls the queue until the stop file appears, or until the queue is empty if
+# exit_when_empty is set.
+def work(spool_dir, poll_interval, exit_when_empty, n_jobs):
+    worker_id = "{}.{}".format(socket.gethostname(), os.getpid())
+    queue_dir = os.path.join(spool_dir, 'queue')
+    stop_file = os.path.join(spool_dir, 'stop')
+
+    while not os.path.exists(stop_file):
+        names = sorted(f for f in os.listdir(queue_dir) if f.endswith('.job'))
+        if len(names) == 0:
+            if exit_when_empty:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        for name in names:
+            job_file = claim_job(spool_dir, name, worker_id)
+            if job_file is None:
+                continue
+            start = time.time()
+            status, message = run_job(job_file, n_jobs)
+            elapsed = time.time() - start
+            finish_job(spool_dir, job_file, name, status, elapsed, message)
+            print("{}\t{}\t{}\t{:.2f}\t{}".format(worker_id, name, status, elapsed, message), flush=True)
+            if os.path.exists(stop_file):
+                break
+
+
+# Start n_workers worker processes and wait for all of them to exit
+def serve(spool_dir, n_workers, poll_interval, exit_when_empty, n_jobs):
+    init_spool(spool_dir)
+    print("worker\tjob\tstatus\telapsed\tmessage", flush=True)
+    procs = [multiprocessing.Process(target=work, args=(spool_dir, poll_interval, exit_when_empty, n_jobs))
+             for i in range(n_workers)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+
+# Print counts of jobs in each state of the spool
+def print_status(spool_dir):
+    for d in spool_dirs:
+        path = os.path.join(spool_dir, d)
+        n = len([f for f in os.listdir(path) if f.endswith('.job')]) if os.path.isdir(path) else 0
+        print("{}: {}".format(d, n))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm extraction workers that pull label files from a spool "
+                                                 "directory.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    submit_parser = subparsers.add_parser('submit', help="queue label files for extraction")
+    submit_parser.add_argument('spool_dir')
+    submit_parser.add_argument('extract_type', help="one of {}".format(extract.run_types))
+    submit_parser.add_argument('label_files', nargs='+', metavar='label_file',
+                               help="processed label file(s) or directories of label files")
+
+    serve_parser = subparsers.add_parser('serve', help="run worker processes on this host")
+    serve_parser.add_argument('spool_dir')
+    serve_parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                              help="number of worker processes (default: %(default)s)")
+    serve_parser.add_argument('--poll-interval', type=float, default=2.0,
+                              help="seconds to wait between checks of an empty queue (default: %(default)s)")
+    serve_parser.add_argument('--exit-when-empty', action='store_true',
+                              help="exit once the queue is empty instead of waiting for new jobs")
+    serve_parser.add_argument('--n-jobs', type=int, default=extract.tsf_jobs,
+                              help="number of tsfresh processes per job (default: %(default)s)")
+    serve_parser.add_argument('--cache', action='store_true',
+                              help="read capture files through the binary cache in waveform-data/cache")
+    serve_parser.add_argument('--index', action='store_true',
+                              help="find events through the index in waveform-data/index (see event_index.py)")
+    serve_parser.add_argument('--output', choices=extract.output_backends, default=extract.output_backend,
+                              help="write per-event CSV files or append to the feature store (default: %(default)s)")
+    serve_parser.add_argument('--features', metavar='SUBSET_FILE',
+                              help="only extract the features listed in this file (see feature_selection.py)")
+    serve_parser.add_argument('--profile', metavar='PROFILE_FILE',
+                              help="append the time and memory used by each stage and feature calculator of every "
+                                   "job to this file (see profiling.py)")
+    serve_parser.add_argument('--mem-budget', type=float, default=None, metavar='MB',
+                              help="keep each job under this many MB of resident memory (see chunked_features.py)")
+    serve_parser.add_argument('--window', type=float, nargs=2, metavar=('START', 'END'),
+                              help="only use the samples from START to END ms around the fault (see windowing.py)")
+    serve_parser.add_argument('--decimate', type=int, default=extract.decimation, metavar='Q',
+                              help="use every Q-th sample after an anti-aliasing filter (default: %(default)s)")
+    serve_parser.add_argument('--feature-cache', nargs='?', const=feature_cache.cache_dir, metavar='CACHE_DIR',
+                              help="only calculate the features that are not in the feature cache, and add them to "
+                                   "it (see feature_cache.py)")
+    serve_parser.add_argument('--feature-cache-local', metavar='LOCAL_DIR',
+                              help="keep a copy of the feature cache entries used in this directory on this node's "
+                                   "local disk, in front of the shared --feature-cache")
+    serve_parser.add_argument('--feature-cache-size', type=float, metavar='GB',
+                              help="when the workers exit, remove the least recently used feature cache entries "
+                                   "until each cache directory is under this size")
+
+    status_parser = subparsers.add_parser('status', help="show the number of jobs in each state")
+    status_parser.add_argument('spool_dir')
+
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        if args.extract_type not in extract.run_types:
+            print("Error: invalid extraction type specified '{}'.  Valid options are {}".format(
+                args.extract_type, extract.run_types))
+            exit(1)
+        label_files = extract.expand_label_files(args.label_files)
+        print("Submitted {} jobs".format(submit_jobs(args.spool_dir, args.extract_type, label_files)))
+    elif args.command == 'serve':
+        extract.use_cache = args.cache
+        extract.use_index = args.index
+        extract.output_backend = args.output
+        extract.memory_budget = args.mem_budget
+        extract.window = args.window
+        extract.decimation = args.decimate
+        message = windowing.check_settings(args.window, args.decimate)
+        if message is not None:
+            print("Error: {}".format(message))
+            exit(1)
+        if args.features is not None:
+            extract.feature_subset = feature_selection.read_feature_subset(args.features)
+        if args.profile is not None:
+            profiling.enable(args.profile)
+        if args.feature_cache is not None:
+            extract.feature_cache_dirs = feature_cache.tiers(args.feature_cache, args.feature_cache_local)
+        serve(args.spool_dir, args.workers, args.poll_interval, args.exit_when_empty, args.n_jobs)
+        if extract.feature_cache_dirs is not None and args.feature_cache_size is not None:
+            feature_cache.prune_tiers(extract.feature_cache_dirs, args.feature_cache_size * 2**30)
+    elif args.command == 'status':
+        print_status(args.spool_dir)
+    else:
+        parser.print_usage()
+        exit(1)